@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Throughput of the JSON serialization of a large diagram:
+`System.json_dump()` to a string (json module with the `to_json` hook)
+versus `System.json_dump(file)` (text written as it is generated)
+
+usage: python bench_json.py [number of blocks]
+"""
+
+from __future__ import division, print_function
+
+import sys
+import os
+import time
+import tempfile
+import tracemalloc
+
+from generators import chain as chain_diagram
+
+
+def measure(func):
+    '''run `func` and return (duration in s, peak of allocated memory in bytes)
+    
+    (the memory is traced in a second run, to not slow down the timing)
+    '''
+    t0 = time.perf_counter()
+    func()
+    duration = time.perf_counter() - t0
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak
+
+
+def main(n):
+    root = chain_diagram(n)
+    path = os.path.join(tempfile.mkdtemp(), 'diagram.json')
+
+    def to_string():
+        with open(path, 'w') as f:
+            f.write(root.json_dump())
+
+    def dump_file():
+        with open(path, 'w') as f:
+            root.json_dump(f)
+
+    print('JSON serialization of a chain of {:d} blocks'.format(n))
+    for name, func in [('json_dump() string', to_string),
+                       ('json_dump(file)', dump_file)]:
+        duration, peak = measure(func)
+        size = os.path.getsize(path)
+        print('{:20s} {:8.3f} s  {:8.1f} MB/s  peak memory {:8.1f} MB'.format(
+              name, duration, size/duration/1e6, peak/1e6))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    main(n)
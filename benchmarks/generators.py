@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Generators of synthetic block diagrams of any size, for benchmarks
+
+* `chain`: a chain of TransferFunctions
+* `tree`: a tree of Summations adding filtered Sources
+* `mesh`: a grid of Summations, each one adding its left and upper neighbours
+* `nested`: a deep hierarchy of SISOSystems with TransferFunctions as leaves
+
+Each generator takes the approximate number of blocks `n` and an optional
+dict `timings`, which receives the durations (in s) of the 'construction'
+of the blocks and of their 'connection' (with `connect_systems`).
+"""
+
+from __future__ import division, print_function
+
+import sys
+import os
+import time
+
+try:
+    import blocks
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    import blocks
+
+
+class _Timer(object):
+    '''records the durations of the successive phases of a generator
+    in the dict `timings` (if not None)'''
+    def __init__(self, timings):
+        self.timings = timings
+        self.t0 = time.perf_counter()
+    
+    def phase(self, name):
+        '''end of the phase `name`'''
+        t = time.perf_counter()
+        if self.timings is not None:
+            self.timings[name] = t - self.t0
+        self.t0 = t
+
+
+def chain(n, timings=None):
+    '''chain of `n` TransferFunction blocks between a Source and a Sink'''
+    timer = _Timer(timings)
+    root = blocks.System('chain')
+    src = blocks.Source('src', root)
+    tfs = [blocks.TransferFunction('TF{:d}'.format(i), [1, 0.5], [1, 2, 1], root)
+           for i in range(n)]
+    out = blocks.Sink('out', root)
+    timer.phase('construction')
+    prev = src
+    for tf in tfs:
+        blocks.connect_systems(prev, tf)
+        prev = tf
+    blocks.connect_systems(prev, out)
+    timer.phase('connection')
+    return root
+
+
+def tree(n, timings=None):
+    '''binary tree of about `n` blocks: n/4 Sources filtered by
+    TransferFunctions and added two by two by Summations, down to a Sink'''
+    timer = _Timer(timings)
+    root = blocks.System('tree')
+    n_leaves = max(n//4, 1)
+    sources = [blocks.Source('src{:d}'.format(i), root) for i in range(n_leaves)]
+    filters = [blocks.TransferFunction('TF{:d}'.format(i), [1], [1, 1], root)
+               for i in range(n_leaves)]
+    sums = [blocks.Summation('sum{:d}'.format(i), ['+', '+'], root)
+            for i in range(n_leaves-1)]
+    out = blocks.Sink('out', root)
+    timer.phase('construction')
+    for src, tf in zip(sources, filters):
+        blocks.connect_systems(src, tf)
+    # level by level, each Summation adds two blocks of the previous level:
+    level = filters
+    k = 0
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level)-1, 2):
+            s = sums[k]
+            k += 1
+            blocks.connect_systems(level[i], s, d_pname='in0')
+            blocks.connect_systems(level[i+1], s, d_pname='in1')
+            next_level.append(s)
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    blocks.connect_systems(level[0], out)
+    timer.phase('connection')
+    return root
+
+
+def mesh(n, timings=None):
+    '''square grid of about `n` Summation blocks, each one adding the outputs
+    of its left and upper neighbours (the first row and column are fed by
+    a Source), with the last block filtered to a Sink'''
+    timer = _Timer(timings)
+    root = blocks.System('mesh')
+    side = max(int(round(n**0.5)), 1)
+    src = blocks.Source('src', root)
+    cells = [[blocks.Summation('sum{:d}_{:d}'.format(i, j), ['+', '+'], root)
+              for j in range(side)] for i in range(side)]
+    tf = blocks.TransferFunction('TF', [1], [1, 1], root)
+    out = blocks.Sink('out', root)
+    timer.phase('construction')
+    for i in range(side):
+        for j in range(side):
+            up = cells[i-1][j] if i > 0 else src
+            left = cells[i][j-1] if j > 0 else src
+            blocks.connect_systems(up, cells[i][j], d_pname='in0')
+            blocks.connect_systems(left, cells[i][j], d_pname='in1')
+    blocks.connect_systems(cells[-1][-1], tf)
+    blocks.connect_systems(tf, out)
+    timer.phase('connection')
+    return root
+
+
+def nested(n, width=2, timings=None):
+    '''hierarchy of SISOSystems, each one containing a chain of `width`
+    SISOSystems, down to about `n` TransferFunction leaves
+    (the depth of the hierarchy is log(n)/log(width))'''
+    timer = _Timer(timings)
+    root = blocks.System('nested')
+    depth = 0
+    while width**(depth+1) <= n:
+        depth += 1
+    
+    # construction, level by level:
+    top = blocks.SISOSystem('S', root)
+    levels = [[top]]
+    for d in range(depth):
+        children = []
+        for parent in levels[-1]:
+            for i in range(width):
+                if d == depth-1:
+                    child = blocks.TransferFunction('TF{:d}'.format(i), [1], [1, 1], parent)
+                else:
+                    child = blocks.SISOSystem('S{:d}'.format(i), parent)
+                children.append(child)
+        levels.append(children)
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', root)
+    timer.phase('construction')
+    
+    for level in levels[:-1]:
+        for syst in level:
+            inner = syst.subsystems
+            if not inner:
+                continue
+            w_in = blocks.SignalWire('w_in', parent=syst)
+            w_in.connect_port(syst.ports_dict['in'], 'parent')
+            w_in.connect_port(inner[0].ports_dict['in'])
+            for a, b in zip(inner[:-1], inner[1:]):
+                blocks.connect_systems(a, b)
+            w_out = blocks.SignalWire('w_out', parent=syst)
+            w_out.connect_port(syst.ports_dict['out'], 'parent')
+            w_out.connect_port(inner[-1].ports_dict['out'])
+    blocks.connect_systems(src, top)
+    blocks.connect_systems(top, out)
+    timer.phase('connection')
+    return root
+
+
+GENERATORS = {'chain': chain, 'tree': tree, 'mesh': mesh, 'nested': nested}
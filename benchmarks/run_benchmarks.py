@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Benchmark suite of sysdiag on synthetic diagrams (see `generators`)
+
+Times the construction of the diagrams, their connection, `incidence_matrix`,
+`json_dump`, `json_load`, `__eq__` and `transfer_syst` (with the default
+`sympy.solve` method up to 100 blocks, and the 'linear' and 'sfg' methods
+up to 10^4 blocks)
+for each generator and size, and records the results to a json file.
+If a baseline file exists, the results are compared to it and the slower
+operations are flagged as regressions (with an exit status of 1).
+
+The default sizes go from 10 to 10^4 blocks. The sizes 10^5 and 10^6 are
+added with --large: they take several minutes (about 3 min for one run of
+the four generators at 10^5 blocks) and several GB of memory at 10^6.
+
+usage: python run_benchmarks.py [--sizes 10 100 1000] [--large]
+                                [--generators chain mesh]
+                                [--output results.json] [--baseline baseline.json]
+                                [--save-baseline] [--tolerance 0.25]
+"""
+
+from __future__ import division, print_function
+
+import sys
+import os
+import time
+import json
+import platform
+import argparse
+
+try:
+    import blocks
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    import blocks
+import sysdiag
+import transfer_func
+
+from generators import GENERATORS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _reset_caches(syst):
+    '''reset the cached hashes and analyses of `syst` and of its descendants,
+    to time the operations without their caches'''
+    stack = [syst]
+    while stack:
+        s = stack.pop()
+        s._structural_hash = None
+        s._analysis_cache = None
+        stack.extend(s.subsystems)
+
+
+def _incidence_matrix(state):
+    _reset_caches(state['root'])
+    blocks.incidence_matrix(state['root'], sparse=True)
+
+def _json_dump(state):
+    state['dump'] = state['root'].json_dump()
+
+def _json_load(state):
+    state['loaded'] = sysdiag.json_load(state['dump'])
+
+def _eq(state):
+    _reset_caches(state['root'])
+    _reset_caches(state['loaded'])
+    assert state['root'] == state['loaded']
+
+def _transfer_syst_solve(state):
+    _reset_caches(state['root'])
+    transfer_func.clear_reduction_cache()
+    transfer_func.transfer_syst(state['root'])
+
+def _transfer_syst_linear(state):
+    _reset_caches(state['root'])
+    transfer_func.transfer_syst(state['root'], method='linear')
+
+def _transfer_syst_sfg(state):
+    _reset_caches(state['root'])
+    transfer_func.clear_reduction_cache()
+    transfer_func.transfer_syst(state['root'], method='sfg')
+
+# Timed operations: (name, function of the benchmark state, maximum size)
+# (each operation can use the results of the previous ones in the state)
+OPERATIONS = [('incidence_matrix', _incidence_matrix, None),
+              ('json_dump', _json_dump, None),
+              ('json_load', _json_load, None),
+              ('__eq__', _eq, None),
+              ('transfer_syst_solve', _transfer_syst_solve, 100),
+              ('transfer_syst_linear', _transfer_syst_linear, 10000),
+              ('transfer_syst_sfg', _transfer_syst_sfg, 10000)]
+
+# Sizes added by the --large option:
+LARGE_SIZES = [100000, 1000000]
+
+
+def best_time(func, repeat):
+    '''best duration (in s) of `repeat` runs of `func()`'''
+    durations = []
+    for k in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t0)
+    return min(durations)
+
+
+def run(generators, sizes, repeat=3, verbose=True):
+    '''time the operations on the diagrams of the `generators` (names)
+    for each of the `sizes`
+
+    Returns a dict {'<generator>/<size>/<operation>': duration in s}
+    '''
+    results = {}
+    for gen_name in generators:
+        for n in sizes:
+            timings = {}
+            state = {'root': GENERATORS[gen_name](n, timings=timings)}
+            for op_name in ['construction', 'connection']:
+                results['{}/{}/{}'.format(gen_name, n, op_name)] = timings[op_name]
+            for op_name, func, max_size in OPERATIONS:
+                if max_size is not None and n > max_size:
+                    continue
+                # (the first run initializes the state for the next operations)
+                results['{}/{}/{}'.format(gen_name, n, op_name)] = \
+                    best_time(lambda: func(state), repeat)
+            if verbose:
+                for key in sorted(k for k in results
+                                  if k.startswith('{}/{}/'.format(gen_name, n))):
+                    print('{:40s} {:10.6f} s'.format(key, results[key]))
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, min_delta=1e-3):
+    '''regressions of the `results` with respect to the `baseline`:
+    operations slower by more than `tolerance` (relative)
+    and by more than `min_delta` seconds (to ignore the timing noise)
+
+    Returns a list of (key, baseline duration, duration)
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], results[key]
+        if new > old*(1 + tolerance) and new - old > min_delta:
+            regressions.append((key, old, new))
+    return regressions
+
+
+def save(results, path):
+    '''save the `results` to the json file `path`, with the description
+    of the platform'''
+    data = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    '''results saved in the json file `path`'''
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='sysdiag benchmark suite')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='numbers of blocks of the diagrams')
+    parser.add_argument('--large', action='store_true',
+                        help='add the sizes {} (slow)'.format(LARGE_SIZES))
+    parser.add_argument('--generators', nargs='+', default=sorted(GENERATORS),
+                        choices=sorted(GENERATORS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each operation (the best is kept)')
+    parser.add_argument('--output', default=os.path.join(HERE, 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown flagged as a regression')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes + (LARGE_SIZES if args.large else [])
+    results = run(args.generators, sizes, args.repeat)
+    save(results, args.output)
+    print('results saved to {}'.format(args.output))
+    if args.save_baseline:
+        save(results, args.baseline)
+        print('baseline saved to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+
+    regressions = compare(results, load(args.baseline), args.tolerance)
+    for key, old, new in regressions:
+        print('REGRESSION {:40s} {:10.6f} s -> {:10.6f} s (x{:.2f})'.format(
+              key, old, new, new/old))
+    if not regressions:
+        print('no regression with respect to {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
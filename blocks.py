@@ -5,10 +5,13 @@ Pierre Haessig — September 2013
 """
 
 from __future__ import division, print_function
+import logging
 import numpy as np
 
 import sysdiag
-from sysdiag import System, InputPort, OutputPort, SignalWire
+from sysdiag import System, InputPort, OutputPort, Wire, SignalWire
+
+logger = logging.getLogger(__name__)
 
 class Source(System):
     '''generic signal input source ("generator")'''
@@ -77,6 +80,11 @@ class Summation(System):
         dict_obj.update({'_operators': self._operators})
         return dict_obj
     # end _to_json
+    
+    def _load_json_extra(self, json_object):
+        '''restore the operators of the Summation from its json object'''
+        if '_operators' in json_object:
+            self.set_operators(json_object['_operators'])
 
 def connect_systems(source, dest, s_pname='out', d_pname='in'):
     '''Connect systems `source` to `dest` using
@@ -92,31 +100,231 @@ def connect_systems(source, dest, s_pname='out', d_pname='in'):
                                 wire_cls=SignalWire)
     return w
 
-def incidence_matrix(syst):
+def _incidence_entries(syst):
+    '''entries of the incidence matrix of `syst`, one per connected
+    input or output port, as a triple of read-only arrays (row, col, data):
+    wire index, subsystem index (both `np.intp`) and sign (`np.int8`).
+    There may be several entries for the same wire and subsystem.
+    
+    The entries are cached on `syst` until it is modified
+    (see `System._cached_analysis`)
+    '''
+    return syst._cached_analysis('incidence_entries',
+                                 lambda: _compute_incidence_entries(syst))
+
+def _compute_incidence_entries(syst):
+    '''entries of the incidence matrix of `syst` (see `_incidence_entries`)
+    
+    The wire and direction of each port are read with `np.fromiter` into
+    preallocated arrays (the Port objects must still be visited one by one),
+    the selection of the connected input and output ports is vectorized.
+    '''
+    subsystems = syst.subsystems
+    # build a Look-up Table for wire indices:
+    wires_ind = {w:i for i,w in enumerate(syst.wires)}
+    direction_sign = {'out': 1, 'in': -1}
+    
+    ports = [p for s in subsystems for p in s.ports]
+    n_ports = np.fromiter((len(s.ports) for s in subsystems), dtype=np.intp,
+                          count=len(subsystems))
+    col = np.repeat(np.arange(len(subsystems), dtype=np.intp), n_ports)
+    # wire index, -1 for an unconnected port:
+    row = np.fromiter((-1 if p.wire is None else wires_ind[p.wire]
+                       for p in ports), dtype=np.intp, count=len(ports))
+    data = np.fromiter((direction_sign.get(p.direction, 0) for p in ports),
+                       dtype=np.int8, count=len(ports))
+    
+    unconnected = row < 0
+    for i in np.flatnonzero(unconnected):
+        logger.warning('unconnected port %s', ports[i])
+    keep = ~unconnected & (data != 0)
+    row, col, data = row[keep], col[keep], data[keep]
+    for arr in (row, col, data):
+        arr.setflags(write=False)
+    return row, col, data
+
+def incidence_matrix(syst, sparse=False):
     '''computes the incidence matrix of the system `syst` taking into account
     the IO Ports (Port direction 'in' and 'out').
-    An ouput port yields +1, an input -1
+    An ouput port yields +1, an input -1. If several ports of a subsystem
+    are connected to the same wire, the last one gives the entry.
+    
+    The matrix has one row per wire and one column per subsystem
+    (dtype `np.int8`).
+    
+    if `sparse` is False: return a dense NumPy array
+    if `sparse` is True: return a scipy.sparse CSR matrix or,
+    if SciPy is not available, the triple of arrays (row, col, data)
+    of the entries (COO format, without duplicates).
     '''
     nw = len(syst.wires)
     ns = len(syst.subsystems)
-    inc_mat = np.zeros((nw, ns), dtype=np.int8)
-    # build a Look-up Table for wire indices:
-    wires_ind = {w:i for i,w in enumerate(syst.wires)}
+    row, col, data = _incidence_entries(syst)
+    # keep the last entry of each (wire, subsystem):
+    keys = row * ns + col
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    row, col, data = row[last], col[last], data[last]
     
-    for s_ind, s in enumerate(syst.subsystems):
-        for p in s.ports:
-            if p.wire is None:
-                print('Warning: unconnected port {:s}'.format(str(p)))
-                continue # (unconnected port)
-            # find the index of the Port's wire
-            w_ind = wires_ind[p.wire]
-            # Put an entry in the incidence matrix:
-            if p.direction == 'out':
-                inc_mat[w_ind, s_ind] = 1
-            elif p.direction == 'in':
-                inc_mat[w_ind, s_ind] = -1
-    
-    return inc_mat
-            
-            
+    if not sparse:
+        inc_mat = np.zeros((nw, ns), dtype=np.int8)
+        inc_mat[row, col] = data
+        return inc_mat
+    
+    try:
+        import scipy.sparse
+    except ImportError:
+        return row, col, data
+    return scipy.sparse.coo_matrix((data, (row, col)), shape=(nw, ns)).tocsr()
+
+def adjacency_matrix(syst, sparse=True):
+    '''computes the block-to-block adjacency matrix of the system `syst`.
+    
+    Entry (i,j) is the number of wires going from an output port of
+    subsystem i to an input port of subsystem j.
+    
+    if `sparse` is False: return a dense NumPy array
+    if `sparse` is True (default): return a scipy.sparse CSR matrix or,
+    if SciPy is not available, the triple of arrays (row, col, data)
+    of the non-zero entries (COO format, with possible duplicates to be summed).
+    '''
+    nw = len(syst.wires)
+    ns = len(syst.subsystems)
+    row, col, data = _incidence_entries(syst)
+    
+    out = data == 1
+    out_wire, out_syst = row[out], col[out]
+    in_wire, in_syst = row[~out], col[~out]
+    
+    # Pair each input entry with all the output entries of the same wire:
+    order = np.argsort(out_wire, kind='stable')
+    out_wire, out_syst = out_wire[order], out_syst[order]
+    n_out = np.bincount(out_wire, minlength=nw)
+    first_out = np.cumsum(n_out) - n_out
+    
+    n_pairs = n_out[in_wire]
+    adj_col = np.repeat(in_syst, n_pairs)
+    # position of each pair within the group of outputs of its wire:
+    pair_start = np.cumsum(n_pairs) - n_pairs
+    offset = np.arange(n_pairs.sum()) - np.repeat(pair_start, n_pairs)
+    adj_row = out_syst[np.repeat(first_out[in_wire], n_pairs) + offset]
+    adj_data = np.ones(len(adj_row), dtype=np.intp)
+    
+    if not sparse:
+        adj_mat = np.zeros((ns, ns), dtype=np.intp)
+        np.add.at(adj_mat, (adj_row, adj_col), adj_data)
+        return adj_mat
+    
+    try:
+        import scipy.sparse
+    except ImportError:
+        return adj_row, adj_col, adj_data
+    return scipy.sparse.coo_matrix((adj_data, (adj_row, adj_col)),
+                                   shape=(ns, ns)).tocsr()
+
+def flatten(syst):
+    '''flattens the hierarchy of `syst` into its *leaf blocks*
+    interconnected by *signals*.
+    
+    Leaf blocks are the empty subsystems (no subsystems nor wires)
+    at any depth of the hierarchy. Wires joined through the ports of
+    intermediate subsystems carry the same signal: they are merged.
+    The input ports of `syst` and the Source blocks are the inputs of the
+    flattened diagram, its output ports and the Sink blocks are the outputs.
+    (if `syst` is empty, it is its own unique leaf block)
+    
+    Returns
+    -------
+    leaves: list of (block, in_signals, out_signals) with the signal indices
+            of the input and output ports of each leaf block
+            (None for an unconnected port)
+    signals: list of the wires representing each signal
+             (the first wire of the signal in depth-first order)
+    inputs: list of (name, signal) of the inputs, named 'U_<syst>_<port>'
+            for the ports and 'U_<source>' for the Sources
+    outputs: list of (name, signal) of the outputs, named 'Y_<syst>_<port>'
+             for the ports and 'Y_<sink>' for the Sinks
+    '''
+    in_ports  = [p for p in syst.ports if p.direction=='in']
+    out_ports = [p for p in syst.ports if p.direction=='out']
+    
+    # Wires, with a union-find forest to merge the wires of the same signal
+    wires = []
+    wires_ind = {}
+    wires_parent = []
+    def register(w):
+        if w is None:
+            return None
+        ind = wires_ind.get(w)
+        if ind is None:
+            ind = wires_ind[w] = len(wires)
+            wires.append(w)
+            wires_parent.append(ind)
+        return ind
+    def find(ind):
+        root = ind
+        while wires_parent[root] != root:
+            root = wires_parent[root]
+        while wires_parent[ind] != root: # path compression
+            wires_parent[ind], ind = root, wires_parent[ind]
+        return root
+    
+    leaves = []
+    inputs = []
+    outputs = []
+    if syst.is_empty():
+        # no inside: syst is its own leaf, with one signal per port
+        in_ind  = [register(Wire(p.name, p.type)) for p in in_ports]
+        out_ind = [register(Wire(p.name, p.type)) for p in out_ports]
+        leaves.append((syst, in_ind, out_ind))
+    else:
+        in_ind  = [register(p.internal_wire) for p in in_ports]
+        out_ind = [register(p.internal_wire) for p in out_ports]
+    inputs.extend(('U_{}_{}'.format(syst.name, p.name), ind)
+                  for p, ind in zip(in_ports, in_ind))
+    outputs.extend(('Y_{}_{}'.format(syst.name, p.name), ind)
+                   for p, ind in zip(out_ports, out_ind))
+    
+    # Depth first traversal of the hierarchy:
+    stack = [] if syst.is_empty() else [syst]
+    while stack:
+        s = stack.pop()
+        for w in s.wires:
+            register(w)
+        for subsys in s.subsystems:
+            sub_in  = [register(p.wire) for p in subsys.ports if p.direction=='in']
+            sub_out = [register(p.wire) for p in subsys.ports if p.direction=='out']
+            if isinstance(subsys, Source):
+                inputs.append(('U_' + subsys.name, sub_out[0]))
+            elif isinstance(subsys, Sink):
+                outputs.append(('Y_' + subsys.name, sub_in[0]))
+            elif subsys.is_empty():
+                leaves.append((subsys, sub_in, sub_out))
+            else:
+                # intermediate system: merge the outer and inner wires
+                for p in subsys.ports:
+                    outer, inner = register(p.wire), register(p.internal_wire)
+                    if outer is not None and inner is not None:
+                        wires_parent[find(inner)] = find(outer)
+                stack.append(subsys)
+    # end while
+    
+    # Number the signals, in the order of their first wire:
+    signals = []
+    signal_ind = {}
+    wire_signal = []
+    for ind in range(len(wires)):
+        root = find(ind)
+        if root not in signal_ind:
+            signal_ind[root] = len(signals)
+            signals.append(wires[ind])
+        wire_signal.append(signal_ind[root])
     
+    def to_signal(ind):
+        return None if ind is None else wire_signal[ind]
+    leaves = [(block, [to_signal(i) for i in in_ind], [to_signal(i) for i in out_ind])
+              for block, in_ind, out_ind in leaves]
+    inputs = [(name, to_signal(ind)) for name, ind in inputs]
+    outputs = [(name, to_signal(ind)) for name, ind in outputs]
+    return leaves, signals, inputs, outputs
+# end flatten
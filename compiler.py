@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Compilation of block diagrams into flat execution plans
+
+The hierarchy of a diagram is flattened once (see `blocks.flatten`) into
+contiguous integer arrays: kinds of the leaf blocks, signals of their ports,
+block-to-block connections, parameter tables and an evaluation order.
+Simulators and solvers can then reuse this plan many times
+without walking through the System/Port/Wire objects.
+"""
+
+from __future__ import division, print_function
+import numpy as np
+
+import blocks
+
+# Kinds of leaf blocks:
+KIND_OTHER = 0
+KIND_TF = 1
+KIND_SUM = 2
+
+def _csr(rows, dtype):
+    '''concatenation of the lists `rows` with their offsets (CSR layout)'''
+    ptr = np.zeros(len(rows)+1, dtype=np.intp)
+    ptr[1:] = np.cumsum([len(r) for r in rows])
+    values = [v for r in rows for v in r]
+    data = np.array(values)
+    if data.dtype != object: # symbolic coefficients are kept as objects
+        data = data.astype(dtype)
+    return ptr, data
+
+def _trim(coefs):
+    '''number of coefficients without the zero highest powers
+    (None for symbolic coefficients)'''
+    try:
+        nonzero = np.flatnonzero(np.asarray(coefs, dtype=float))
+    except TypeError:
+        return None
+    return nonzero[-1]+1 if len(nonzero) else 0
+
+class CompiledDiagram(object):
+    '''Flat execution plan of a block diagram (see `compile`)
+    
+    Leaf blocks are numbered 0..n_blocks-1 and signals 0..n_signals-1.
+    Unconnected ports have the signal -1.
+    
+    Attributes
+    ----------
+    kind: kind of each block (KIND_TF, KIND_SUM or KIND_OTHER)
+    in_ptr, in_sig: signals of the input ports of the blocks (CSR layout:
+                    the inputs of block b are in_sig[in_ptr[b]:in_ptr[b+1]])
+    in_gain: gain (±1) of each input of the Summation blocks (1 otherwise)
+    out_ptr, out_sig: signals of the output ports of the blocks (CSR layout)
+    num_ptr, num, den_ptr, den: coefficients of the numerator and denominator
+                                of the TransferFunction blocks (CSR layout,
+                                empty for other blocks)
+    feedthrough: True for blocks whose outputs depend directly on their inputs
+    input_names, input_sig: inputs of the diagram and their signals
+    output_names, output_sig: outputs of the diagram and their signals
+    n_drivers: number of sources (block outputs and inputs) of each signal
+    driver: block driving each signal (-1 for none or for an input)
+    edge_src, edge_dst, edge_sig: connections from block to block
+    order: evaluation order of the blocks (each block after the blocks
+           it depends on, except in algebraic loops, see `graph.topological_order`)
+    level: evaluation level of the blocks (-1 for the blocks in algebraic loops)
+    algebraic_loop: True if some feedthrough blocks depend on each other
+    
+    The `system`, its leaf `blocks` and the wires of its `signals`
+    are also kept, for the lookup of blocks and for error messages.
+    '''
+    def __init__(self, syst):
+        leaves, signals, inputs, outputs = blocks.flatten(syst)
+        self.system = syst
+        self.blocks = [block for block, in_sig, out_sig in leaves]
+        self.signals = signals
+        self._block_index = dict((id(block), b) for b, block in enumerate(self.blocks))
+        n_blocks = len(leaves)
+        n_sig = len(signals)
+        
+        def sig_list(sigs):
+            return [-1 if sig is None else sig for sig in sigs]
+        
+        kind = np.zeros(n_blocks, dtype=np.int8)
+        feedthrough = np.ones(n_blocks, dtype=bool)
+        in_gain, num, den = [], [], []
+        for b, (block, in_sig, out_sig) in enumerate(leaves):
+            gain = [1.]*len(in_sig)
+            num_b, den_b = [], []
+            if isinstance(block, blocks.TransferFunction):
+                kind[b] = KIND_TF
+                num_b, den_b = block.params['num'], block.params['den']
+                n_num, n_den = _trim(num_b), _trim(den_b)
+                if n_num is not None and n_den is not None:
+                    feedthrough[b] = n_num >= n_den
+            elif isinstance(block, blocks.Summation):
+                kind[b] = KIND_SUM
+                gain = [1. if op == '+' else -1. for op in block._operators]
+            in_gain.append(gain)
+            num.append(num_b)
+            den.append(den_b)
+        self.kind = kind
+        self.feedthrough = feedthrough
+        self.in_ptr, self.in_sig = _csr([sig_list(l[1]) for l in leaves], np.intp)
+        self.out_ptr, self.out_sig = _csr([sig_list(l[2]) for l in leaves], np.intp)
+        _, self.in_gain = _csr(in_gain, float)
+        self.num_ptr, self.num = _csr(num, float)
+        self.den_ptr, self.den = _csr(den, float)
+        
+        self.input_names = [name for name, sig in inputs]
+        self.input_sig = np.array(sig_list(sig for name, sig in inputs), dtype=np.intp)
+        self.output_names = [name for name, sig in outputs]
+        self.output_sig = np.array(sig_list(sig for name, sig in outputs), dtype=np.intp)
+        
+        # Sources of the signals:
+        out_block = np.repeat(np.arange(n_blocks), np.diff(self.out_ptr))
+        in_block = np.repeat(np.arange(n_blocks), np.diff(self.in_ptr))
+        driven = self.out_sig >= 0
+        self.n_drivers = np.bincount(self.out_sig[driven], minlength=n_sig) + \
+                         np.bincount(self.input_sig[self.input_sig >= 0], minlength=n_sig)
+        self.driver = np.full(n_sig, -1, dtype=np.intp)
+        self.driver[self.out_sig[driven]] = out_block[driven]
+        
+        # Connections from block to block:
+        connected = self.in_sig >= 0
+        connected[connected] = self.driver[self.in_sig[connected]] >= 0
+        self.edge_sig = self.in_sig[connected]
+        self.edge_src = self.driver[self.edge_sig]
+        self.edge_dst = in_block[connected]
+        
+        import graph # (graph depends on this module)
+        self.order, self.level, self.algebraic_loop = graph._evaluation_levels(self)
+    # end __init__
+    
+    @property
+    def n_blocks(self):
+        return len(self.kind)
+    
+    @property
+    def n_signals(self):
+        return len(self.signals)
+    
+    def block_index(self, block):
+        '''index of the leaf `block`, given either as a System or
+        as a path of names (e.g. 'plant/integrator')'''
+        if isinstance(block, str):
+            syst = self.system
+            for name in block.split('/'):
+                syst = syst.subsystems_dict[name]
+            block = syst
+        try:
+            return self._block_index[id(block)]
+        except KeyError:
+            raise ValueError('{} is not a leaf block of {}'.format(
+                             repr(block), repr(self.system)))
+    
+    def inputs_of(self, b):
+        '''signals of the inputs of block `b`'''
+        return self.in_sig[self.in_ptr[b]:self.in_ptr[b+1]]
+    
+    def outputs_of(self, b):
+        '''signals of the outputs of block `b`'''
+        return self.out_sig[self.out_ptr[b]:self.out_ptr[b+1]]
+    
+    def gains_of(self, b):
+        '''gains of the inputs of block `b`'''
+        return self.in_gain[self.in_ptr[b]:self.in_ptr[b+1]]
+    
+    def num_of(self, b):
+        '''numerator coefficients of the TransferFunction block `b`'''
+        return self.num[self.num_ptr[b]:self.num_ptr[b+1]]
+    
+    def den_of(self, b):
+        '''denominator coefficients of the TransferFunction block `b`'''
+        return self.den[self.den_ptr[b]:self.den_ptr[b+1]]
+# end CompiledDiagram
+
+def compile(syst):
+    '''compile the block diagram `syst` into a flat execution plan
+    (see `CompiledDiagram`)
+    
+    The plan is cached on `syst` until the diagram is modified
+    (see `System._cached_analysis`): it should not be modified.
+    '''
+    return syst._cached_analysis('compile', lambda: CompiledDiagram(syst))
@@ -2,6 +2,10 @@
 # -*- coding: utf-8 -*-
 """ Elements for electrical diagrams
 Pierre Haessig — September 2013
+
+Electrical elements have ports of type 'elec' which are connected
+by wires of the same type (the nodes of the circuit).
+Circuits are solved by Modified Nodal Analysis (see `mna`).
 """
 
 from __future__ import division, print_function
@@ -10,14 +14,51 @@ from sysdiag import System, Port
 
 class Dipole(System):
     '''Common class for electrical dipoles (Resistor, Capacitor, Inductor)
+    
+    a dipole has two ports, 'p' and 'n'. Its voltage is v(p) - v(n)
+    and its current flows from p to n through the dipole.
     '''
-    def __init__(self, name='D'):
-        super(Dipole, self).__init__(name)
-        self.add_port(Port('p', 'elec'))
-        self.add_port(Port('n', 'elec'))
+    def __init__(self, name='D', parent=None):
+        super(Dipole, self).__init__(name, parent)
+        self.add_port(Port('p', 'elec'), created_by_system = True)
+        self.add_port(Port('n', 'elec'), created_by_system = True)
 
 
 class Resistor(Dipole):
-    def __init__(self, name='R', R=1e3):
-        super(Resistor, self).__init__(name)
+    '''Resistor of resistance `R` (Ohm)'''
+    def __init__(self, name='R', R=1e3, parent=None):
+        super(Resistor, self).__init__(name, parent)
         self.params['R'] = R
+
+class Capacitor(Dipole):
+    '''Capacitor of capacitance `C` (Farad)'''
+    def __init__(self, name='C', C=1e-6, parent=None):
+        super(Capacitor, self).__init__(name, parent)
+        self.params['C'] = C
+
+class Inductor(Dipole):
+    '''Inductor of inductance `L` (Henry)'''
+    def __init__(self, name='L', L=1e-3, parent=None):
+        super(Inductor, self).__init__(name, parent)
+        self.params['L'] = L
+
+class VoltageSource(Dipole):
+    '''Ideal voltage source: v(p) - v(n) = `V` (Volt)'''
+    def __init__(self, name='V', V=1., parent=None):
+        super(VoltageSource, self).__init__(name, parent)
+        self.params['V'] = V
+
+class CurrentSource(Dipole):
+    '''Ideal current source of current `I` (Ampere),
+    flowing from n to p through the source (i.e. injected into node p)
+    '''
+    def __init__(self, name='I', I=1e-3, parent=None):
+        super(CurrentSource, self).__init__(name, parent)
+        self.params['I'] = I
+
+
+class Ground(System):
+    '''Ground: the node connected to its port 'p' is the voltage reference'''
+    def __init__(self, name='GND', parent=None):
+        super(Ground, self).__init__(name, parent)
+        self.add_port(Port('p', 'elec'), created_by_system = True)
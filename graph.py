@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Graph analysis of block diagrams
+
+The directed signal graph of a diagram has one node per leaf block and
+one edge from the block driving each signal to each block reading it
+(see `compiler.compile`). Its strongly connected components, computed in
+linear time, give the feedback loops and the algebraic loops
+(loops of blocks with direct feedthrough).
+"""
+
+from __future__ import division, print_function
+import numpy as np
+
+import compiler
+
+class AlgebraicLoopError(ValueError):
+    '''Error raised for a diagram with algebraic loops
+    
+    attribute `loops` is the list of the loops, as lists of blocks
+    '''
+    def __init__(self, loops):
+        self.loops = loops
+        names = ['(' + ', '.join(block.name for block in loop) + ')'
+                 for loop in loops]
+        super(AlgebraicLoopError, self).__init__(
+            '{} algebraic loop(s) through the blocks {}'.format(
+            len(loops), ', '.join(names)))
+
+def _plan(syst):
+    '''compiled plan of `syst` (System or CompiledDiagram)'''
+    if isinstance(syst, compiler.CompiledDiagram):
+        return syst
+    return compiler.compile(syst)
+
+def _csr_graph(n_nodes, src, dst):
+    '''successors of the nodes of the graph with edges `src` -> `dst`,
+    in CSR layout (ptr, succ)'''
+    src = np.asarray(src, dtype=np.intp)
+    dst = np.asarray(dst, dtype=np.intp)
+    order = np.argsort(src, kind='stable')
+    ptr = np.zeros(n_nodes+1, dtype=np.intp)
+    ptr[1:] = np.cumsum(np.bincount(src, minlength=n_nodes))
+    return ptr, dst[order]
+
+def strongly_connected_components(n_nodes, src, dst):
+    '''strongly connected components of the directed graph of `n_nodes`
+    nodes with edges `src[k]` -> `dst[k]` (iterative Tarjan algorithm,
+    in O(nodes + edges)).
+    
+    Returns the list of the components (arrays of nodes),
+    in reverse topological order.
+    '''
+    ptr, succ = _csr_graph(n_nodes, src, dst)
+    ptr = ptr.tolist()
+    succ = succ.tolist()
+    index = [-1]*n_nodes
+    lowlink = [0]*n_nodes
+    on_stack = [False]*n_nodes
+    stack = []
+    components = []
+    counter = 0
+    for root in range(n_nodes):
+        if index[root] >= 0:
+            continue
+        # call stack of (node, position in its successors):
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        calls = [(root, ptr[root])]
+        while calls:
+            node, pos = calls[-1]
+            if pos < ptr[node+1]:
+                calls[-1] = (node, pos+1)
+                child = succ[pos]
+                if index[child] < 0:
+                    # "recursive call" on child:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    calls.append((child, ptr[child]))
+                elif on_stack[child] and index[child] < lowlink[node]:
+                    lowlink[node] = index[child]
+                continue
+            # all the successors of node are visited:
+            calls.pop()
+            if calls:
+                parent = calls[-1][0]
+                if lowlink[node] < lowlink[parent]:
+                    lowlink[parent] = lowlink[node]
+            if lowlink[node] == index[node]:
+                # node is the root of a component
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(np.array(component[::-1], dtype=np.intp))
+        # end while calls
+    return components
+
+def _loops(plan, src, dst):
+    '''components of the graph of the blocks of `plan` which are loops
+    (several blocks or a block connected to itself), as lists of blocks'''
+    self_loop = np.zeros(plan.n_blocks, dtype=bool)
+    self_loop[src[src == dst]] = True
+    loops = []
+    for component in strongly_connected_components(plan.n_blocks, src, dst):
+        if len(component) > 1 or self_loop[component[0]]:
+            loops.append([plan.blocks[b] for b in sorted(component)])
+    return loops[::-1]
+
+def feedback_loops(syst):
+    '''feedback loops of the block diagram `syst` (System or compiled plan),
+    as the list of the sets of leaf blocks strongly connected together
+    (each set being a list of blocks)
+    '''
+    plan = _plan(syst)
+    return _loops(plan, plan.edge_src, plan.edge_dst)
+
+def algebraic_loops(syst):
+    '''algebraic loops of the block diagram `syst` (System or compiled plan):
+    feedback loops where all the blocks have direct feedthrough (Summations,
+    TransferFunctions which are not strictly proper, generic blocks).
+    
+    Returns a list of loops (each loop being a list of blocks)
+    '''
+    plan = _plan(syst)
+    # a loop through a block without feedthrough is broken by this block:
+    keep = plan.feedthrough[plan.edge_dst] & plan.feedthrough[plan.edge_src]
+    return _loops(plan, plan.edge_src[keep], plan.edge_dst[keep])
+
+def check_algebraic_loops(syst):
+    '''raises an AlgebraicLoopError if the block diagram `syst`
+    has algebraic loops'''
+    loops = algebraic_loops(syst)
+    if loops:
+        raise AlgebraicLoopError(loops)
+
+def _levels(n_nodes, src, dst):
+    '''topological levels of the nodes of the graph with edges
+    `src[k]` -> `dst[k]` (Kahn algorithm, processed level by level):
+    the nodes without predecessors are at level 0, and each other node is
+    one level after its last predecessor.
+    
+    Returns the order of the nodes (by level, then by index)
+    and the level of each node (-1 for nodes in or after a cycle)
+    '''
+    dst = np.asarray(dst, dtype=np.intp)
+    ptr, succ = _csr_graph(n_nodes, src, dst)
+    indegree = np.bincount(dst, minlength=n_nodes)
+    level = np.full(n_nodes, -1, dtype=np.intp)
+    order = []
+    frontier = np.flatnonzero(indegree == 0)
+    k = 0
+    while len(frontier):
+        level[frontier] = k
+        order.append(frontier)
+        # successors of the frontier (concatenation of their CSR ranges):
+        starts, counts = ptr[frontier], ptr[frontier+1] - ptr[frontier]
+        offsets = np.cumsum(counts) - counts
+        targets = succ[np.repeat(starts - offsets, counts) + np.arange(counts.sum())]
+        np.subtract.at(indegree, targets, 1)
+        frontier = np.unique(targets[indegree[targets] == 0])
+        k += 1
+    order = np.concatenate(order) if order else np.zeros(0, dtype=np.intp)
+    return order, level
+
+def _evaluation_levels(plan):
+    '''evaluation levels of the blocks of the compiled `plan`, where
+    each feedthrough block comes after the blocks driving its inputs
+    (the loops are broken at the blocks without direct feedthrough,
+    like strictly proper TransferFunctions).
+    
+    Returns the order, the level of each block and a flag for algebraic loops.
+    The blocks of algebraic loops (level -1) are put at the end of the order.
+    '''
+    keep = plan.feedthrough[plan.edge_dst]
+    order, level = _levels(plan.n_blocks, plan.edge_src[keep], plan.edge_dst[keep])
+    algebraic_loop = len(order) < plan.n_blocks
+    if algebraic_loop:
+        order = np.concatenate([order, np.flatnonzero(level < 0)])
+    return order, level, algebraic_loop
+
+def topological_order(syst):
+    '''evaluation order of the leaf blocks of the diagram `syst`
+    (System or compiled plan), so that each block is evaluated after the
+    blocks driving its inputs. Feedback loops are broken at the blocks without
+    direct feedthrough (strictly proper TransferFunctions).
+    
+    Returns
+    -------
+    order: list of the blocks
+    levels: list of the levels, as lists of blocks which are independent
+            of each other (they can be evaluated in parallel) and only depend
+            on the blocks of the previous levels
+    
+    Raises an AlgebraicLoopError if the diagram has algebraic loops.
+    '''
+    plan = _plan(syst)
+    if plan.algebraic_loop:
+        check_algebraic_loops(plan)
+    order = [plan.blocks[b] for b in plan.order]
+    n_levels = plan.level.max()+1 if plan.n_blocks else 0
+    levels = [[] for k in range(n_levels)]
+    for b in plan.order:
+        levels[plan.level[b]].append(plan.blocks[b])
+    return order, levels
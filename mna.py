@@ -0,0 +1,569 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Modified Nodal Analysis (MNA) of electrical circuits
+
+The electrical elements of a diagram (see `elec`) are flattened
+into a network where each node is a set of connected 'elec' wires.
+The unknowns are the voltages of the nodes (except the Ground node,
+which is the reference) and the currents of the branches of the
+voltage sources and inductors. The circuit equations
+
+    G x + C dx/dt = B u
+
+with `u` the values of the sources are assembled in sparse matrices
+and solved by sparse LU factorization for DC, AC and transient analyses.
+"""
+
+from __future__ import division, print_function
+from collections import namedtuple, OrderedDict
+import hashlib
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+import elec
+
+# Kinds of elements:
+KIND_R = 0
+KIND_C = 1
+KIND_L = 2
+KIND_V = 3
+KIND_I = 4
+
+_ELEMENTS = [(elec.Resistor, KIND_R, 'R'),
+             (elec.Capacitor, KIND_C, 'C'),
+             (elec.Inductor, KIND_L, 'L'),
+             (elec.VoltageSource, KIND_V, 'V'),
+             (elec.CurrentSource, KIND_I, 'I')]
+
+def _flatten_circuit(syst):
+    '''flattens the hierarchy of `syst` into its electrical elements
+    
+    Returns
+    -------
+    elements: list of (element, kind, value, p_node, n_node) for each dipole,
+              with nodes numbered from 0 and -1 for the Ground node
+    nodes: list of the wires of each node (the first wire of the node
+           in depth-first order, None for the nodes of unconnected ports)
+    '''
+    # Wires, with a union-find forest to merge the wires of the same node
+    wires = []
+    wires_ind = {}
+    wires_parent = []
+    def register(w):
+        if w is None:
+            # unconnected port: a node of its own
+            wires.append(None)
+            wires_parent.append(len(wires_parent))
+            return len(wires)-1
+        ind = wires_ind.get(w)
+        if ind is None:
+            ind = wires_ind[w] = len(wires)
+            wires.append(w)
+            wires_parent.append(ind)
+        return ind
+    def find(ind):
+        root = ind
+        while wires_parent[root] != root:
+            root = wires_parent[root]
+        while wires_parent[ind] != root: # path compression
+            wires_parent[ind], ind = root, wires_parent[ind]
+        return root
+    
+    leaves = []
+    grounds = []
+    stack = [syst]
+    while stack:
+        s = stack.pop()
+        for subsys in s.subsystems:
+            if isinstance(subsys, elec.Ground):
+                grounds.append(register(subsys.ports_dict['p'].wire))
+            elif isinstance(subsys, elec.Dipole):
+                for cls, kind, param in _ELEMENTS:
+                    if isinstance(subsys, cls):
+                        break
+                else:
+                    raise ValueError('unsupported element {}'.format(repr(subsys)))
+                leaves.append((subsys, kind, subsys.params[param],
+                               register(subsys.ports_dict['p'].wire),
+                               register(subsys.ports_dict['n'].wire)))
+            elif subsys.is_empty():
+                raise ValueError('{} is not an electrical element'.format(repr(subsys)))
+            else:
+                # intermediate system: merge the outer and inner wires
+                for p in subsys.ports:
+                    if p.wire is not None and p.internal_wire is not None:
+                        outer, inner = register(p.wire), register(p.internal_wire)
+                        wires_parent[find(inner)] = find(outer)
+                stack.append(subsys)
+    # end while
+    if not grounds:
+        raise ValueError('the circuit {} has no Ground'.format(repr(syst)))
+    ground = find(grounds[0])
+    for g in grounds[1:]:
+        wires_parent[find(g)] = ground
+    
+    # Number the nodes connected to the elements, in order of appearance:
+    node_ind = {}
+    nodes = []
+    def to_node(ind):
+        root = find(ind)
+        if root == find(ground):
+            return -1
+        if root not in node_ind:
+            node_ind[root] = len(nodes)
+            nodes.append(wires[root])
+        return node_ind[root]
+    elements = [(element, kind, value, to_node(p), to_node(n))
+                for element, kind, value, p, n in leaves]
+    return elements, nodes
+# end _flatten_circuit
+
+def _two_terminal(a, b, value):
+    '''entries (row, col, data) of the stamp of a two-terminal `value`
+    between the nodes `a` and `b` (arrays, -1 for the Ground)'''
+    row = np.concatenate([a, b, a, b])
+    col = np.concatenate([a, b, b, a])
+    data = np.concatenate([value, value, -value, -value])
+    keep = (row >= 0) & (col >= 0)
+    return row[keep], col[keep], data[keep]
+
+def _branch(a, b, k):
+    '''entries (row, col, data) of the stamp of the branch currents `k`
+    flowing from the nodes `a` to `b`:
+    in the current laws of `a` and `b` and in the voltage equations `k`'''
+    ones = np.ones(len(k))
+    row = np.concatenate([a, b, k, k])
+    col = np.concatenate([k, k, a, b])
+    data = np.concatenate([ones, -ones, ones, -ones])
+    keep = (row >= 0) & (col >= 0)
+    return row[keep], col[keep], data[keep]
+
+def _coo(entries, size):
+    '''sparse CSC matrix of shape `size`x`size` summing the list of `entries`'''
+    row = np.concatenate([e[0] for e in entries])
+    col = np.concatenate([e[1] for e in entries])
+    data = np.concatenate([e[2] for e in entries])
+    return scipy.sparse.coo_matrix((data, (row, col)), shape=(size, size)).tocsc()
+
+OrderingCacheInfo = namedtuple('OrderingCacheInfo',
+                               ['hits', 'misses', 'factor_reuses',
+                                'maxsize', 'currsize'])
+
+class _OrderingCache(object):
+    '''Least Recently Used cache of the column orderings of the sparse LU
+    factorizations, keyed on the sparsity pattern of the matrices,
+    with hit and miss statistics'''
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.factor_reuses = 0 # reuses of a factorization kept on a Circuit
+    
+    def get(self, key):
+        '''cached column ordering for `key` (None if not cached)'''
+        perm = self._data.pop(key, None)
+        if perm is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data[key] = perm # most recently used
+        return perm
+    
+    def put(self, key, perm):
+        self._data[key] = perm
+        self.trim()
+    
+    def trim(self):
+        '''remove the least recently used orderings above `maxsize`'''
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+    
+    def info(self):
+        return OrderingCacheInfo(self.hits, self.misses, self.factor_reuses,
+                                 self.maxsize, len(self._data))
+    
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+        self.factor_reuses = 0
+
+# Column orderings of the circuit matrices, keyed on their sparsity pattern:
+_ordering_cache = _OrderingCache()
+
+def ordering_cache_info():
+    '''statistics of the cache of column orderings of the circuit matrices:
+    OrderingCacheInfo(hits, misses, factor_reuses, maxsize, currsize)
+    
+    * hits: factorizations reusing the cached ordering of their sparsity
+      pattern. This only saves the computation of the fill-reducing ordering:
+      SuperLU still does the full factorization, symbolic analysis included.
+    * misses: factorizations which computed the ordering of a new pattern
+    * factor_reuses: factorizations reused for the same matrix
+      (see `Circuit.factorize`)
+    * maxsize, currsize: size of the cache of orderings
+    '''
+    return _ordering_cache.info()
+
+def clear_ordering_cache():
+    '''empty the cache of column orderings and reset the statistics'''
+    _ordering_cache.clear()
+
+def set_ordering_cache_size(maxsize):
+    '''set the maximum number of cached column orderings
+    (0 disables the cache)'''
+    _ordering_cache.maxsize = maxsize
+    _ordering_cache.trim()
+
+class _LU(object):
+    '''sparse LU factorization of the matrix A, given the factorization
+    `lu` of A[:, perm] (`perm` is None for no permutation)'''
+    def __init__(self, lu, perm=None):
+        self.lu = lu
+        self.perm = perm
+    
+    def solve(self, b):
+        y = self.lu.solve(b)
+        if self.perm is None:
+            return y
+        x = np.empty_like(y)
+        x[self.perm] = y
+        return x
+
+class Circuit(object):
+    '''Modified Nodal Analysis equations of an electrical circuit
+    (see `compile_circuit`)
+    
+    The unknowns x are the voltages of the n_nodes nodes, followed by
+    the currents of the n_branches branches (voltage sources and inductors).
+    The equations are G x + C dx/dt = B u, with u the values of the sources.
+    
+    Attributes
+    ----------
+    elements: list of the dipoles
+    kind: kind of each element (KIND_R, KIND_C, KIND_L, KIND_V or KIND_I)
+    value: value of each element (R, C, L, V or I parameter)
+    p_node, n_node: nodes of the p and n ports of each element (-1 for Ground)
+    branch: index in x of the current of each element (-1 for no unknown)
+    sources: indices of the source elements (columns of B)
+    nodes: wire of each node (None for the nodes of unconnected ports)
+    G, C: sparse CSC matrices of shape (size, size), B: (size, n_sources)
+    
+    The matrices G + s C of the analyses (s = 0 for DC, s = jω for AC,
+    s = 2/h or 1/h for the transient steps of length h) share the same
+    sparsity pattern: their LU factorizations reuse a column ordering cached
+    on the pattern (see `ordering_cache_info`), and the last factorizations
+    are kept on the Circuit.
+    '''
+    _max_factors = 2
+    
+    def __init__(self, syst):
+        elements, nodes = _flatten_circuit(syst)
+        self.system = syst
+        self.elements = [e[0] for e in elements]
+        self._element_index = dict((id(e), k) for k, e in enumerate(self.elements))
+        self.nodes = nodes
+        n_el = len(elements)
+        self.kind = np.array([e[1] for e in elements], dtype=np.int8)
+        self.value = np.array([e[2] for e in elements], dtype=float)
+        self.p_node = np.array([e[3] for e in elements], dtype=np.intp)
+        self.n_node = np.array([e[4] for e in elements], dtype=np.intp)
+        
+        kind = self.kind
+        n_nodes = len(nodes)
+        has_branch = (kind == KIND_L) | (kind == KIND_V)
+        self.branch = np.full(n_el, -1, dtype=np.intp)
+        self.branch[has_branch] = n_nodes + np.arange(has_branch.sum())
+        self.n_branches = int(has_branch.sum())
+        size = self.size
+        
+        p, n, value = self.p_node, self.n_node, self.value
+        resistor = kind == KIND_R
+        capacitor = kind == KIND_C
+        inductor = kind == KIND_L
+        empty = (np.zeros(0, dtype=np.intp),)*2 + (np.zeros(0),)
+        self.G = _coo([empty,
+                       _two_terminal(p[resistor], n[resistor], 1/value[resistor]),
+                       _branch(p[has_branch], n[has_branch], self.branch[has_branch])],
+                      size)
+        # the voltage of an inductor is L di/dt:
+        self.C = _coo([empty,
+                       _two_terminal(p[capacitor], n[capacitor], value[capacitor]),
+                       (self.branch[inductor], self.branch[inductor], -value[inductor])],
+                      size)
+        
+        # Sources: the voltage of a voltage source in its branch equation,
+        # the current of a current source injected in its p node:
+        self.sources = np.flatnonzero((kind == KIND_V) | (kind == KIND_I))
+        src_kind = kind[self.sources]
+        src_col = np.arange(len(self.sources))
+        v_src, i_src = src_kind == KIND_V, src_kind == KIND_I
+        row = np.concatenate([self.branch[self.sources[v_src]],
+                              p[self.sources[i_src]], n[self.sources[i_src]]])
+        col = np.concatenate([src_col[v_src], src_col[i_src], src_col[i_src]])
+        data = np.concatenate([np.ones(v_src.sum()),
+                               np.ones(i_src.sum()), -np.ones(i_src.sum())])
+        keep = row >= 0
+        self.B = scipy.sparse.coo_matrix((data[keep], (row[keep], col[keep])),
+                                         shape=(size, len(self.sources))).tocsc()
+        
+        self._pattern = None
+        self._factors = OrderedDict()
+    # end __init__
+    
+    def _aligned_pattern(self):
+        '''sparsity pattern of G + C, in CSC layout (indptr, indices),
+        with the values of G and C aligned on this pattern, and a key
+        identifying the pattern (sha1 of its layout)'''
+        if self._pattern is None:
+            G, C = self.G.tocoo(), self.C.tocoo()
+            size = self.size
+            # union of the patterns (no cancellation with positive markers):
+            ones = np.ones(G.nnz + C.nnz)
+            P = scipy.sparse.coo_matrix((ones, (np.concatenate([G.row, C.row]),
+                                                np.concatenate([G.col, C.col]))),
+                                        shape=(size, size)).tocsc()
+            P.sort_indices()
+            # position of the entries of G and C in the pattern:
+            # (keys in int64: the products overflow the int32 indices of
+            #  scipy.sparse above about 46,340 unknowns)
+            def keys_of(col, row):
+                return col.astype(np.int64)*size + row.astype(np.int64)
+            col = np.repeat(np.arange(size), np.diff(P.indptr))
+            keys = keys_of(col, P.indices)
+            g_data = np.zeros(P.nnz)
+            g_data[np.searchsorted(keys, keys_of(G.col, G.row))] = G.data
+            c_data = np.zeros(P.nnz)
+            c_data[np.searchsorted(keys, keys_of(C.col, C.row))] = C.data
+            digest = hashlib.sha1(P.indptr.tobytes())
+            digest.update(P.indices.tobytes())
+            key = (size, P.nnz, digest.hexdigest())
+            self._pattern = (P.indptr, P.indices, g_data, c_data, key)
+        return self._pattern
+    
+    def matrix(self, s):
+        '''sparse CSC matrix G + s C (with all the entries of the pattern
+        of G + C)'''
+        indptr, indices, g_data, c_data, key = self._aligned_pattern()
+        data = g_data + s*c_data if s != 0 else g_data.copy()
+        return scipy.sparse.csc_matrix((data, indices, indptr),
+                                       shape=(self.size, self.size))
+    
+    def factorize(self, s):
+        '''sparse LU factorization of the matrix G + s C,
+        with a `solve(b)` method
+        
+        The fill-reducing column ordering is computed once for each sparsity
+        pattern (cached by the module, see `ordering_cache_info`): the next
+        factorizations of matrices with the same pattern reuse it. This only
+        saves the computation of the ordering: SciPy's SuperLU has no
+        numeric-only refactorization, so each new matrix is fully factorized.
+        The last factorizations are kept on the Circuit, for the same `s`.
+        '''
+        if s in self._factors:
+            _ordering_cache.factor_reuses += 1
+            lu = self._factors.pop(s)
+            self._factors[s] = lu # most recently used
+            return lu
+        A = self.matrix(s)
+        key = self._aligned_pattern()[-1]
+        perm = _ordering_cache.get(key)
+        try:
+            if perm is None:
+                lu = scipy.sparse.linalg.splu(A)
+                if _ordering_cache.maxsize > 0:
+                    # order of the columns (perm_c is the position of each column):
+                    _ordering_cache.put(key, np.argsort(lu.perm_c))
+                lu = _LU(lu)
+            else:
+                lu = _LU(scipy.sparse.linalg.splu(A[:, perm],
+                                                  permc_spec='NATURAL'), perm)
+        except RuntimeError as e:
+            raise ValueError('singular circuit equations ({}): '.format(e) +
+                             'check for floating nodes or loops of voltage sources')
+        self._factors[s] = lu
+        while len(self._factors) > self._max_factors:
+            self._factors.popitem(last=False)
+        return lu
+    
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+    
+    @property
+    def size(self):
+        '''number of unknowns'''
+        return self.n_nodes + self.n_branches
+    
+    def element_index(self, element):
+        '''index of the `element`, given either as a System or
+        as a path of names (e.g. 'filter/R1')'''
+        if isinstance(element, str):
+            syst = self.system
+            for name in element.split('/'):
+                syst = syst.subsystems_dict[name]
+            element = syst
+        try:
+            return self._element_index[id(element)]
+        except KeyError:
+            raise ValueError('{} is not an element of {}'.format(
+                             repr(element), repr(self.system)))
+    
+    def source_values(self, sources=None, n_points=None):
+        '''values u of the sources, of shape (n_sources,) or
+        (n_sources, n_points) if `n_points` is given.
+        
+        The values of the source parameters (V or I) can be replaced
+        with the dict `sources` {element: value}, where each value is either
+        a scalar or an array of `n_points` values.
+        '''
+        u = self.value[self.sources]
+        if n_points is not None:
+            u = np.repeat(u[:, None], n_points, axis=1)
+        if sources:
+            if any(np.iscomplexobj(value) for value in sources.values()):
+                u = u.astype(complex)
+            src_index = dict((k, j) for j, k in enumerate(self.sources))
+            for element, value in sources.items():
+                k = self.element_index(element)
+                if k not in src_index:
+                    raise ValueError('{} is not a source'.format(repr(self.elements[k])))
+                u[src_index[k]] = value
+        return u
+    
+    def voltage(self, x, element, port=None):
+        '''voltage of the `port` ('p' or 'n') of the `element` in the
+        solution `x`, or voltage v(p) - v(n) of the element if `port` is None'''
+        k = self.element_index(element)
+        def node_voltage(node):
+            return x[node] if node >= 0 else np.zeros_like(x[0])
+        if port == 'p':
+            return node_voltage(self.p_node[k])
+        elif port == 'n':
+            return node_voltage(self.n_node[k])
+        elif port is None:
+            return node_voltage(self.p_node[k]) - node_voltage(self.n_node[k])
+        raise ValueError("Unknown port '{}'!".format(port))
+    
+    def current(self, x, element, omega=None):
+        '''current of the `element` in the solution `x`, flowing from p to n
+        through the element (the pulsation `omega` is needed for
+        the capacitors in AC analysis)'''
+        k = self.element_index(element)
+        kind = self.kind[k]
+        if self.branch[k] >= 0:
+            return x[self.branch[k]]
+        elif kind == KIND_R:
+            return self.voltage(x, element)/self.value[k]
+        elif kind == KIND_C and omega is not None:
+            return 1j*omega*self.value[k]*self.voltage(x, element)
+        raise ValueError('the current of {} is not available'.format(
+                         repr(self.elements[k])))
+# end Circuit
+
+def compile_circuit(syst):
+    '''Modified Nodal Analysis equations of the circuit `syst`
+    (see `Circuit`)
+    
+    The equations are cached on `syst` until it is modified
+    (see `System._cached_analysis`).
+    '''
+    return syst._cached_analysis('mna', lambda: Circuit(syst))
+
+def _circuit(syst):
+    if isinstance(syst, Circuit):
+        return syst
+    return compile_circuit(syst)
+
+def dc_analysis(syst, sources=None):
+    '''DC operating point of the circuit `syst` (System or Circuit):
+    capacitors are open and inductors are short circuits.
+    
+    `sources` optionally replaces the values of the sources
+    (see `Circuit.source_values`).
+    
+    Returns `x`, `circuit`
+    with x the vector of the unknowns (see `Circuit`)
+    '''
+    circuit = _circuit(syst)
+    if circuit.size == 0:
+        return np.zeros(0), circuit
+    u = circuit.source_values(sources)
+    x = circuit.factorize(0.).solve(circuit.B.dot(u))
+    return x, circuit
+
+def ac_analysis(syst, omegas, sources=None):
+    '''AC (small signal) analysis of the circuit `syst` (System or Circuit)
+    at the pulsations `omegas` (rad/s)
+    
+    `sources` optionally replaces the values of the sources, used as
+    the complex amplitudes of the sinusoidal sources
+    (see `Circuit.source_values`).
+    
+    Returns `x`, `circuit`
+    with x of shape (size, len(omegas)), the complex amplitudes of
+    the unknowns (see `Circuit`)
+    '''
+    circuit = _circuit(syst)
+    omegas = np.atleast_1d(omegas)
+    b = circuit.B.dot(circuit.source_values(sources)).astype(complex)
+    x = np.zeros((circuit.size, len(omegas)), dtype=complex)
+    if circuit.size == 0:
+        return x, circuit
+    for k, omega in enumerate(omegas):
+        x[:, k] = circuit.factorize(1j*omega).solve(b)
+    return x, circuit
+
+def transient_analysis(syst, t, sources=None, x0=None, method='trap'):
+    '''transient analysis of the circuit `syst` (System or Circuit)
+    over the time instants `t`
+    
+    Parameters
+    ----------
+    sources: optional dict {element: values} replacing the values of the
+             sources, each value being a scalar or an array of len(t) values
+             (see `Circuit.source_values`)
+    x0: initial values of the unknowns. Defaults to the DC operating point
+        with the values of the sources at t[0].
+    method: integration method, 'trap' (trapezoidal, default) or
+            'be' (backward Euler). The matrix of the steps is factorized
+            once for each distinct time step (see `Circuit.factorize`).
+    
+    Returns `x`, `circuit`
+    with x of shape (size, len(t)) (see `Circuit`)
+    '''
+    if method not in ('trap', 'be'):
+        raise ValueError("Unknown method '{}'!".format(method))
+    circuit = _circuit(syst)
+    t = np.asarray(t, dtype=float)
+    n_t = len(t)
+    u = circuit.source_values(sources, n_t)
+    b = circuit.B.dot(u)
+    x = np.zeros((circuit.size, n_t))
+    if circuit.size == 0 or n_t == 0:
+        return x, circuit
+    if x0 is None:
+        x[:, 0] = circuit.factorize(0.).solve(b[:, 0])
+    else:
+        x[:, 0] = x0
+    
+    G, C = circuit.G, circuit.C
+    steps = np.diff(t)
+    uniform = len(steps) and np.allclose(steps, steps[0], rtol=1e-9, atol=0)
+    factors = {}
+    for k, h in enumerate(steps):
+        key = steps[0] if uniform else float('{:.12g}'.format(h))
+        if key not in factors:
+            if method == 'trap':
+                factors[key] = (circuit.factorize(2/key), (2/key)*C - G)
+            else:
+                factors[key] = (circuit.factorize(1/key), (1/key)*C)
+        lu, M = factors[key]
+        if method == 'trap':
+            rhs = M.dot(x[:, k]) + b[:, k] + b[:, k+1]
+        else:
+            rhs = M.dot(x[:, k]) + b[:, k+1]
+        x[:, k+1] = lu.solve(rhs)
+    return x, circuit
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Opt-in instrumentation of the core operations of sysdiag
+
+Counts the calls and measures the durations of the operations on the
+diagrams (add, connect, serialize and solve) and the reduction time
+of each subsystem by `transfer_func.transfer_syst`:
+
+    with profiling.profile() as report:
+        transfer_func.transfer_syst(root)
+    print(report)
+
+The functions are wrapped only while a profile is active: there is
+no overhead when the instrumentation is disabled.
+"""
+
+from __future__ import division, print_function
+import time
+import functools
+import importlib
+
+# Instrumented operations: (module, class name or None, function, category)
+OPERATIONS = [
+    ('sysdiag', 'System', 'add_port', 'add'),
+    ('sysdiag', 'System', 'add_subsystem', 'add'),
+    ('sysdiag', 'System', 'add_wire', 'add'),
+    ('sysdiag', 'System', 'del_port', 'add'),
+    ('sysdiag', 'Wire', 'connect_port', 'connect'),
+    ('sysdiag', 'Wire', 'connect_ports', 'connect'),
+    ('sysdiag', None, 'connect_systems', 'connect'),
+    ('sysdiag', 'System', 'json_dump', 'serialize'),
+    ('sysdiag', 'System', 'binary_dump', 'serialize'),
+    ('sysdiag', None, 'json_load', 'serialize'),
+    ('sysdiag', None, 'binary_load', 'serialize'),
+    ('compiler', None, 'compile', 'solve'),
+    ('transfer_func', None, 'transfer_syst', 'solve'),
+    ('transfer_func', None, 'frequency_response', 'solve'),
+    ('simulation', None, 'simulate', 'solve'),
+    ('simulation', None, 'simulate_batch', 'solve'),
+    ('mna', None, 'dc_analysis', 'solve'),
+    ('mna', None, 'ac_analysis', 'solve'),
+    ('mna', None, 'transient_analysis', 'solve'),
+]
+
+# Reductions of the subsystems (timed per subsystem):
+_SUBSYSTEM_OPERATION = ('transfer_func', None, '_reduce_subsystem')
+
+
+class Report(object):
+    '''Report of a profile (see `profile`)
+    
+    Attributes
+    ----------
+    counts: dict {operation: number of calls}
+    times: dict {operation: total duration in s}
+    categories: dict {category: (number of calls, total duration in s)}
+                for the categories 'add', 'connect', 'serialize' and 'solve'
+    subsystems: dict {path of the subsystem: (number of reductions,
+                total duration in s)} of the reductions of the subsystems
+                by `transfer_syst`
+    duration: total duration of the profile in s
+    
+    The durations are inclusive (they include the nested operations), except
+    for the recursive calls of an operation which are timed only once.
+    '''
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+        self.categories = {}
+        self.subsystems = {}
+        self.duration = 0.
+        self._category = {}
+    
+    def _record(self, operation, category, duration):
+        '''records a call of `operation` (duration None for a nested call)'''
+        self.counts[operation] = self.counts.get(operation, 0) + 1
+        self._category[operation] = category
+        n, t = self.categories.get(category, (0, 0.))
+        if duration is None:
+            self.categories[category] = (n+1, t)
+            return
+        self.times[operation] = self.times.get(operation, 0.) + duration
+        self.categories[category] = (n+1, t + duration)
+    
+    def _record_subsystem(self, path, duration):
+        n, t = self.subsystems.get(path, (0, 0.))
+        self.subsystems[path] = (n+1, t + duration)
+    
+    def as_dict(self):
+        '''structured report, as a JSON-serializable dict'''
+        return {'duration': self.duration,
+                'operations': dict((op, {'category': self._category[op],
+                                         'count': n,
+                                         'time': self.times.get(op, 0.)})
+                                   for op, n in self.counts.items()),
+                'categories': dict((cat, {'count': n, 'time': t})
+                                   for cat, (n, t) in self.categories.items()),
+                'subsystems': dict((path, {'count': n, 'time': t})
+                                   for path, (n, t) in self.subsystems.items())}
+    
+    def __str__(self):
+        lines = ['Profile of {:.6f} s'.format(self.duration)]
+        lines.append('{:40s} {:>10s} {:>12s}'.format('operation', 'calls', 'time (s)'))
+        for op in sorted(self.counts, key=lambda op: -self.times.get(op, 0.)):
+            lines.append('{:40s} {:10d} {:12.6f}'.format(
+                         op, self.counts[op], self.times.get(op, 0.)))
+        for cat in sorted(self.categories):
+            n, t = self.categories[cat]
+            lines.append('{:40s} {:10d} {:12.6f}'.format('[' + cat + ']', n, t))
+        if self.subsystems:
+            lines.append('{:40s} {:>10s} {:>12s}'.format('subsystem', 'reductions', 'time (s)'))
+            for path in sorted(self.subsystems, key=lambda p: -self.subsystems[p][1]):
+                n, t = self.subsystems[path]
+                lines.append('{:40s} {:10d} {:12.6f}'.format(path, n, t))
+        return '\n'.join(lines)
+# end Report
+
+
+# Active reports, and the original functions replaced by the wrappers:
+_reports = []
+_originals = []
+
+def _system_path(syst):
+    '''path of names of `syst` from its root (e.g. 'root/plant/int')'''
+    names = []
+    while syst is not None:
+        names.append(syst.name)
+        syst = syst.parent
+    return '/'.join(names[::-1])
+
+def _wrap(func, operation, category):
+    '''wrapper of `func` recording its calls in the active reports'''
+    active = [0] # depth of the recursive calls
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if active[0]:
+            for report in _reports:
+                report._record(operation, category, None)
+            return func(*args, **kwargs)
+        active[0] += 1
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - t0
+            active[0] -= 1
+            for report in _reports:
+                report._record(operation, category, duration)
+    return wrapper
+
+def _wrap_subsystem(func):
+    '''wrapper of the reduction of a subsystem, timed per subsystem'''
+    @functools.wraps(func)
+    def wrapper(subsys, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(subsys, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - t0
+            path = _system_path(subsys)
+            for report in _reports:
+                report._record_subsystem(path, duration)
+    return wrapper
+
+def _install():
+    '''replaces the instrumented functions with their wrappers
+    (the modules which cannot be imported are skipped)'''
+    for mod_name, cls_name, func_name, category in OPERATIONS:
+        func = _original(mod_name, cls_name, func_name)
+        if func is not None:
+            operation = '.'.join(n for n in (mod_name, cls_name, func_name) if n)
+            _replace(mod_name, cls_name, func_name, _wrap(func, operation, category))
+    func = _original(*_SUBSYSTEM_OPERATION)
+    if func is not None:
+        _replace(*(_SUBSYSTEM_OPERATION + (_wrap_subsystem(func),)))
+
+def _owner(mod_name, cls_name):
+    '''module or class holding an instrumented function (None if the
+    module cannot be imported)'''
+    try:
+        module = importlib.import_module(mod_name)
+    except ImportError:
+        return None
+    return module if cls_name is None else getattr(module, cls_name)
+
+def _original(mod_name, cls_name, func_name):
+    '''original function to be wrapped (None if not available)'''
+    owner = _owner(mod_name, cls_name)
+    if owner is None:
+        return None
+    return owner.__dict__[func_name]
+
+def _replace(mod_name, cls_name, func_name, wrapper):
+    owner = _owner(mod_name, cls_name)
+    _originals.append((owner, func_name, owner.__dict__[func_name]))
+    setattr(owner, func_name, wrapper)
+
+def _uninstall():
+    '''restores the original functions'''
+    while _originals:
+        owner, func_name, func = _originals.pop()
+        setattr(owner, func_name, func)
+
+
+class profile(object):
+    '''context manager profiling the core operations of sysdiag
+    (see the module docstring). Returns a `Report`, filled during the
+    profile. Profiles can be nested.
+    '''
+    def __enter__(self):
+        self.report = Report()
+        if not _reports:
+            _install()
+        _reports.append(self.report)
+        self._t0 = time.perf_counter()
+        return self.report
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report.duration = time.perf_counter() - self._t0
+        _reports.remove(self.report)
+        if not _reports:
+            _uninstall()
+        return False
+
+def enabled():
+    '''True if a profile is active'''
+    return bool(_reports)
@@ -0,0 +1,483 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Time-domain simulation of block diagrams
+
+The diagram is flattened and compiled into a single state-space model
+(each TransferFunction block being realized from its `num` and `den`
+parameters), which is then integrated over NumPy arrays.
+"""
+
+from __future__ import division, print_function
+import copy
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.linalg
+
+import compiler
+
+def _n_coefs(coefs):
+    '''number of coefficients of a batch of polynomials `coefs` (2D array),
+    without the highest powers which are zero in the whole batch'''
+    nonzero = np.flatnonzero(coefs.any(axis=0))
+    return nonzero[-1]+1 if len(nonzero) else 0
+
+def _zoh_recursion(Ad, Bu, x0):
+    '''states of the discrete recursion x[k+1] = Ad x[k] + Bu[k], x[0] = x0
+    for a batch of models: `Ad` of shape (n_b, n_x, n_x), `Bu` of shape
+    (n_b, n_x, n_t) and `x0` of shape (n_b, n_x).
+    
+    The time steps are grouped in blocks of L ~ sqrt(n_t) steps:
+    
+    1. zero-state responses z[m, j] to Bu inside all the blocks m at once,
+    2. states s[m] at the start of the blocks: s[m+1] = Ad^L s[m] + z[m, L],
+    3. states x[mL + j] = Ad^j s[m] + z[m, j]
+    
+    with loops of about sqrt(n_t) iterations, each one vectorized over the
+    blocks. The states are only multiplied by Ad (or Ad^L), as in the plain
+    recursion, which makes the computation as stable.
+    
+    Returns x, of shape (n_b, n_x, n_t)
+    '''
+    n_b, n_x, n_t = Bu.shape
+    L = max(int(np.ceil(np.sqrt(n_t))), 1)
+    n_blk = -(-(n_t - 1)//L) if n_t > 1 else 0
+    # inputs by blocks, padded with zeros:
+    Bu_blk = np.zeros((n_b, n_x, n_blk*L))
+    Bu_blk[:, :, :n_t-1] = Bu[:, :, :n_t-1]
+    Bu_blk = Bu_blk.reshape(n_b, n_x, n_blk, L)
+    
+    # 1. zero-state responses inside the blocks
+    Z = np.empty((n_b, n_x, n_blk, L))
+    z = np.zeros((n_b, n_x, n_blk))
+    for j in range(L):
+        Z[:, :, :, j] = z
+        z = np.matmul(Ad, z) + Bu_blk[:, :, :, j]
+    # 2. states at the start of the blocks
+    AdL = np.linalg.matrix_power(Ad, L)
+    S = np.empty((n_b, n_x, n_blk))
+    s = x0[:, :, None]
+    for m in range(n_blk):
+        S[:, :, m] = s[:, :, 0]
+        s = np.matmul(AdL, s) + z[:, :, m, None]
+    # 3. states inside the blocks
+    X = np.empty((n_b, n_x, n_blk, L))
+    for j in range(L):
+        X[:, :, :, j] = S + Z[:, :, :, j]
+        S = np.matmul(Ad, S)
+    x = np.concatenate([X.reshape(n_b, n_x, n_blk*L), s], axis=2)
+    return x[:, :, :n_t]
+
+def _tf_realization_batch(num, den):
+    '''controllable canonical state-space realizations of a batch of transfer
+    functions, with `num` and `den` of shapes (n_batch, n_coefs).
+    
+    Returns A, B, C, D of shapes (n_batch, n, n), (n_batch, n, 1),
+    (n_batch, 1, n) and (n_batch, 1, 1)
+    '''
+    num = np.atleast_2d(np.asarray(num, dtype=float))
+    den = np.atleast_2d(np.asarray(den, dtype=float))
+    num = num[:, :max(_n_coefs(num), 1)]
+    den = den[:, :_n_coefs(den)]
+    if den.shape[1] == 0:
+        raise ValueError('denominator of the transfer function is zero!')
+    if not den[:, -1].all():
+        raise ValueError('the degree of the denominator should be the same ' +\
+                         'for all the transfer functions of the batch')
+    n_batch = max(len(num), len(den))
+    n = den.shape[1] - 1
+    if num.shape[1] - 1 > n:
+        raise ValueError('transfer function {}/{} is not proper!'.format(
+                         num.tolist(), den.tolist()))
+    a = den/den[:, -1:]
+    b = np.zeros((n_batch, n+1))
+    b[:, :num.shape[1]] = num/den[:, -1:]
+    
+    A = np.zeros((n_batch, n, n))
+    A[:, :-1, 1:] = np.eye(n-1)
+    if n > 0:
+        A[:, -1, :] = -a[:, :-1]
+    B = np.zeros((n_batch, n, 1))
+    if n > 0:
+        B[:, -1, 0] = 1
+    D = b[:, n].reshape(n_batch, 1, 1)
+    C = (b[:, :n] - a[:, :n]*b[:, n:]).reshape(n_batch, 1, n)
+    return A, B, C, D
+
+def tf_realization(num, den):
+    '''controllable canonical state-space realization (A, B, C, D)
+    of the transfer function num(s)/den(s), with the coefficients
+    of `num` and `den` in increasing powers of s.
+    
+    The transfer function should be proper (deg num <= deg den)
+    '''
+    A, B, C, D = _tf_realization_batch([num], [den])
+    return A[0], B[0], C[0], D[0]
+
+def _batch_params(plan, params):
+    '''parameters of the blocks of the compiled diagram `plan`
+    which vary in a batch
+    
+    Returns a dict {block index: {name: 2D array}} and the batch size
+    '''
+    batch = {}
+    n_batch = None
+    for block, block_params in params.items():
+        b = plan.block_index(block)
+        if plan.kind[b] != compiler.KIND_TF:
+            raise ValueError('Only the parameters of TransferFunction blocks ' +\
+                             'can vary ({} given)'.format(repr(plan.blocks[b])))
+        values = {}
+        for name, value in block_params.items():
+            if name not in ('num', 'den'):
+                raise ValueError("Unknown parameter '{}' of {}".format(
+                                 name, repr(plan.blocks[b])))
+            value = np.asarray(value, dtype=float)
+            if value.ndim == 1:
+                value = value.reshape(-1, 1)
+            if n_batch is None:
+                n_batch = len(value)
+            elif len(value) != n_batch:
+                raise ValueError('the parameters should have the same batch size')
+            values[name] = value
+        batch[b] = values
+    return batch, n_batch
+
+class StateSpaceModel(object):
+    '''State-space model of a block diagram
+    
+        dx/dt = A x + B u
+        y = C x + D u
+    
+    with u the inputs (input ports of `syst` and Source blocks)
+    and y the outputs (output ports and Sink blocks), named in
+    `input_names` and `output_names` (see `blocks.flatten`).
+    `syst` may also be a diagram already compiled by `compiler.compile`.
+    
+    The algebraic equations of the signals (Summation blocks and
+    direct feedthrough of TransferFunction blocks) are solved once,
+    when building the model.
+    
+    `params` (optional) describes a batch of variants of the diagram, as a
+    dict {block: {param_name: values}} where `block` is a TransferFunction of
+    `syst` (or its path of names, like 'plant/integrator') and `values`
+    holds the 'num' or 'den' parameter of each variant along its first axis.
+    The matrices A, B, C, D are then stacked along a first batch axis
+    of length `batch_size`.
+    '''
+    def __init__(self, syst, params=None):
+        if isinstance(syst, compiler.CompiledDiagram):
+            plan = syst
+        else:
+            plan = compiler.compile(syst)
+        self.input_names = plan.input_names
+        self.output_names = plan.output_names
+        batch, self.batch_size = _batch_params(plan, params or {})
+        nb = 1 if self.batch_size is None else self.batch_size
+        n_sig = plan.n_signals
+        n_in = len(plan.input_sig)
+        
+        # Realization of each block:
+        realizations = []
+        n_x = 0
+        for b in range(plan.n_blocks):
+            if plan.kind[b] == compiler.KIND_TF:
+                values = batch.get(b, {})
+                num = values.get('num', [plan.num_of(b)])
+                den = values.get('den', [plan.den_of(b)])
+                Ak, Bk, Ck, Dk = _tf_realization_batch(num, den)
+            elif plan.kind[b] == compiler.KIND_SUM:
+                n_k = len(plan.inputs_of(b))
+                Ak, Bk, Ck = np.zeros((1, 0, 0)), np.zeros((1, 0, n_k)), np.zeros((1, 1, 0))
+                Dk = plan.gains_of(b).reshape(1, 1, n_k)
+            else:
+                raise ValueError('Block {} has no LTI model!'.format(repr(plan.blocks[b])))
+            Ak, Bk, Ck, Dk = [np.broadcast_to(X, (nb,) + X.shape[1:])
+                              for X in (Ak, Bk, Ck, Dk)]
+            realizations.append((n_x, Ak, Bk, Ck, Dk))
+            n_x += Ak.shape[1]
+        self.n_states = n_x
+        
+        not_driven = np.flatnonzero(plan.n_drivers != 1)
+        if len(not_driven):
+            sig = not_driven[0]
+            raise ValueError('Signal of {} has {} sources (one expected)'.format(
+                             repr(plan.signals[sig]), plan.n_drivers[sig]))
+        
+        # Assembly of the equations, as lists of (row, col, values) entries
+        # with the values of the whole batch:
+        # signals: w = M w + N x + E u
+        # states: dx/dt = Ab x + Bb w
+        M, N, E, Ab, Bb = [], [], [], [], []
+        for k, sig in enumerate(plan.input_sig):
+            if sig >= 0:
+                E.append((sig, k, np.ones(nb)))
+        for b, (x0, Ak, Bk, Ck, Dk) in enumerate(realizations):
+            in_sig = plan.inputs_of(b)
+            for i, j in zip(*np.nonzero(Ak.any(axis=0))):
+                Ab.append((x0+i, x0+j, Ak[:, i, j]))
+            for j, sig in enumerate(in_sig):
+                if sig < 0:
+                    continue
+                for i in np.flatnonzero(Bk[:, :, j].any(axis=0)):
+                    Bb.append((x0+i, sig, Bk[:, i, j]))
+            out = plan.outputs_of(b)[0]
+            if out < 0:
+                continue
+            for j in np.flatnonzero(Ck[:, 0].any(axis=0)):
+                N.append((out, x0+j, Ck[:, 0, j]))
+            for j, sig in enumerate(in_sig):
+                if sig >= 0 and Dk[:, 0, j].any():
+                    M.append((out, sig, Dk[:, 0, j]))
+        # end for each block
+        
+        if self.batch_size is None:
+            A, B, G, H = self._solve_signals_sparse(M, N, E, Ab, Bb, n_sig, n_x, n_in)
+        else:
+            A, B, G, H = self._solve_signals_batch(M, N, E, Ab, Bb, n_sig, n_x, n_in, nb)
+        
+        # Outputs:
+        out_index = plan.output_sig
+        connected = out_index >= 0
+        C = np.zeros(G.shape[:-2] + (len(out_index), n_x))
+        D = np.zeros(G.shape[:-2] + (len(out_index), n_in))
+        C[..., connected, :] = G[..., out_index[connected], :]
+        D[..., connected, :] = H[..., out_index[connected], :]
+        self.A, self.B, self.C, self.D = A, B, C, D
+    # end __init__
+    
+    @staticmethod
+    def _solve_signals_sparse(M, N, E, Ab, Bb, n_sig, n_x, n_in):
+        '''solve the algebraic equations of the signals, w = G x + H u,
+        with sparse matrices (single model). Returns A, B, G, H
+        '''
+        def sparse(entries, shape):
+            rows = [e[0] for e in entries]
+            cols = [e[1] for e in entries]
+            values = [e[2][0] for e in entries]
+            return scipy.sparse.coo_matrix((values, (rows, cols)), shape=shape)
+        M = sparse(M, (n_sig, n_sig))
+        N = sparse(N, (n_sig, n_x))
+        E = sparse(E, (n_sig, n_in))
+        Ab = sparse(Ab, (n_x, n_x))
+        Bb = sparse(Bb, (n_x, n_sig))
+        
+        if n_sig > 0:
+            I_M = (scipy.sparse.identity(n_sig) - M).tocsc()
+            try:
+                lu = scipy.sparse.linalg.splu(I_M)
+            except RuntimeError:
+                raise ValueError('the diagram has a singular algebraic loop!')
+            GH = lu.solve(scipy.sparse.hstack([N, E]).toarray())
+        else:
+            GH = np.zeros((0, n_x + n_in))
+        G, H = GH[:, :n_x], GH[:, n_x:]
+        return Ab.toarray() + Bb.dot(G), Bb.dot(H), G, H
+    
+    @staticmethod
+    def _solve_signals_batch(M, N, E, Ab, Bb, n_sig, n_x, n_in, nb):
+        '''solve the algebraic equations of the signals, w = G x + H u,
+        for a batch of `nb` models with stacked dense matrices.
+        Returns A, B, G, H
+        '''
+        def stacked(entries, shape):
+            mat = np.zeros((nb,) + shape)
+            if entries:
+                rows = np.array([e[0] for e in entries], dtype=np.intp)
+                cols = np.array([e[1] for e in entries], dtype=np.intp)
+                values = np.array([e[2] for e in entries])
+                np.add.at(mat, (slice(None), rows, cols), values.T)
+            return mat
+        M = stacked(M, (n_sig, n_sig))
+        NE = np.concatenate([stacked(N, (n_sig, n_x)),
+                             stacked(E, (n_sig, n_in))], axis=2)
+        Ab = stacked(Ab, (n_x, n_x))
+        Bb = stacked(Bb, (n_x, n_sig))
+        try:
+            GH = np.linalg.solve(np.eye(n_sig) - M, NE)
+        except np.linalg.LinAlgError:
+            raise ValueError('the diagram has a singular algebraic loop!')
+        G, H = GH[..., :n_x], GH[..., n_x:]
+        return Ab + np.matmul(Bb, G), np.matmul(Bb, H), G, H
+    
+    def _batch_slice(self, start, stop):
+        '''model of the variants `start` to `stop` of a batch'''
+        model = copy.copy(self)
+        model.A, model.B, model.C, model.D = [X[start:stop] for X in
+                                              (self.A, self.B, self.C, self.D)]
+        model.batch_size = len(model.A)
+        return model
+    
+    def _inputs_array(self, u, n_t):
+        '''input signals as an array of shape (n_in, n_t)
+        or (batch_size, n_in, n_t)'''
+        n_in = len(self.input_names)
+        if u is None:
+            return np.zeros((n_in, n_t))
+        u = np.asarray(u, dtype=float)
+        if u.ndim == 1:
+            u = u.reshape(1, -1)
+        if u.shape[-2:] != (n_in, n_t) or \
+           (u.ndim == 3 and u.shape[0] != self.batch_size):
+            raise ValueError('inputs should be of shape {}'.format((n_in, n_t)))
+        return u
+    
+    def simulate(self, t, u=None, x0=None, method='zoh', **options):
+        '''simulate the model over the time instants `t` (array)
+        
+        Parameters
+        ----------
+        `t`: array of time instants (uniformly spaced for method 'zoh')
+        `u`: input signals, array of shape (n_in, len(t)),
+             or (len(t),) for a single input. Defaults to zero inputs.
+             For a batch model, inputs may also differ for each variant,
+             with shape (batch_size, n_in, len(t)).
+        `x0`: initial state (defaults to zero), of shape (n_states,)
+              or (batch_size, n_states)
+        `method`: either
+          * 'zoh' (default): exact discretization with inputs held constant
+            between time instants (fixed step)
+          * a method of `scipy.integrate.solve_ivp` ('RK45', 'LSODA', 'BDF'...)
+            for an adaptive step integration, with inputs interpolated
+            linearly. `options` are passed to `solve_ivp` (e.g. rtol, atol).
+        
+        Returns
+        -------
+        y: outputs, array of shape (n_out, len(t))
+        x: states, array of shape (n_states, len(t))
+        (with an additional first batch axis for a batch model)
+        '''
+        t = np.asarray(t, dtype=float)
+        n_t = len(t)
+        u = self._inputs_array(u, n_t)
+        n_x = self.n_states
+        x0 = np.zeros(n_x) if x0 is None else np.asarray(x0, dtype=float)
+        
+        # Work with a batch axis in all cases:
+        single = self.batch_size is None
+        A, B, C, D = [X[None] if single else X
+                      for X in (self.A, self.B, self.C, self.D)]
+        u_b = np.broadcast_to(u, (len(A),) + u.shape[-2:])
+        x0 = np.broadcast_to(x0, (len(A), n_x))
+        
+        if method == 'zoh':
+            x = self._simulate_zoh(A, B, t, u_b, x0)
+        else:
+            x = self._simulate_ivp(A, B, t, u_b, x0, method, **options)
+        y = np.matmul(C, x) + np.matmul(D, u_b)
+        if single:
+            return y[0], x[0]
+        return y, x
+    
+    @staticmethod
+    def _simulate_zoh(A, B, t, u, x0):
+        n_b, n_x, n_t = len(A), A.shape[1], len(t)
+        n_in = u.shape[1]
+        if n_x == 0 or n_t == 0:
+            return np.zeros((n_b, n_x, n_t))
+        dt = t[1] - t[0] if n_t > 1 else 1.
+        if n_t > 2 and not np.allclose(np.diff(t), dt):
+            raise ValueError("method 'zoh' requires uniformly spaced time instants")
+        # Discretization: expm([[A, B], [0, 0]] dt)
+        F = np.zeros((n_b, n_x + n_in, n_x + n_in))
+        F[:, :n_x, :n_x] = A
+        F[:, :n_x, n_x:] = B
+        Fd = scipy.linalg.expm(F*dt)
+        Ad, Bd = Fd[:, :n_x, :n_x], Fd[:, :n_x, n_x:]
+        # Recursion over time, vectorized over the batch:
+        return _zoh_recursion(Ad, np.matmul(Bd, u), x0)
+    
+    @staticmethod
+    def _simulate_ivp(A, B, t, u, x0, method, **options):
+        from scipy.integrate import solve_ivp
+        n_b, n_x, n_t = len(A), A.shape[1], len(t)
+        
+        def u_at(ti):
+            '''inputs interpolated linearly at time ti'''
+            if n_t < 2:
+                return u[:, :, 0]
+            k = np.clip(np.searchsorted(t, ti) - 1, 0, n_t-2)
+            alpha = np.clip((ti - t[k])/(t[k+1] - t[k]), 0, 1)
+            return (1-alpha)*u[:, :, k] + alpha*u[:, :, k+1]
+        
+        def derivative(ti, x):
+            # the states of the batch are stacked in a single vector
+            x = x.reshape(n_b, n_x, 1)
+            dx = np.matmul(A, x) + np.matmul(B, u_at(ti)[:, :, None])
+            return dx.ravel()
+        
+        if method in ('Radau', 'BDF', 'LSODA'):
+            jac = scipy.sparse.block_diag(list(A), format='csc')
+            if method == 'LSODA':
+                jac = jac.toarray()
+            options.setdefault('jac', lambda ti, x: jac)
+        sol = solve_ivp(derivative, (t[0], t[-1]), x0.ravel(), method=method,
+                        t_eval=t, **options)
+        if not sol.success:
+            raise RuntimeError('integration failed: ' + sol.message)
+        return sol.y.reshape(n_b, n_x, n_t)
+# end StateSpaceModel
+
+def simulate(syst, t, u=None, x0=None, method='zoh', **options):
+    '''simulate the block diagram `syst` over the time instants `t`
+    
+    see `StateSpaceModel.simulate` for the parameters.
+    
+    Returns `y`, `output_names`, `input_names`
+    with y of shape (n_out, len(t))
+    '''
+    if isinstance(syst, StateSpaceModel):
+        model = syst
+    else:
+        model = StateSpaceModel(syst)
+    y, x = model.simulate(t, u, x0, method, **options)
+    return y, model.output_names, model.input_names
+
+def _simulate_chunk(args):
+    '''simulation of a chunk of a batch (in a worker process)'''
+    model, t, u, x0, method, options = args
+    y, x = model.simulate(t, u, x0, method, **options)
+    return y
+
+def simulate_batch(syst, t, params, u=None, x0=None, method='zoh',
+                   processes=None, **options):
+    '''simulate a batch of variants of the block diagram `syst`,
+    with different parameters, over the time instants `t`.
+    
+    `params` describes the parameters of each variant, as a dict
+    {block: {param_name: values}} (see `StateSpaceModel`), e.g. to sweep
+    the gain of a controller:
+    
+        {'controller': {'num': [[1, K] for K in gains]}}
+    
+    All the variants are simulated at once with stacked state-space matrices.
+    
+    if `processes` is not None, the batch is split into chunks simulated
+    by a pool of `processes` worker processes.
+    
+    see `StateSpaceModel.simulate` for the other parameters.
+    
+    Returns `y`, `output_names`, `input_names`
+    with y of shape (batch_size, n_out, len(t))
+    '''
+    model = StateSpaceModel(syst, params)
+    if processes is None or model.batch_size is None:
+        y, x = model.simulate(t, u, x0, method, **options)
+        return y, model.output_names, model.input_names
+    
+    import multiprocessing
+    bounds = np.linspace(0, model.batch_size, processes+1).astype(int)
+    chunks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop > start:
+            chunks.append((model._batch_slice(start, stop), t,
+                           u if u is None or np.ndim(u) < 3 else np.asarray(u)[start:stop],
+                           x0 if x0 is None or np.ndim(x0) < 2 else np.asarray(x0)[start:stop],
+                           method, options))
+    pool = multiprocessing.Pool(processes)
+    try:
+        y = np.concatenate(pool.map(_simulate_chunk, chunks))
+    finally:
+        pool.close()
+        pool.join()
+    return y, model.output_names, model.input_names
@@ -5,11 +5,20 @@ Pierre Haessig — September 2013
 """
 
 from __future__ import division, print_function
+from fractions import Fraction
+import json
+import numbers
+import sys
 
-def _create_name(name_list, base):
+def _create_name(name_list, base, counters=None):
     '''Returns a name (str) built on `base` that doesn't exist in `name_list`.
     
     Useful for automatic creation of subsystems or wires
+    
+    `counters` is an optional dict which remembers, for each base name,
+    the last suffix found to be free, so that the counting restarts from it
+    on the next call. Used with a set or a dict as `name_list`, repeated
+    name creations are then amortized O(1).
     '''
     base = str(base).strip()
     if base == '':
@@ -19,56 +28,420 @@ def _create_name(name_list, base):
         return base
     
     # Else: build another name by counting
-    i = 0
+    i = 0 if counters is None else counters.get(base, 0)
     name = base + str(i)
     while name in name_list:
         i += 1
         name = base + str(i)
+    if counters is not None:
+        counters[base] = i
     return name
 
+class _TrackedParams(dict):
+    '''dict of the parameters of a System, which notifies the System
+    of its modifications (see `System._changed`).
+    
+    in-place modifications of the values (e.g. of a list) are not tracked.
+    '''
+    _plain = None
+    
+    def __init__(self, owner, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._owner = owner
+    
+    def _has_plain_values(self):
+        '''True if the values are plain (see `_plain_items`),
+        cached until the next modification'''
+        if self._plain is None:
+            self._plain = _plain_items(self.values())
+        return self._plain
+    
+    def _notify(self):
+        self._plain = None
+        # (no owner yet while unpickling)
+        owner = getattr(self, '_owner', None)
+        if owner is not None:
+            owner._changed()
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._notify()
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._notify()
+    
+    def clear(self):
+        dict.clear(self)
+        self._notify()
+    
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._notify()
+        return value
+    
+    def popitem(self):
+        item = dict.popitem(self)
+        self._notify()
+        return item
+    
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        self._notify()
+        return value
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._notify()
+
+def _is_array(value):
+    '''True if `value` is an array (numpy-like: with dtype, shape and tobytes)'''
+    return hasattr(value, 'dtype') and hasattr(value, 'shape') and \
+           hasattr(value, 'tobytes') and not isinstance(value, numbers.Number)
+
+def _is_sympy(value):
+    '''True if `value` is a sympy object (without importing sympy)'''
+    sympy = sys.modules.get('sympy')
+    return sympy is not None and isinstance(value, sympy.Basic)
+
+def _number_key(value):
+    '''exact value of the number `value`: a Fraction, ('inf', sign)
+    or a ('complex', real, imag) tuple. None for NaN and unknown numbers.
+    
+    Python and numpy numbers are equal if they have the same exact value,
+    which, unlike `==`, is transitive (e.g. `np.float32(0.1) == 0.1`
+    but their exact values differ).
+    '''
+    if isinstance(value, numbers.Complex) and not isinstance(value, numbers.Real):
+        real, imag = _number_key(value.real), _number_key(value.imag)
+        if real is None or imag is None:
+            return None
+        return real if imag == 0 else ('complex', real, imag)
+    if isinstance(value, numbers.Integral):
+        return Fraction(int(value))
+    if isinstance(value, numbers.Rational):
+        return Fraction(value.numerator, value.denominator)
+    try:
+        return Fraction(*value.as_integer_ratio())
+    except OverflowError:
+        return ('inf', 1 if value > 0 else -1)
+    except (ValueError, AttributeError):
+        return None
+
+# types which values are compared by `==` in `_values_equal`:
+_PLAIN_TYPES = frozenset([str, int, float, bool, type(None)])
+
+def _plain_items(values):
+    '''True if the `values` are of the plain types (see `_PLAIN_TYPES`)
+    or lists or tuples of values of the plain types'''
+    for value in values:
+        value_type = type(value)
+        if value_type not in _PLAIN_TYPES and not \
+           ((value_type is list or value_type is tuple) and
+            _PLAIN_TYPES.issuperset(map(type, value))):
+            return False
+    return True
+
+def _has_plain_values(params):
+    '''`_plain_items` of the values of the dict `params`, cached for
+    the params of the Systems (see `_TrackedParams`)'''
+    if isinstance(params, _TrackedParams):
+        return params._has_plain_values()
+    return _plain_items(params.values())
+
+def _values_equal(a, b):
+    '''equality of two values of params, as `a == b` except that:
+    
+    * arrays are equal if they have the same dtype, shape and elements,
+    * the containers (dict, list and tuple) are compared recursively,
+    * python and numpy numbers are equal if their exact values are equal
+      (see `_number_key`),
+    * sympy objects are only equal to sympy objects (e.g. `Integer(1)`
+      is not equal to 1, while `Integer(1) == 1`, but `Integer(1) != 1.0`).
+    '''
+    if a is b:
+        return True
+    # (fast paths for the common built-in types, for which `==` is exact)
+    value_type = type(a)
+    if value_type is type(b):
+        if value_type in _PLAIN_TYPES:
+            return a == b
+        if (value_type is list or value_type is tuple) and \
+           _plain_items(a) and _plain_items(b):
+            return a == b
+    if isinstance(a, dict) and isinstance(b, dict) and \
+       _has_plain_values(a) and _has_plain_values(b):
+        return a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return len(a) == len(b) and \
+               all(k in b and _values_equal(v, b[k]) for k, v in a.items())
+    if _is_array(a) or _is_array(b):
+        return _is_array(a) and _is_array(b) and \
+               a.dtype == b.dtype and a.shape == b.shape and bool((a == b).all())
+    for seq_type in (list, tuple):
+        if isinstance(a, seq_type) or isinstance(b, seq_type):
+            return isinstance(a, seq_type) and isinstance(b, seq_type) and \
+                   len(a) == len(b) and \
+                   all(_values_equal(va, vb) for va, vb in zip(a, b))
+    if _is_sympy(a) or _is_sympy(b):
+        return _is_sympy(a) and _is_sympy(b) and a == b
+    if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+        key_a, key_b = _number_key(a), _number_key(b)
+        if key_a is not None and key_b is not None:
+            return key_a == key_b
+    return a == b
+
+def _canonical(value, inexact):
+    '''JSON-serializable description of `value` for `System.structural_hash`,
+    identical for values which are equal (see `_values_equal`):
+    
+    * numbers are described by their exact value (see `_number_key`):
+      an int if it is an integer (e.g. 1, 1.0 or True), else ['num', 'p/q'],
+    * sympy objects are described by their `srepr`, which includes
+      the assumptions of the symbols and the exact value of the numbers,
+    * arrays are described by their dtype, shape and a hash of their data,
+    * lists and tuples are tagged with their type, since they are different,
+    * dicts are described by the list of their (key, value) pairs, sorted
+      by key description, so that keys of any type are kept apart
+      (e.g. 1 and '1', which JSON would merge).
+    
+    Within these types, equal descriptions imply equal values.
+    The other values (other objects, NaN, arrays of objects or with NaN)
+    get a coarse description and are appended to the list `inexact`:
+    their equality must be checked by `_values_equal`.
+    '''
+    import hashlib
+    # (fast paths for the common built-in types)
+    value_type = type(value)
+    if value_type is str or value is None:
+        return value
+    if value_type is int or value_type is bool:
+        return int(value)
+    if value_type is float and value - value == 0:
+        return int(value) if value.is_integer() else ['num', str(Fraction(value))]
+    if _is_array(value):
+        if value.dtype.hasobject or bool((value != value).any()):
+            inexact.append(value)
+            return ['array', value.dtype.str, list(value.shape)]
+        # (+0 turns -0. into 0., which compare equal)
+        data = (value + 0).tobytes() if value.dtype.kind in 'fc' else value.tobytes()
+        return ['array', value.dtype.str, list(value.shape),
+                hashlib.sha1(data).hexdigest()]
+    if isinstance(value, dict):
+        items = [(_canonical(k, inexact), _canonical(v, inexact))
+                 for k, v in value.items()]
+        items.sort(key=lambda item: repr(item[0]))
+        return ['dict', [list(item) for item in items]]
+    if isinstance(value, (list, tuple)):
+        seq_type = 'list' if isinstance(value, list) else 'tuple'
+        return [seq_type, [_canonical(v, inexact) for v in value]]
+    if value is None or isinstance(value, str):
+        return value
+    if _is_sympy(value):
+        return ['sympy', sys.modules['sympy'].srepr(value)]
+    if isinstance(value, numbers.Number):
+        key = _number_key(value)
+        if key is not None:
+            return _describe_number(key)
+    inexact.append(value)
+    return ['object']
+
+def _describe_number(key):
+    '''JSON-serializable description of the exact value `key`
+    of a number (see `_number_key`)'''
+    if isinstance(key, tuple):
+        return [key[0]] + [_describe_number(k) for k in key[1:]]
+    if key.denominator == 1:
+        return int(key)
+    return ['num', str(key)]
+
 class System(object):
     '''Diagram description of a system
     
     a System is either an interconnecion of subsystems
     or an atomic element (a leaf of the tree)
+    
+    private attribute `_lazy_content` holds the json objects of the
+    subsystems and wires of a System loaded lazily (see `json_load`),
+    until they are materialized on first access.
+    
+    private attributes `_structural_hash` and `_analysis_cache` cache the
+    result of `structural_hash` and of analyses (see `_cached_analysis`),
+    and `_hash_exact` tells whether equal hashes imply equal Systems.
+    They are reset by `_changed`, which is called by all the modifications
+    of the System (params, ports, subsystems, wires, their names and types
+    and their connections).
     '''
+    _lazy_content = None
+    _lazy_loading = False
+    _structural_hash = None
+    _hash_exact = False
+    _analysis_cache = None
+    
     def __init__(self, name='root', parent=None):
-        self.name = name
+        self._name = name
         # Parent system, if any (None for top-level):
         self.parent = None
         # Children systems, if any (None for leaf-level):
-        self.subsystems = []
-        self.wires = []
+        self._subsystems = []
+        self._wires = []
         self.ports = []
         self.params = {}
+        # Name -> object indexes, kept in sync with the lists above
+        # by the add_* and del_* methods:
+        self._subsystems_index = {}
+        self._wires_index = {}
+        self._ports_index = {}
+        # Next suffix to try for automatic names, for each category and base:
+        self._name_counters = {'subsystem': {}, 'wire': {}}
         
         # If a parent system is provided, request its addition as a subsystem
         if parent is not None:
             parent.add_subsystem(self)
     #end __init__()
 
+    @property
+    def name(self):
+        '''name of the System'''
+        return self._name
+    
+    @name.setter
+    def name(self, name):
+        parent = self.parent
+        if parent is not None and name != self._name:
+            # move the entry of the name index of the parent:
+            index = parent._subsystems_index
+            if name in index:
+                raise ValueError("system name '{}' already exists in {:s}!".format(
+                                  name, repr(parent))
+                                 )
+            del index[self._name]
+            index[name] = self
+        self._name = name
+        # the analyses of the System use its name (e.g. in the symbols of
+        # transfer_syst) and the structure of the parent includes the names
+        # of its subsystems:
+        self._changed()
+
+    @property
+    def params(self):
+        '''dict of parameters
+        
+        (its modifications are tracked, see `_changed`, but not the in-place
+        modifications of its values: a parameter should be changed by
+        assigning it a new value, e.g. `params['num'] = [1, 2]`
+        rather than `params['num'][0] = 1`)
+        '''
+        return self._params
+    
+    @params.setter
+    def params(self, params):
+        self._params = _TrackedParams(self, params)
+        self._changed()
+
+    def _changed(self):
+        '''to be called on each modification of the System: invalidates
+        the cached structural hash and analyses of the System
+        and of its ancestors (the path up to the root, in O(depth)).
+        
+        The materialization of the content of a System loaded lazily
+        is not a modification (see `_load_lazy_content`).
+        '''
+        if self._lazy_loading:
+            return
+        syst = self
+        while syst is not None:
+            syst._structural_hash = None
+            syst._analysis_cache = None
+            syst = syst.parent
+
+    def _cached_analysis(self, key, compute):
+        '''result of the analysis `compute()` of the System, cached under
+        `key` until the System or one of its descendants is modified
+        (see `_changed`). The result should not be modified.
+        '''
+        if self._analysis_cache is None:
+            self._analysis_cache = {}
+        try:
+            return self._analysis_cache[key]
+        except KeyError:
+            result = self._analysis_cache[key] = compute()
+            return result
+
+    @property
+    def subsystems(self):
+        '''list of subsystems'''
+        if self._lazy_content is not None:
+            self._load_lazy_content()
+        return self._subsystems
+
+    @property
+    def wires(self):
+        '''list of wires'''
+        if self._lazy_content is not None:
+            self._load_lazy_content()
+        return self._wires
+
+    def _load_lazy_content(self):
+        '''materializes the subsystems and wires of a System loaded lazily.
+        
+        Subsystems are themselves loaded lazily, unless there remains
+        some depth to load immediately.
+        
+        This is not a modification: no cache is invalidated (see `_changed`).
+        '''
+        subsystems, wires, depth = self._lazy_content
+        self._lazy_content = None
+        self._lazy_loading = True
+        try:
+            for s_object in subsystems:
+                self.add_subsystem(_lazy_system_from_json(s_object, depth-1))
+            _add_wires_from_json(self, wires)
+        finally:
+            self._lazy_loading = False
+
     def is_empty(self):
         '''True if the System contains no subsystems and no wires'''
-        return (not self.subsystems) and (not self.wires)
+        if self._lazy_content is not None:
+            subsystems, wires, depth = self._lazy_content
+            return (not subsystems) and (not wires)
+        return (not self._subsystems) and (not self._wires)
 
     @property
     def ports_dict(self):
-        '''dict of ports, which keys are the names of the ports'''
-        return {p.name:p for p in self.ports}
+        '''dict of ports, which keys are the names of the ports
+        
+        (this is the internal index of the System: it should not be modified)
+        '''
+        return self._ports_index
 
     @property
     def subsystems_dict(self):
-        '''dict of subsystems, which keys are the names of the systems'''
-        return {s.name:s for s in self.subsystems}
+        '''dict of subsystems, which keys are the names of the systems
+        
+        (this is the internal index of the System: it should not be modified)
+        '''
+        if self._lazy_content is not None:
+            self._load_lazy_content()
+        return self._subsystems_index
+
+    @property
+    def wires_dict(self):
+        '''dict of wires, which keys are the names of the wires
+        
+        (this is the internal index of the System: it should not be modified)
+        '''
+        if self._lazy_content is not None:
+            self._load_lazy_content()
+        return self._wires_index
 
     def add_port(self, port, created_by_system = False):
         '''add a Port to the System'''
-        if port in self.ports:
-            raise ValueError('port already added!')
         # extract the port's name
         name = port.name
-        port_names = [p.name for p in self.ports]
-        if name in port_names:
+        if name in self._ports_index:
+            if self._ports_index[name] is port:
+                raise ValueError('port already added!')
             raise ValueError("port name '{}' already exists in {:s}!".format(
                               name, repr(self))
                              )
@@ -76,6 +449,8 @@ class System(object):
         port.system = self
         port._created_by_system = bool(created_by_system)
         self.ports.append(port)
+        self._ports_index[name] = port
+        self._changed()
 
     def del_port(self, port):
         '''delete a Port of the System (and disconnect any connected wire)
@@ -85,44 +460,57 @@ class System(object):
             raise NotImplementedError('Cannot yet delete a connected Port')
         # Remove the ports list:
         self.ports.remove(port)
+        del self._ports_index[port.name]
+        self._changed()
 
     def add_subsystem(self, subsys):
+        if self._lazy_content is not None:
+            self._load_lazy_content()
         # 1) Check name uniqueness
         name = subsys.name
-        subsys_names = [s.name for s in self.subsystems]
-        if name in subsys_names:
+        if name in self._subsystems_index:
             raise ValueError("system name '{}' already exists in {:s}!".format(
                               name, repr(self))
                              )
         # 2) Add parent relationship and add to the system list
         subsys.parent = self
-        self.subsystems.append(subsys)
+        self._subsystems.append(subsys)
+        self._subsystems_index[name] = subsys
+        self._changed()
     
     def add_wire(self, wire):
+        if self._lazy_content is not None:
+            self._load_lazy_content()
         # 1) Check name uniqueness
         name = wire.name
-        wire_names = [w.name for w in self.wires]
-        if name in wire_names:
+        if name in self._wires_index:
             raise ValueError("wire name '{}' already exists in {:s}!".format(
                               name, repr(self))
                              )
         # Add parent relationship and add to the ports dict:
         wire.parent = self
-        self.wires.append(wire)
+        self._wires.append(wire)
+        self._wires_index[name] = wire
+        self._changed()
     
     def create_name(self, category, base):
         '''Returns a name (str) built on `base` that doesn't exist in
         within the names of `category`.
+        
+        Suffixes already tried for `base` are remembered, so that creating
+        many names on the same base (e.g. 'W0', 'W1', ...) is amortized O(1).
+        Names added manually are still taken into account.
         '''
+        if self._lazy_content is not None:
+            self._load_lazy_content()
         if category == 'subsystem':
-            components = self.subsystems
+            name_list = self._subsystems_index
         elif category == 'wire':
-            components = self.wires
+            name_list = self._wires_index
         else:
             raise ValueError("Unknown category '{}'!".format(str(category)))
         
-        name_list = [c.name for c in components]
-        return _create_name(name_list, base)
+        return _create_name(name_list, base, self._name_counters[category])
 
     def __repr__(self):
         cls_name = self.__class__.__name__
@@ -142,38 +530,121 @@ class System(object):
         return s
 
     def __eq__(self, other):
-        '''Systems compare equal if their class, `name` and `params` are equal.
-        and also their lists of ports and wires are *similar*
-        (see `_is_similar` methods of Port and Wire)
-        and finally their subsystems recursively compare equal.
+        '''Systems compare equal if their class, `name`, params, ports,
+        wires and, recursively, subsystems are equal (see `full_compare`).
+        
+        If the structural hashes of both Systems are cached (see
+        `structural_hash`), they are compared in O(1): different hashes
+        imply different Systems, and so do equal hashes if they are exact
+        (i.e. unless some params are NaN or objects which are not numbers,
+        strings, containers, arrays or sympy objects).
+        Otherwise, the Systems are compared by `full_compare`.
+        In-place modifications of mutable params (e.g. `params['num'][0] = 2`)
+        are not tracked by the hash: compare such Systems with `full_compare`.
         
         parent systems are not compared (would generate infinite recursion).
         '''
         if not isinstance(other, System):
             return NotImplemented
+        if self is other:
+            return True
+        if not (self.__class__  == other.__class__  and
+                self.name       == other.name):
+            return False
+        hashes = (self._structural_hash, other._structural_hash)
+        if None not in hashes:
+            if hashes[0] != hashes[1]:
+                return False
+            if self._hash_exact and other._hash_exact:
+                return True
+        return self.full_compare(other)
+    # end __eq__()
+    
+    def __ne__(self,other):
+        return not (self==other)
+
+    def full_compare(self, other):
+        '''compare two Systems by walking through the whole trees,
+        without using the structural hashes (see `__eq__`).
+        
+        Systems are equal if their class, `name`, `params` and class-specific
+        attributes are equal (see `_values_equal`), their lists of ports
+        and wires are *similar* (see `_is_similar` methods of Port and Wire)
+        and finally their subsystems recursively compare equal.
+        
+        This is the fallback of `==`, without the cached hashes.
+        '''
         # Basic similarity
         basic_sim = self.__class__  == other.__class__  and \
                     self.name       == other.name       and \
-                    self.params     == other.params
+                    _values_equal(self.params, other.params)
         if not basic_sim:
             return False
+        # Class-specific attributes (none for the classes which use
+        # the serialization of System):
+        if type(self)._to_json is not System._to_json and \
+           not _values_equal(self._json_extra(), other._json_extra()):
+            return False
         # Port similarity: (sensitive to the order)
-        ports_sim = all(p1._is_similar(p2) for (p1,p2)
-                        in zip(self.ports, other.ports))
-        if not ports_sim:
+        if [p._similarity_key() for p in self.ports] != \
+           [p._similarity_key() for p in other.ports]:
             return False
         # Wires similarity
-        wires_sim = all(w1._is_similar(w2) for (w1,w2)
-                        in zip(self.wires, other.wires))
-        if not wires_sim:
+        wires, other_wires = self.wires, other.wires
+        if len(wires) != len(other_wires) or \
+           [w._similarity_key() for w in wires] != \
+           [w._similarity_key() for w in other_wires]:
             return False
-        print('equality at level {} is true'.format(self.name))
         # Since everything matches, compare subsystems:
-        return self.subsystems == other.subsystems
-    # end __eq__()
-    
-    def __ne__(self,other):
-        return not (self==other)
+        subsystems, other_subsystems = self.subsystems, other.subsystems
+        return len(subsystems) == len(other_subsystems) and \
+               all(s1.full_compare(s2) for (s1,s2)
+                   in zip(subsystems, other_subsystems))
+
+    def structural_hash(self):
+        '''hash (hex string) of the structure of the System:
+        class, params, class-specific attributes, ports, wires with their
+        connections and, recursively, the names and structure of the subsystems
+        (Merkle tree).
+        
+        The name of the System itself is not included, so that
+        replicated subsystems share the same hash.
+        
+        Values which compare equal have the same description in the hash
+        (see `_canonical`), so that different hashes imply different Systems.
+        If all the values of the subtree have an exact description,
+        equal hashes imply equal Systems (`_hash_exact` is True).
+        
+        The hash is cached until the System or one of its descendants
+        is modified (see `_changed`).
+        '''
+        if self._structural_hash is not None:
+            return self._structural_hash
+        import hashlib
+        inexact = []
+        def class_name(obj):
+            return obj.__module__ +'.'+ obj.__class__.__name__
+        ports = [(class_name(p), p.name, _canonical(p.type, inexact))
+                 for p in self.ports]
+        subsystems = [(subsys.name, subsys.structural_hash())
+                      for subsys in self.subsystems]
+        def connection(p):
+            '''(system name, port name), without the name of the System itself'''
+            return ('' if p.system is self else p.system.name, p.name)
+        # (the connections are in the order of the ports, as in `Wire._is_similar`)
+        wires = [(class_name(w), w.name, _canonical(w.type, inexact),
+                  [connection(p) for p in w.ports])
+                 for w in self.wires]
+        structure = [class_name(self), _canonical(self.params, inexact),
+                     _canonical(self._json_extra(), inexact),
+                     ports, subsystems, wires]
+        # (the structure only holds lists, tuples, strings and ints,
+        #  which `repr` describes unambiguously)
+        data = repr(structure)
+        self._hash_exact = not inexact and \
+                           all(subsys._hash_exact for subsys in self.subsystems)
+        self._structural_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return self._structural_hash
 
     def _to_json(self):
         '''convert the System instance to a JSON-serializable object
@@ -196,13 +667,30 @@ class System(object):
                 'params':self.params
                }
     # end _to_json
+    
+    def _json_extra(self):
+        '''class-specific attributes of the System: the items of its json
+        object (see `_to_json` of the subclasses) which are not those
+        of all Systems'''
+        if type(self)._to_json is System._to_json:
+            return {}
+        return {k:v for k,v in self._to_json().items()
+                if k not in _SYSTEM_JSON_KEYS}
+    
+    def _load_json_extra(self, json_object):
+        '''restore the class-specific attributes of the System
+        from its json object (see `_to_json` of the subclasses)'''
+        pass
+    
     def json_dump(self, output=None, indent=2, sort_keys=True):
         '''dump (e.g. save) the System structure in json format
         
         if `output` is None: return a json string
-        if `output` is a writable file: write in this file
+        if `output` is a writable file: write in this file, as the text
+        is generated (`json.dump` converts each System, Wire and Port with
+        `to_json` only when it is reached, so that the memory use does not
+        grow with the size of the diagram)
         '''
-        import json
         if output is None:
             return json.dumps(self, default=to_json, indent=indent, sort_keys=sort_keys)
         else:
@@ -210,6 +698,20 @@ class System(object):
             return
         # end json_dump
 
+    def binary_dump(self, output=None):
+        '''dump (e.g. save) the System structure in a compact binary format
+        (see `binary_load` to load it back)
+        
+        if `output` is None: return a bytes string
+        if `output` is a file opened in binary mode: write in this file
+        '''
+        data = _binary_encode(self)
+        if output is None:
+            return data
+        else:
+            output.write(data)
+            return
+
         
 class Port(object):
     '''Port enables the connection of a System to a Wire
@@ -227,13 +729,45 @@ class Port(object):
     direction = 'none'
     
     def __init__(self, name, ptype):
+        self.system = None
         self.name = name
         self.type = ptype
-        self.system = None
         self.wire = None
         self.internal_wire = None
         self._created_by_system = False
     
+    @property
+    def name(self):
+        '''name of the Port'''
+        return self._name
+    
+    @name.setter
+    def name(self, name):
+        system = self.system
+        if system is not None and name != self._name:
+            # move the entry of the port index of the system:
+            index = system._ports_index
+            if name in index:
+                raise ValueError("port name '{}' already exists in {:s}!".format(
+                                  name, repr(system))
+                                 )
+            del index[self._name]
+            index[name] = self
+        self._name = name
+        if system is not None:
+            system._changed()
+    
+    @property
+    def type(self):
+        '''type of the Port'''
+        return self._type
+    
+    @type.setter
+    def type(self, ptype):
+        self._type = ptype
+        if self.system is not None:
+            self.system._changed()
+    
     def __repr__(self):
         cls_name = self.__class__.__name__
         s = '{:s}({:s}, {:s})'.format(cls_name, repr(self.name), repr(self.type))
@@ -250,9 +784,11 @@ class Port(object):
         '''
         if not isinstance(other, Port):
             return NotImplemented
-        return self.__class__ == other.__class__ and \
-               self.type      == other.type      and \
-               self.name      == other.name
+        return self._similarity_key() == other._similarity_key()
+    
+    def _similarity_key(self):
+        '''(class, `type`, `name`): Ports are *similar* if their keys are equal'''
+        return (self.__class__, self.type, self.name)
     
     def _to_json(self):
         '''convert the Port instance to a JSON-serializable object
@@ -286,8 +822,8 @@ class Wire(object):
     '''Wire enables the interconnection of several Systems
     through their Ports'''
     def __init__(self, name, wtype, parent=None):
-        self.name = name
         self.parent = None
+        self.name = name
         self.type = wtype
         self.ports = []
         
@@ -295,6 +831,38 @@ class Wire(object):
         if parent is not None:
             parent.add_wire(self)
     
+    @property
+    def name(self):
+        '''name of the Wire'''
+        return self._name
+    
+    @name.setter
+    def name(self, name):
+        parent = self.parent
+        if parent is not None and name != self._name:
+            # move the entry of the wire index of the parent:
+            index = parent._wires_index
+            if name in index:
+                raise ValueError("wire name '{}' already exists in {:s}!".format(
+                                  name, repr(parent))
+                                 )
+            del index[self._name]
+            index[name] = self
+        self._name = name
+        if parent is not None:
+            parent._changed()
+    
+    @property
+    def type(self):
+        '''type of the Wire'''
+        return self._type
+    
+    @type.setter
+    def type(self, wtype):
+        self._type = wtype
+        if self.parent is not None:
+            self.parent._changed()
+    
     def is_connect_allowed(self, port, port_level, raise_error=False):
         '''Check that a connection between Wire ̀ self` and a Port `port` is allowed.
         
@@ -357,7 +925,8 @@ class Wire(object):
     
     def connect_port(self, port, port_level='sibling'):
         '''Connect the Wire to a Port `port`'''
-        if port in self.ports:
+        # (checked on the links of the port, rather than by a scan of self.ports)
+        if port.wire is self or port.internal_wire is self:
             return # Port is aleady connected
         # Type checking:
         self.is_connect_allowed(port, port_level, raise_error=True)
@@ -370,6 +939,56 @@ class Wire(object):
             port.internal_wire = self
         # Book keeping of ports:
         self.ports.append(port)
+        if self.parent is not None:
+            self.parent._changed()
+    
+    def _check_connections(self, port_levels):
+        '''Check that the connections of Wire `self` to a list of
+        (port, port_level) pairs are allowed, raising an error otherwise.
+        
+        (used by `connect_ports` to validate all the connections at once)
+        
+        The ports are checked with `is_connect_allowed`. When it is not
+        overridden by a subclass of Wire or SignalWire, the specific checks of
+        SignalWire are done once for the whole list by `_check_connections`,
+        and only the generic checks of Wire are run for each port.
+        '''
+        is_connect_allowed = type(self).is_connect_allowed
+        if is_connect_allowed is Wire.is_connect_allowed or \
+           is_connect_allowed is SignalWire.is_connect_allowed:
+            is_connect_allowed = Wire.is_connect_allowed
+        for port, port_level in port_levels:
+            is_connect_allowed(self, port, port_level, raise_error=True)
+    
+    def connect_ports(self, port_levels):
+        '''Connect the Wire to several Ports at once
+        
+        `port_levels` is a list of (port, port_level) pairs, with `port_level`
+        either 'sibling' or 'parent' (see `connect_port`).
+        
+        The connections are validated once for the whole list
+        rather than port by port.
+        '''
+        connected = set(id(p) for p in self.ports)
+        new_port_levels = []
+        for port, port_level in port_levels:
+            if port_level not in ('sibling', 'parent'):
+                raise ValueError("Unknown port level '{}'!".format(port_level))
+            if id(port) in connected:
+                continue # Port is aleady connected
+            connected.add(id(port))
+            new_port_levels.append((port, port_level))
+        
+        self._check_connections(new_port_levels)
+        
+        for port, port_level in new_port_levels:
+            if port_level == 'sibling':
+                port.wire = self
+            else:
+                port.internal_wire = self
+            self.ports.append(port)
+        if self.parent is not None:
+            self.parent._changed()
     
     @property
     def ports_by_name(self):
@@ -419,10 +1038,16 @@ class Wire(object):
         '''
         if not isinstance(other, Wire):
             return NotImplemented
-        return self.__class__ == other.__class__ and \
-               self.type      == other.type      and \
-               self.name      == other.name      and \
-               self.ports_by_name == other.ports_by_name
+        return self._similarity_key() == other._similarity_key()
+    
+    def _similarity_key(self):
+        '''(class, `type`, `name`, connections): Wires are *similar* if their
+        keys are equal. The connections are the (is parent, system name,
+        port name) of the ports, as `ports_by_name` without checking the levels.
+        '''
+        parent = self.parent
+        return (self.__class__, self.type, self.name,
+                [(p.system is parent, p.system.name, p.name) for p in self.ports])
 
     def _to_json(self):
         '''convert the Wire instance to a JSON-serializable object
@@ -479,15 +1104,13 @@ class SignalWire(Wire):
             '''
             if level=='detect':
                 wire = self
-                if wire.parent == port.system:
+                if wire.parent is port.system:
                     level = 'parent'
-                elif wire.parent == port.system.parent:
+                elif wire.parent is port.system.parent:
                     level = 'sibling'
                 else:
                     raise ValueError('Port is neither sibling nor parent')
-            is_out = (level=='sibling' and port.direction == 'out') or \
-                     (level=='parent'  and port.direction == 'in')
-            return is_out
+            return _is_signal_source(port, level)
         
         # Now we have an I/O Port for sure:    
         if is_output(port, port_level):
@@ -502,6 +1125,33 @@ class SignalWire(Wire):
 
         # Now the I/O aspect is fine. Launch some further checks:
         return super(SignalWire, self).is_connect_allowed(port, port_level, raise_error)
+    
+    def _check_connections(self, port_levels):
+        '''Check that the connections of SignalWire `self` to a list of
+        (port, port_level) pairs are allowed, raising an error otherwise.
+        
+        The uniqueness of the output port is checked once for the whole list.
+        '''
+        n_outputs = 0
+        for p in self.ports:
+            level = 'parent' if p.system is self.parent else 'sibling'
+            n_outputs += _is_signal_source(p, level)
+        for port, port_level in port_levels:
+            if port.direction not in ['in', 'out']:
+                raise TypeError('Only Input/Output Port can be connected!')
+            n_outputs += _is_signal_source(port, port_level)
+        if n_outputs > 1:
+            raise ValueError('Only one output port can be connected!')
+        # Now the I/O aspect is fine. Launch some further checks:
+        super(SignalWire, self)._check_connections(port_levels)
+
+def _is_signal_source(port, level):
+    '''True if `port` is a source for a SignalWire, that is either:
+    * a sibling system'port with direction == 'out' or
+    * a parent system'port with direction == 'in'
+    '''
+    return (level=='sibling' and port.direction == 'out') or \
+           (level=='parent'  and port.direction == 'in')
 
 
 def connect_systems(source, dest, s_pname, d_pname, wire_cls=Wire):
@@ -534,6 +1184,102 @@ def connect_systems(source, dest, s_pname, d_pname, wire_cls=Wire):
     w.connect_port(d_port)
     return w
 
+
+from collections import namedtuple
+
+Difference = namedtuple('Difference', ['change', 'category', 'path', 'old', 'new'])
+Difference.__doc__ = '''difference between two diagrams (see `diff`)
+
+`change`: 'added', 'removed' or 'modified'
+`category`: 'system', 'port', 'wire', 'param' or 'attribute'
+            (class-specific attribute like the operators of a Summation)
+`path`: names from the compared System down to the item, joined by '/'
+        ('' for the compared System itself)
+`old`, `new`: the item in each diagram (None if absent). For a modified
+              System, its class name. For a modified wire, its connections.
+'''
+
+def diff(sys_a, sys_b):
+    '''structural differences between the Systems `sys_a` and `sys_b`
+    
+    Subsystems, ports and wires are matched by name. The subtrees with
+    the same exact structural hash (see `System.structural_hash`) are skipped,
+    so that the cost is proportional to the size of the changes
+    (once the hashes are cached). The subtrees with the same hash, but not
+    exact, are compared (e.g. their params with NaN or objects).
+    
+    Returns a list of `Difference`, in depth-first order.
+    '''
+    differences = []
+    _diff_system(sys_a, sys_b, [], differences)
+    return differences
+
+def _diff_items(items_a, items_b, category, path, differences, changed):
+    '''differences between the dicts {name: item} `items_a` and `items_b`,
+    with `changed(item_a, item_b)` returning the (old, new) description
+    of modified items (or None).
+    Returns the names of the items common to both dicts.
+    '''
+    common = []
+    for name, item in items_a.items():
+        if name not in items_b:
+            differences.append(Difference('removed', category,
+                                          '/'.join(path + [name]), item, None))
+        else:
+            common.append(name)
+            old_new = changed(item, items_b[name])
+            if old_new is not None:
+                differences.append(Difference('modified', category,
+                                              '/'.join(path + [name]), *old_new))
+    for name, item in items_b.items():
+        if name not in items_a:
+            differences.append(Difference('added', category,
+                                          '/'.join(path + [name]), None, item))
+    return common
+
+def _diff_system(sys_a, sys_b, path, differences):
+    '''appends to `differences` the differences between the Systems
+    `sys_a` and `sys_b` located at `path` (list of names)
+    '''
+    if sys_a.structural_hash() == sys_b.structural_hash() and \
+       sys_a._hash_exact and sys_b._hash_exact:
+        return # identical subtrees
+    cls_a = sys_a.__module__ +'.'+ sys_a.__class__.__name__
+    cls_b = sys_b.__module__ +'.'+ sys_b.__class__.__name__
+    if cls_a != cls_b:
+        differences.append(Difference('modified', 'system', '/'.join(path),
+                                      cls_a, cls_b))
+    
+    def value_changed(value_a, value_b):
+        return None if _values_equal(value_a, value_b) else (value_a, value_b)
+    _diff_items(sys_a.params, sys_b.params, 'param', path, differences,
+                value_changed)
+    _diff_items(sys_a._json_extra(), sys_b._json_extra(), 'attribute', path,
+                differences, value_changed)
+    
+    def port_changed(p_a, p_b):
+        return None if p_a._is_similar(p_b) else (p_a, p_b)
+    _diff_items(sys_a.ports_dict, sys_b.ports_dict, 'port', path, differences,
+                port_changed)
+    
+    def wire_changed(w_a, w_b):
+        def connections(w):
+            return sorted(('' if p.system is w.parent else p.system.name, p.name)
+                          for p in w.ports)
+        if w_a.__class__ == w_b.__class__ and w_a.type == w_b.type and \
+           connections(w_a) == connections(w_b):
+            return None
+        return (connections(w_a), connections(w_b))
+    _diff_items(sys_a.wires_dict, sys_b.wires_dict, 'wire', path, differences,
+                wire_changed)
+    
+    # Subsystems:
+    subsys_a, subsys_b = sys_a.subsystems_dict, sys_b.subsystems_dict
+    common = _diff_items(subsys_a, subsys_b, 'system', path, differences,
+                         lambda s_a, s_b: None)
+    for name in common:
+        _diff_system(subsys_a[name], subsys_b[name], path + [name], differences)
+
 def to_json(py_obj):
     '''convert `py_obj` to JSON-serializable objects
     
@@ -549,12 +1295,70 @@ def to_json(py_obj):
     raise TypeError(repr(py_obj) + ' is not JSON serializable')
 # end to_json
 
-import sys
+_class_cache = {}
+
 def _str_to_class(mod_class):
-    '''retreives the class from a "module.class" string'''
-    mod_name, cls_name = mod_class.split('.')
-    mod = sys.modules[mod_name]
-    return getattr(mod, cls_name)
+    '''retreives the class from a "module.class" string
+    
+    (classes already retrieved are cached)
+    '''
+    cls = _class_cache.get(mod_class)
+    if cls is None:
+        mod_name, cls_name = mod_class.split('.')
+        mod = sys.modules[mod_name]
+        cls = _class_cache[mod_class] = getattr(mod, cls_name)
+    return cls
+
+def _system_from_json(json_object):
+    '''creates the System described by `json_object` with its
+    parameters and ports, but without its subsystems and wires
+    '''
+    # TODO: specialize the instanciation for each class using
+    # _from_json class methods
+    cls = _str_to_class(json_object['__class__'])
+    syst = cls(name = json_object['name'])
+    syst.params = json_object['params']
+    syst._load_json_extra(json_object)
+    # add ports if any:
+    for p in json_object['ports']:
+        if not isinstance(p, Port):
+            p = from_json(p)
+        syst.add_port(p)
+    return syst
+
+def _add_wires_from_json(syst, wires):
+    '''adds to `syst` the wires described by the list of json objects `wires`
+    and make their connections'''
+    subsystems_index = syst._subsystems_index
+    for w_dict in wires:
+        # 1) decode the wire:
+        w_cls = _str_to_class(w_dict['__class__'])
+        w = w_cls(name = w_dict['name'], wtype = w_dict['type'])
+        syst.add_wire(w)
+        # 2) find the ports and make all the connections at once:
+        port_levels = []
+        for level, s_name, p_name in w_dict['ports']:
+            if level == 'parent':
+                assert syst.name == s_name
+                port_syst = syst
+            else:
+                port_syst = subsystems_index[s_name]
+            port_levels.append((port_syst._ports_index[p_name], level))
+        w.connect_ports(port_levels)
+    # end for each wire
+
+def _lazy_system_from_json(json_object, depth):
+    '''creates the System described by `json_object` with its parameters
+    and ports, loading its subsystems and wires only down to `depth` levels.
+    
+    The content of deeper systems is kept as json objects
+    until it is accessed (see `System._load_lazy_content`)
+    '''
+    syst = _system_from_json(json_object)
+    syst._lazy_content = (json_object['subsystems'], json_object['wires'], depth)
+    if depth > 0:
+        syst._load_lazy_content()
+    return syst
 
 def from_json(json_object):
     '''deserializes a sysdiag json object'''
@@ -566,31 +1370,197 @@ def from_json(json_object):
             return port
 
         if json_object['__sysdiagclass__'] == 'System':
-            # TODO: specialize the instanciation for each class using
-            # _from_json class methods
-            syst = cls(name = json_object['name'])
-            syst.params = json_object['params']
-            # add ports if any:
-            for p in json_object['ports']:
-                syst.add_port(p)
+            syst = _system_from_json(json_object)
             # add subsystems
             for s in json_object['subsystems']:
                 syst.add_subsystem(s)
             # add wires
-            for w_dict in json_object['wires']:
-                # 1) decode the wire:
-                w_cls = _str_to_class(w_dict['__class__'])
-                w = w_cls(name = w_dict['name'], wtype = w_dict['type'])
-                syst.add_wire(w)
-                # make the connections:
-                for level, s_name, p_name in w_dict['ports']:
-                    w.connect_by_name(s_name, p_name, level)
-            # end for each wire
+            _add_wires_from_json(syst, json_object['wires'])
             return syst
 
     return json_object
 
-def json_load(json_dump):
-    import json
-    syst = json.loads(json_dump, object_hook=from_json)
-    return syst
+def json_load(json_dump, lazy_depth=None):
+    '''load a System from its json dump (see `System.json_dump`)
+    
+    if `lazy_depth` is None: the whole hierarchy is loaded
+    if `lazy_depth` is an integer: only `lazy_depth` levels of subsystems
+    are loaded. The content of the deeper systems (subsystems and wires)
+    is loaded when first accessed. Their ports are loaded immediately,
+    since the wires of their parent connect to them.
+    '''
+    if lazy_depth is None:
+        return json.loads(json_dump, object_hook=from_json)
+    json_object = json.loads(json_dump)
+    if json_object.get('__sysdiagclass__') != 'System':
+        return from_json(json_object)
+    return _lazy_system_from_json(json_object, lazy_depth)
+
+
+### Binary format ###
+
+# Keys of the json object of a System which are not class specific:
+_SYSTEM_JSON_KEYS = frozenset(['__sysdiagclass__', '__class__', 'name',
+                               'subsystems', 'wires', 'ports', 'params'])
+
+# File signature, with the version number of the format in the last byte:
+_BINARY_MAGIC = b'SYSDIAG\x01'
+
+from array import array
+from functools import partial
+import struct
+# typecode of unsigned 32 bits integers:
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+
+def _u32_bytes(values):
+    '''little endian bytes of a sequence of unsigned 32 bits integers'''
+    arr = array(_U32, values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tobytes()
+
+def _binary_encode(syst):
+    '''encodes the System `syst` in the sysdiag binary format.
+    
+    The format holds the same information as the json format in two parts:
+    
+    * a table of all the strings (class names, names, port types,
+      json-encoded params), each string being stored only once
+    * a flat array of 32 bits integers which describes the hierarchy
+      in depth-first order, with strings referred to by their index in the
+      table and wire connections referred to by the index of the subsystem.
+    
+    Layout:
+    magic | n_strings | string lengths | utf-8 strings | n_ints | integers
+    '''
+    strings = []
+    strings_ind = {}
+    def intern(string):
+        ind = strings_ind.get(string)
+        if ind is None:
+            ind = strings_ind[string] = len(strings)
+            strings.append(string)
+        return ind
+    
+    ints = []
+    put = ints.append
+    
+    def encode_system(syst):
+        put(intern(syst.__module__ +'.'+ syst.__class__.__name__))
+        put(intern(syst.name))
+        put(intern(json.dumps(syst.params, sort_keys=True)))
+        put(intern(json.dumps(syst._json_extra(), sort_keys=True)))
+        # Ports:
+        # (without the ports created at the initialization of the system)
+        ports = [p for p in syst.ports if not p._created_by_system]
+        put(len(ports))
+        for p in ports:
+            put(intern(p.__module__ +'.'+ p.__class__.__name__))
+            put(intern(p.name))
+            put(intern(p.type))
+        # Subsystems:
+        put(len(syst.subsystems))
+        for subsys in syst.subsystems:
+            encode_system(subsys)
+        # Wires, with connections to the parent (0)
+        # or to subsystem i (i+1):
+        subsys_ind = {id(subsys): i+1 for i, subsys in enumerate(syst.subsystems)}
+        put(len(syst.wires))
+        for w in syst.wires:
+            put(intern(w.__module__ +'.'+ w.__class__.__name__))
+            put(intern(w.name))
+            put(intern(w.type))
+            put(len(w.ports))
+            for p in w.ports:
+                if p.system is syst:
+                    put(0)
+                else:
+                    put(subsys_ind[id(p.system)])
+                put(intern(p.name))
+    # end encode_system()
+    encode_system(syst)
+    
+    strings_bytes = [string.encode('utf-8') for string in strings]
+    return b''.join([_BINARY_MAGIC,
+                     struct.pack('<I', len(strings)),
+                     _u32_bytes([len(b) for b in strings_bytes]),
+                     b''.join(strings_bytes),
+                     struct.pack('<I', len(ints)),
+                     _u32_bytes(ints)])
+# end _binary_encode
+
+def binary_load(binary_dump):
+    '''load a System saved with `System.binary_dump`
+    
+    `binary_dump` is either a bytes string or a file opened in binary mode.
+    
+    The Systems, Ports and Wires are built directly from the integer array
+    (the result is the same as loading the json dump with `json_load`).
+    '''
+    if hasattr(binary_dump, 'read'):
+        binary_dump = binary_dump.read()
+    data = memoryview(binary_dump)
+    
+    n_magic = len(_BINARY_MAGIC)
+    if data[:n_magic].tobytes() != _BINARY_MAGIC:
+        raise ValueError('not a sysdiag binary dump (or unsupported version)')
+    pos = n_magic
+    
+    def read_u32(n):
+        arr = array(_U32)
+        arr.frombytes(data[pos:pos+4*n].tobytes())
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return arr.tolist()
+    
+    # 1) String table
+    n_strings, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    lengths = read_u32(n_strings)
+    pos += 4*n_strings
+    strings = []
+    for length in lengths:
+        strings.append(data[pos:pos+length].tobytes().decode('utf-8'))
+        pos += length
+    # 2) Integer array
+    n_ints, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    next_int = partial(next, iter(read_u32(n_ints)))
+    
+    def next_str():
+        return strings[next_int()]
+    
+    def decode_system():
+        cls = _str_to_class(next_str())
+        syst = cls(name = next_str())
+        syst.params = json.loads(next_str())
+        extra = next_str()
+        if extra != '{}':
+            syst._load_json_extra(json.loads(extra))
+        # Ports:
+        for i in range(next_int()):
+            p_cls = _str_to_class(next_str())
+            syst.add_port(p_cls(name = next_str(), ptype = next_str()))
+        # Subsystems:
+        subsystems = [syst]
+        for i in range(next_int()):
+            subsys = decode_system()
+            syst.add_subsystem(subsys)
+            subsystems.append(subsys)
+        # Wires, with connections to the parent (0)
+        # or to subsystem i (i+1):
+        for i in range(next_int()):
+            w_cls = _str_to_class(next_str())
+            w = w_cls(name = next_str(), wtype = next_str())
+            syst.add_wire(w)
+            port_levels = []
+            for j in range(next_int()):
+                s_ind = next_int()
+                port = subsystems[s_ind]._ports_index[next_str()]
+                port_levels.append((port, 'sibling' if s_ind else 'parent'))
+            w.connect_ports(port_levels)
+        return syst
+    # end decode_system()
+    
+    return decode_system()
+# end binary_load
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Diagrams shared by the tests of System Diagram
+"""
+
+# Import sysdiag:
+import sys
+try:
+    import blocks
+except ImportError:
+    sys.path.append('..')
+    import blocks
+
+
+def closed_loop(num=[1, 0.1], den=[0, 0.1], plant_den=[0, 1], nested=True):
+    '''closed loop diagram:
+    control num/den (by default PI) of a plant 1/plant_den (by default
+    an integrator). The plant is a TransferFunction 'int' inside a
+    SISOSystem 'plant' if `nested`, else the TransferFunction 'plant'.'''
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    ctrl = blocks.TransferFunction('controller', num, den, root)
+    if nested:
+        plant = blocks.SISOSystem('plant', root)
+        blocks.TransferFunction('int', [1], plant_den, plant)
+        wp1 = blocks.SignalWire('wp1', parent=plant)
+        wp2 = blocks.SignalWire('wp2', parent=plant)
+        wp1.connect_by_name('plant','in','parent')
+        wp1.connect_by_name('int','in')
+        wp2.connect_by_name('plant','out','parent')
+        wp2.connect_by_name('int','out')
+    else:
+        plant = blocks.TransferFunction('plant', [1], plant_den, root)
+    comp = blocks.Summation('compare', ops = ['+','-'], parent = root)
+    out = blocks.Sink('out', parent=root)
+    blocks.connect_systems(src, comp, d_pname='in0')
+    blocks.connect_systems(comp, ctrl)
+    blocks.connect_systems(ctrl, plant)
+    blocks.connect_systems(plant, comp, d_pname='in1')
+    blocks.connect_systems(plant, out)
+    return root
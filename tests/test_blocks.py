@@ -14,6 +14,8 @@ except ImportError:
     sys.path.append('..')
     import blocks
 
+from diagrams import closed_loop
+
 
 def test_source():
     '''test the Source block class'''
@@ -141,3 +143,155 @@ def test_json():
     assert_is(type(ctrl1), blocks.TransferFunction)
     assert_equal(ctrl1.name, "controller")
     assert_equal(ctrl, ctrl1)
+
+def test_incidence_matrix():
+    '''dense and sparse incidence matrices, adjacency matrix'''
+    import numpy as np
+    root = closed_loop(nested=False)
+    inc = blocks.incidence_matrix(root)
+    assert_equal(inc.shape, (4, 5))
+    # one source (+1) per wire
+    assert_equal(list((inc == 1).sum(axis=1)), [1, 1, 1, 1])
+    assert_equal(inc[0].tolist(), [1, 0, 0, -1, 0])
+
+    inc_sp = blocks.incidence_matrix(root, sparse=True)
+    assert_true(np.array_equal(inc_sp.toarray(), inc))
+
+    adj = blocks.adjacency_matrix(root, sparse=False)
+    # src -> compare -> controller -> plant -> (compare, out)
+    expected = np.zeros((5, 5), dtype=int)
+    for i, j in [(0, 3), (3, 1), (1, 2), (2, 3), (2, 4)]:
+        expected[i, j] = 1
+    assert_true(np.array_equal(adj, expected))
+    adj_sp = blocks.adjacency_matrix(root)
+    assert_true(np.array_equal(adj_sp.toarray(), expected))
+
+    # cached matrices are updated after a modification:
+    inc[0, 0] = 5 # (returned matrices are copies)
+    assert_equal(blocks.incidence_matrix(root)[0, 0], 1)
+    blocks.Sink('out2', parent=root)
+    assert_equal(blocks.incidence_matrix(root).shape, (4, 6))
+
+    # two ports of a block on the same wire: the last one gives the entry,
+    # in both modes:
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    double = blocks.Summation('double', parent=root)
+    w = blocks.connect_systems(src, double, d_pname='in0')
+    w.connect_port(double.ports_dict['in1'])
+    inc = blocks.incidence_matrix(root)
+    assert_equal(inc.dtype, np.int8)
+    assert_equal(inc[0].tolist(), [1, -1])
+    assert_true(np.array_equal(blocks.incidence_matrix(root, sparse=True).toarray(), inc))
+    # (output and input of a block on the same wire: the input is last)
+    import sysdiag
+    loop = blocks.Summation('loop', ops=['+'], parent=root)
+    w_loop = sysdiag.Wire('w_loop', '', parent=root)
+    w_loop.connect_port(loop.ports_dict['in0'])
+    w_loop.connect_port(loop.ports_dict['out'])
+    inc = blocks.incidence_matrix(root)
+    assert_equal(inc.tolist(), [[1, -1, 0], [0, 0, -1]])
+    assert_true(np.array_equal(blocks.incidence_matrix(root, sparse=True).toarray(), inc))
+
+def test_json_file():
+    '''json_dump(file) gives the same text as json_dump()'''
+    import io
+    root = closed_loop(nested=False)
+    for indent in [2, None, '\t']:
+        for sort_keys in [True, False]:
+            out = io.StringIO()
+            root.json_dump(out, indent=indent, sort_keys=sort_keys)
+            assert_equal(out.getvalue(),
+                         root.json_dump(indent=indent, sort_keys=sort_keys))
+
+def test_binary_dump():
+    '''binary save/load gives the same objects as the JSON round trip'''
+    import io
+    import sysdiag
+    root = closed_loop(nested=False)
+    # a hierarchical subsystem with custom ports:
+    plant = blocks.SISOSystem('plant2', parent=root)
+    plant.add_port(blocks.InputPort('extra', 'type1'))
+    blocks.TransferFunction('int', [1], [0, 1], parent=plant)
+    w = blocks.SignalWire('wp1', parent=plant)
+    w.connect_by_name('plant2', 'in', 'parent')
+    w.connect_by_name('int', 'in')
+
+    data = root.binary_dump()
+    r_bin = sysdiag.binary_load(data)
+    r_json = sysdiag.json_load(root.json_dump())
+    assert_equal(r_bin, r_json)
+    # the operators of the Summation are restored:
+    assert_equal(r_json, root)
+    assert_equal(r_bin.json_dump(), r_json.json_dump())
+    assert_true(len(data) < len(root.json_dump(indent=None)))
+    # Files:
+    f = io.BytesIO()
+    root.binary_dump(f)
+    f.seek(0)
+    assert_equal(sysdiag.binary_load(f).json_dump(), r_json.json_dump())
+    # Wrong data:
+    with assert_raises(ValueError):
+        sysdiag.binary_load(b'{"name": "not binary"}')
+
+def test_json_lazy_load():
+    '''lazy loading of the subsystems beyond a given depth'''
+    import sysdiag
+    root = closed_loop(nested=False)
+    plant = blocks.SISOSystem('plant2', parent=root)
+    blocks.TransferFunction('int', [1], [0, 1], parent=plant)
+    w = blocks.SignalWire('wp1', parent=plant)
+    w.connect_by_name('plant2', 'in', 'parent')
+    w.connect_by_name('int', 'in')
+    blocks.connect_systems(root.subsystems_dict['plant'], plant)
+    s_json = root.json_dump()
+
+    r = sysdiag.json_load(s_json, lazy_depth=1)
+    assert_is(r._lazy_content, None)
+    p2 = r._subsystems_index['plant2']
+    # the content of plant2 is not yet loaded, but its ports are:
+    assert_true(p2._lazy_content is not None)
+    assert_equal(len(p2.ports), 2)
+    assert_is(p2.ports_dict['in'].wire, r.wires[-1])
+    assert_true(not p2.is_empty())
+    # first access to the subsystems:
+    assert_equal([s.name for s in p2.subsystems], ['int'])
+    assert_is(p2._lazy_content, None)
+    assert_is(p2.ports_dict['in'].internal_wire, p2.wires[0])
+    assert_equal(r, sysdiag.json_load(s_json))
+
+    # lazy_depth=0: even the top level is loaded on demand
+    r = sysdiag.json_load(s_json, lazy_depth=0)
+    assert_true(r._lazy_content is not None)
+    assert_equal(r.json_dump(), sysdiag.json_load(s_json).json_dump())
+
+def test_cache_invalidation():
+    '''caches of the ancestors invalidated by a deep modification'''
+    import sysdiag
+    root = closed_loop(nested=False)
+    plant = blocks.SISOSystem('plant2', parent=root)
+    integrator = blocks.TransferFunction('int', [1], [0, 1], parent=plant)
+    blocks.incidence_matrix(root)
+    assert_true(root._analysis_cache is not None)
+    # the analysis of root does not hash the tree:
+    assert_is(root._structural_hash, None)
+    assert_is(integrator._structural_hash, None)
+    integrator.params['num'] = [2]
+    assert_is(root._analysis_cache, None)
+    # the hashes of the ancestors are invalidated as well:
+    root.structural_hash()
+    integrator.params['num'] = [3]
+    assert_is(plant._structural_hash, None)
+    assert_is(root._structural_hash, None)
+    assert_true(root.subsystems[0]._structural_hash is not None)
+
+    # loading the content of a lazy System invalidates nothing:
+    r = sysdiag.json_load(root.json_dump(), lazy_depth=1)
+    r_plant = r.subsystems_dict['plant2']
+    r._structural_hash = 'fake'
+    assert_equal([s.name for s in r_plant.subsystems], ['int'])
+    assert_equal(r._structural_hash, 'fake')
+    # nor while the analysis of a lazy System loads its content:
+    r = sysdiag.json_load(root.json_dump(), lazy_depth=0)
+    blocks.incidence_matrix(r)
+    assert_true(r._analysis_cache is not None)
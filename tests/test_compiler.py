@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Test the compilation of block diagrams into flat execution plans
+"""
+
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises, assert_is
+
+import numpy as np
+
+# Import sysdiag:
+import sys
+try:
+    import blocks
+    import compiler
+except ImportError:
+    sys.path.append('..')
+    import blocks
+    import compiler
+
+from diagrams import closed_loop
+
+
+def test_compile():
+    '''flat execution plan of a diagram'''
+    r = closed_loop([1, 2], [0, 1])
+    plan = compiler.compile(r)
+    assert_equal(plan.n_blocks, 3)
+    assert_equal(plan.n_signals, 4)
+    ctrl = plan.block_index('controller')
+    integ = plan.block_index('plant/int')
+    comp = plan.block_index(r.subsystems_dict['compare'])
+    assert_equal(plan.kind[ctrl], compiler.KIND_TF)
+    assert_equal(plan.kind[comp], compiler.KIND_SUM)
+    assert_equal(list(plan.gains_of(comp)), [1, -1])
+    assert_equal(list(plan.num_of(ctrl)), [1, 2])
+    assert_equal(list(plan.den_of(integ)), [0, 1])
+    assert_equal(list(np.diff(plan.in_ptr)), [2 if b == comp else 1 for b in range(3)])
+    # the controller and the integrator are connected through
+    # the port of the plant:
+    assert_equal(plan.outputs_of(ctrl)[0], plan.inputs_of(integ)[0])
+    assert_equal(plan.driver[plan.outputs_of(integ)[0]], integ)
+    assert_true(np.all(plan.n_drivers == 1))
+    assert_equal(plan.input_names, ['U_src'])
+    assert_equal(plan.output_names, ['Y_out'])
+    assert_equal(plan.output_sig[0], plan.outputs_of(integ)[0])
+    # Edges:
+    edges = set(zip(plan.edge_src, plan.edge_dst))
+    assert_equal(edges, set([(comp, ctrl), (ctrl, integ), (integ, comp)]))
+    # Evaluation order: the integrator breaks the loop
+    assert_false(plan.algebraic_loop)
+    assert_equal(list(plan.order), [integ, comp, ctrl])
+    with assert_raises(ValueError):
+        plan.block_index(r)
+    # the plan is cached until the diagram is modified:
+    assert_is(compiler.compile(r), plan)
+    r.subsystems_dict['plant'].subsystems[0].params['den'] = [1, 1]
+    plan2 = compiler.compile(r)
+    assert_true(plan2 is not plan)
+    assert_equal(list(plan2.den_of(integ)), [1, 1])
+    # and after the renaming of a port:
+    plant = r.subsystems_dict['plant']
+    plan = compiler.compile(plant)
+    assert_equal(plan.input_names, ['U_plant_in'])
+    plant.ports_dict['in'].name = 'u'
+    plan = compiler.compile(plant)
+    assert_equal(plan.input_names, ['U_plant_u'])
+
+
+def test_algebraic_loop():
+    '''evaluation order with an algebraic loop'''
+    r = blocks.System('root')
+    src = blocks.Source('src', r)
+    comp = blocks.Summation('sum', ops = ['+','-'], parent = r)
+    gain = blocks.TransferFunction('gain', [2], [1], r)
+    blocks.connect_systems(src, comp, d_pname='in0')
+    blocks.connect_systems(comp, gain)
+    blocks.connect_systems(gain, comp, d_pname='in1')
+    plan = compiler.compile(r)
+    assert_true(plan.algebraic_loop)
+    assert_true(plan.feedthrough.all())
+    assert_equal(sorted(plan.order), [0, 1])
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Test the graph analysis of block diagrams
+"""
+
+from nose.tools import assert_equal, assert_raises
+
+import numpy as np
+
+# Import sysdiag:
+import sys
+try:
+    import blocks
+    import graph
+    import transfer_func
+except ImportError:
+    sys.path.append('..')
+    import blocks
+    import graph
+    import transfer_func
+
+from diagrams import closed_loop
+
+
+def loop(plant_den):
+    '''feedback loop of a gain 2 and a plant 1/plant_den'''
+    return closed_loop([2], [1], plant_den, nested=False)
+
+
+def test_strongly_connected_components():
+    '''Tarjan algorithm on a small graph'''
+    # 0 -> 1 -> 2 -> 0, 2 -> 3, 3 -> 3, 4
+    src = [0, 1, 2, 2, 3]
+    dst = [1, 2, 0, 3, 3]
+    components = graph.strongly_connected_components(5, src, dst)
+    assert_equal([sorted(c.tolist()) for c in components], [[3], [0, 1, 2], [4]])
+    # long chain (no recursion limit):
+    n = 20000
+    components = graph.strongly_connected_components(n, np.arange(n), (np.arange(n)+1) % n)
+    assert_equal(len(components), 1)
+
+
+def test_loops():
+    '''feedback and algebraic loops'''
+    r = loop([0, 1]) # integrator plant: no algebraic loop
+    names = [[b.name for b in l] for l in graph.feedback_loops(r)]
+    assert_equal(names, [['controller', 'plant', 'compare']])
+    assert_equal(graph.algebraic_loops(r), [])
+    graph.check_algebraic_loops(r)
+
+    r = loop([1]) # static plant: algebraic loop
+    names = [[b.name for b in l] for l in graph.algebraic_loops(r)]
+    assert_equal(names, [['controller', 'plant', 'compare']])
+    with assert_raises(graph.AlgebraicLoopError):
+        graph.check_algebraic_loops(r)
+    with assert_raises(graph.AlgebraicLoopError):
+        transfer_func.transfer_syst(r, check_loops=True)
+    # (the loop is solvable: y = 2(u - y))
+    Y_expr, Y, U = transfer_func.transfer_syst(r)
+    assert_equal(Y_expr[0], 2*U[0]/3)
+
+
+def test_topological_order():
+    '''evaluation order and levels'''
+    r = loop([0, 1])
+    order, levels = graph.topological_order(r)
+    # the loop is broken at the integrator:
+    assert_equal([b.name for b in order], ['plant', 'compare', 'controller'])
+    assert_equal([[b.name for b in l] for l in levels],
+                 [['plant'], ['compare'], ['controller']])
+
+    # parallel branches: src -> (g1, g2) -> sum -> g3
+    r = blocks.System('root')
+    src = blocks.Source('src', r)
+    g1 = blocks.TransferFunction('g1', [1], [1], r)
+    g2 = blocks.TransferFunction('g2', [1], [1, 1], r)
+    add = blocks.Summation('add', ops = ['+','+'], parent = r)
+    g3 = blocks.TransferFunction('g3', [1], [1], r)
+    w = blocks.connect_systems(src, g1)
+    w.connect_by_name('g2', 'in')
+    blocks.connect_systems(g1, add, d_pname='in0')
+    blocks.connect_systems(g2, add, d_pname='in1')
+    blocks.connect_systems(add, g3)
+    order, levels = graph.topological_order(r)
+    assert_equal([[b.name for b in l] for l in levels],
+                 [['g1', 'g2'], ['add'], ['g3']])
+    assert_equal(order, [b for l in levels for b in l])
+
+    with assert_raises(graph.AlgebraicLoopError):
+        graph.topological_order(loop([1]))
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Test the Modified Nodal Analysis of electrical circuits
+"""
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+import numpy as np
+
+# Import sysdiag:
+import sys
+try:
+    import elec
+    import mna
+except ImportError:
+    sys.path.append('..')
+    import elec
+    import mna
+
+from sysdiag import System, Port, Wire, connect_systems
+
+
+def divider(R1=1e3, R2=3e3, V=10.):
+    '''voltage source V across two resistors in series'''
+    root = System('root')
+    src = elec.VoltageSource('V1', V, root)
+    r1 = elec.Resistor('R1', R1, root)
+    r2 = elec.Resistor('R2', R2, root)
+    gnd = elec.Ground('GND', root)
+    connect_systems(src, r1, 'p', 'p')
+    connect_systems(r1, r2, 'n', 'p')
+    connect_systems(r2, src, 'n', 'n')
+    connect_systems(gnd, src, 'p', 'n')
+    return root
+
+def low_pass(R=1e3, C=1e-6):
+    '''voltage source -> RC low-pass filter, with the filter
+    inside a subsystem with ports 'in', 'out' and 'gnd' '''
+    root = System('root')
+    src = elec.VoltageSource('V1', 1., root)
+    gnd = elec.Ground('GND', root)
+    filt = System('filter', root)
+    for name in ['in', 'out', 'gnd']:
+        filt.add_port(Port(name, 'elec'))
+    r = elec.Resistor('R', R, filt)
+    c = elec.Capacitor('C', C, filt)
+    for name, ports in [('w_in', [(r, 'p')]),
+                        ('w_out', [(r, 'n'), (c, 'p')]),
+                        ('w_gnd', [(c, 'n')])]:
+        w = Wire(name, 'elec', filt)
+        w.connect_port(filt.ports_dict[name[2:]], 'parent')
+        for syst, pname in ports:
+            w.connect_port(syst.ports_dict[pname])
+    connect_systems(src, filt, 'p', 'in')
+    connect_systems(src, filt, 'n', 'gnd')
+    connect_systems(gnd, src, 'p', 'n')
+    return root
+
+def ladder(n, V=1.):
+    '''voltage source across a chain of `n` 1 Ω resistors,
+    with a 1 µF capacitor from each internal node to the Ground'''
+    root = System('root')
+    src = elec.VoltageSource('V1', V, root)
+    gnd = elec.Ground('GND', root)
+    connect_systems(gnd, src, 'p', 'n')
+    prev = src
+    for k in range(n):
+        r = elec.Resistor('R{}'.format(k), 1., root)
+        connect_systems(prev, r, 'p' if prev is src else 'n', 'p')
+        if k > 0:
+            c = elec.Capacitor('C{}'.format(k), 1e-6, root)
+            connect_systems(prev, c, 'n', 'p')
+            connect_systems(c, src, 'n', 'n')
+        prev = r
+    connect_systems(prev, src, 'n', 'n')
+    return root
+
+
+def test_dc_analysis():
+    '''DC operating points'''
+    root = divider()
+    x, circuit = mna.dc_analysis(root)
+    assert_equal((circuit.n_nodes, circuit.n_branches), (2, 1))
+    assert_true(np.isclose(circuit.voltage(x, 'R2'), 7.5))
+    assert_true(np.isclose(circuit.voltage(x, 'R1', 'p'), 10.))
+    assert_true(np.isclose(circuit.current(x, 'R1'), 2.5e-3))
+    # the current flows from n to p through the source:
+    assert_true(np.isclose(circuit.current(x, 'V1'), -2.5e-3))
+    # modified source value:
+    x, circuit = mna.dc_analysis(root, sources={'V1': 2.})
+    assert_true(np.isclose(circuit.voltage(x, 'R2'), 1.5))
+    
+    # inductors are short circuits, current sources:
+    root = System('root')
+    src = elec.CurrentSource('I1', 1e-3, root)
+    r = elec.Resistor('R', 2e3, root)
+    l = elec.Inductor('L', 1e-3, root)
+    gnd = elec.Ground('GND', root)
+    connect_systems(src, r, 'p', 'p')
+    connect_systems(r, l, 'n', 'p')
+    connect_systems(l, src, 'n', 'n')
+    connect_systems(gnd, src, 'p', 'n')
+    x, circuit = mna.dc_analysis(root)
+    assert_true(np.isclose(circuit.voltage(x, 'I1'), 2.))
+    assert_true(np.isclose(circuit.voltage(x, 'L'), 0.))
+    assert_true(np.isclose(circuit.current(x, 'L'), 1e-3))
+    
+    # capacitors are open circuits:
+    x, circuit = mna.dc_analysis(low_pass())
+    assert_true(np.isclose(circuit.voltage(x, 'filter/C'), 1.))
+    # floating node between two capacitors:
+    root = System('root')
+    src = elec.VoltageSource('V1', 1., root)
+    c1 = elec.Capacitor('C1', 1e-6, root)
+    c2 = elec.Capacitor('C2', 1e-6, root)
+    gnd = elec.Ground('GND', root)
+    connect_systems(src, c1, 'p', 'p')
+    connect_systems(c1, c2, 'n', 'p')
+    connect_systems(c2, src, 'n', 'n')
+    connect_systems(gnd, src, 'p', 'n')
+    with assert_raises(ValueError):
+        mna.dc_analysis(root)
+    # no Ground:
+    root = System('root')
+    r = elec.Resistor('R', 1e3, root)
+    with assert_raises(ValueError):
+        mna.compile_circuit(root)
+    
+    # large circuit (pattern keys above the int32 range):
+    n = 46400
+    x, circuit = mna.dc_analysis(ladder(n))
+    assert_true(circuit.size > 46341)
+    assert_equal(abs(circuit.matrix(0.) - circuit.G).max(), 0)
+    assert_true(np.isclose(circuit.voltage(x, 'R{}'.format(n//2), 'n'),
+                           (n - n//2 - 1)/n))
+
+
+def test_ac_analysis():
+    '''frequency response of an RC filter'''
+    root = low_pass(R=1e3, C=1e-6)
+    omegas = np.logspace(1, 5, 20)
+    x, circuit = mna.ac_analysis(root, omegas)
+    assert_equal(x.shape, (circuit.size, 20))
+    H = circuit.voltage(x, 'filter/C')
+    assert_true(np.allclose(H, 1/(1 + 1j*omegas*1e-3)))
+    # capacitor current:
+    i_c = circuit.current(x, 'filter/C', omegas)
+    assert_true(np.allclose(i_c, circuit.current(x, 'filter/R')))
+
+
+def test_transient_analysis():
+    '''step response of an RC filter'''
+    root = low_pass(R=1e3, C=1e-6)
+    t = np.linspace(0, 5e-3, 2001)
+    u = np.ones(len(t))
+    u[0] = 0.
+    for method in ['trap', 'be']:
+        x, circuit = mna.transient_analysis(root, t, sources={'V1': u},
+                                            method=method)
+        v_c = circuit.voltage(x, 'filter/C')
+        assert_true(np.allclose(v_c, 1 - np.exp(-t/1e-3), atol=2e-3))
+    # the equations are cached on the System:
+    assert_true(mna.compile_circuit(root) is circuit)
+
+
+def test_ordering_cache():
+    '''reuse of the LU column orderings across sweeps'''
+    root = low_pass(R=1e3, C=1e-6)
+    omegas = np.logspace(1, 5, 20)
+    mna.clear_ordering_cache()
+    x, circuit = mna.ac_analysis(root, omegas)
+    info = mna.ordering_cache_info()
+    assert_equal((info.hits, info.misses, info.factor_reuses), (19, 1, 0))
+    # same sweep: the last factorizations are kept on the circuit
+    x, circuit = mna.ac_analysis(root, omegas[-2:])
+    assert_equal(mna.ordering_cache_info().factor_reuses, 2)
+    
+    # new values, same topology: the ordering is reused
+    root.subsystems_dict['filter'].subsystems_dict['R'].params['R'] = 2e3
+    x, circuit = mna.ac_analysis(root, omegas)
+    info = mna.ordering_cache_info()
+    assert_equal((info.hits, info.misses), (39, 1))
+    assert_true(np.allclose(circuit.voltage(x, 'filter/C'),
+                            1/(1 + 1j*omegas*2e-3)))
+    
+    # transient: one factorization for the DC point and one for the steps
+    mna.clear_ordering_cache()
+    x, circuit = mna.transient_analysis(root, np.linspace(0, 1e-2, 101))
+    info = mna.ordering_cache_info()
+    assert_equal((info.hits, info.misses), (1, 1))
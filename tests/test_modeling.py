@@ -4,7 +4,7 @@
 Pierre Haessig — October 2013
 """
 
-from nose.tools import assert_equal, assert_true, assert_raises, assert_is, assert_is_instance
+from nose.tools import assert_equal, assert_true, assert_raises, assert_is
 
 import sympy
 from sympy import symbols
@@ -19,6 +19,8 @@ except ImportError:
     import blocks
     import transfer_func
 
+from diagrams import closed_loop
+
 
 def testl_laplace_output():
     '''laplace_output function'''
@@ -52,3 +54,368 @@ def test_transfer_syst():
     # 2b) depth=1, the inside is analyzed. Traversing connection is solved
     out_expr, out_var, in_var = transfer_func.transfer_syst(s, depth=1)
     assert_equal(out_expr[0], U)
+
+
+def test_linear_model():
+    '''linear engine versus sympy.solve'''
+    root = closed_loop()
+    Y_lin, Y, U = transfer_func.transfer_syst(root, method='linear')
+    assert_equal([str(v) for v in Y], ['Y_out'])
+    assert_equal([str(v) for v in U], ['U_src'])
+    Y_sol, Y, U = transfer_func.transfer_syst(root)
+    assert_equal(sympy.simplify(Y_lin[0] - Y_sol[0]), 0)
+
+    # Numerical evaluation:
+    model = transfer_func.LinearModel(root)
+    s = symbols('s')
+    for s_val in [1j, 0.5+2j, 10]:
+        H = model.solve(s_val)
+        H_expr = complex(Y_lin[0].subs({s: s_val, U[0]: 1}))
+        assert_true(abs(H[0,0] - H_expr) < 1e-12)
+
+    # Generic blocks have no numerical model:
+    with assert_raises(ValueError):
+        transfer_func.LinearModel(blocks.SISOSystem('s1'))
+
+    # long chain: the products of the transfer functions are kept factored
+    root = blocks.System('root')
+    prev = blocks.Source('src', root)
+    for i in range(200):
+        tf = blocks.TransferFunction('TF{}'.format(i), [1], [1, 1], root)
+        blocks.connect_systems(prev, tf)
+        prev = tf
+    blocks.connect_systems(prev, blocks.Sink('out', root))
+    Y_lin, Y, U = transfer_func.transfer_syst(root, method='linear')
+    assert_equal(sympy.cancel(Y_lin[0]*(1 + s)**200), U[0])
+
+
+def test_frequency_response():
+    '''vectorized frequency response versus the analytical transfer'''
+    import numpy as np
+    root = closed_loop()
+    omegas = np.logspace(-2, 3, 200)
+    H, Y, U = transfer_func.frequency_response(root, omegas)
+    assert_equal(H.shape, (1, 1, 200))
+    # closed loop of C = (1 + 0.1s)/(0.1s) and P = 1/s:
+    s = 1j*omegas
+    CP = (1 + 0.1*s)/(0.1*s) / s
+    assert_true(np.allclose(H[0,0], CP/(1 + CP), rtol=1e-12))
+    # chunked computation (7 frequencies per chunk):
+    model = transfer_func.LinearModel(root)
+    n, n_in, n_out = model.shape
+    H2 = model.frequency_response(omegas, max_memory=7*16*n*(n + n_in))
+    assert_true(np.allclose(H2, H))
+    # sparse factorization of each frequency, when one does not fit:
+    H3 = model.frequency_response(omegas, max_memory=1)
+    assert_true(np.allclose(H3, H))
+
+
+def test_reduction_cache():
+    '''replicated subsystems are reduced once'''
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', parent=root)
+    prev = src
+    for i in range(4):
+        # plant i: 1/(1+s) inside a SISOSystem
+        plant = blocks.SISOSystem('plant{}'.format(i), root)
+        blocks.TransferFunction('lag', [1], [1, 1], plant)
+        wp1 = blocks.SignalWire('wp1', parent=plant)
+        wp2 = blocks.SignalWire('wp2', parent=plant)
+        wp1.connect_by_name(plant.name, 'in', 'parent')
+        wp1.connect_by_name('lag', 'in')
+        wp2.connect_by_name(plant.name, 'out', 'parent')
+        wp2.connect_by_name('lag', 'out')
+        blocks.connect_systems(prev, plant)
+        prev = plant
+    blocks.connect_systems(prev, out)
+    plants = root.subsystems[2:]
+    assert_equal(len(set(p.structural_hash() for p in plants)), 1)
+    assert_true(root.structural_hash() != plants[0].structural_hash())
+
+    transfer_func.clear_reduction_cache()
+    Y_expr, Y, U = transfer_func.transfer_syst(root)
+    info = transfer_func.reduction_cache_info()
+    assert_equal((info.hits, info.misses, info.currsize), (3, 1, 1))
+    s = symbols('s')
+    assert_equal(sympy.simplify(Y_expr[0] - U[0]/(1 + s)**4), 0)
+    # the cache can be disabled:
+    transfer_func.set_reduction_cache_size(0)
+    try:
+        Y_expr2, Y, U = transfer_func.transfer_syst(root)
+        assert_equal(transfer_func.reduction_cache_info().currsize, 0)
+    finally:
+        transfer_func.set_reduction_cache_size(128)
+    assert_equal(sympy.simplify(Y_expr[0] - Y_expr2[0]), 0)
+
+    # with a limited depth, the plants are modeled by their names:
+    Y_expr, Y, U = transfer_func.transfer_syst(root, depth=1)
+    TF = symbols('TF_plant0 TF_plant1 TF_plant2 TF_plant3')
+    assert_equal(Y_expr[0], TF[0]*TF[1]*TF[2]*TF[3]*U[0])
+
+
+def test_reduction_cache_exact():
+    '''subsystems with equal but not exact hashes are reduced separately'''
+    s = symbols('s')
+    k, k_pos = symbols('k'), symbols('k', positive=True)
+    for dens in ([[k, 1], [k_pos, 1]],
+                 [[sympy.Rational(1, 3), 1], [1/3, 1]]):
+        root = blocks.System('root')
+        src = blocks.Source('src', root)
+        out = blocks.Sink('out', parent=root)
+        first, last = lag_chain(root, dens)
+        blocks.connect_systems(src, first)
+        blocks.connect_systems(last, out)
+        transfer_func.clear_reduction_cache()
+        Y_expr, Y, U = transfer_func.transfer_syst(root)
+        info = transfer_func.reduction_cache_info()
+        assert_equal((info.hits, info.misses), (0, 2))
+        expected = U[0]/((dens[0][0] + s)*(dens[1][0] + s))
+        assert_equal(sympy.simplify(Y_expr[0] - expected), 0)
+
+    # not exact hashes (NaN params): no caching
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', parent=root)
+    first, last = lag_chain(root, [[1, 1], [1, 1]])
+    blocks.connect_systems(src, first)
+    blocks.connect_systems(last, out)
+    first.params['note'] = last.params['note'] = float('nan')
+    transfer_func.clear_reduction_cache()
+    Y_expr, Y, U = transfer_func.transfer_syst(root)
+    info = transfer_func.reduction_cache_info()
+    assert_equal((info.hits, info.misses, info.currsize), (0, 0, 0))
+    assert_equal(sympy.simplify(Y_expr[0] - U[0]/(s + 1)**2), 0)
+
+
+def test_incremental_transfer():
+    '''cached transfer function, recomputed after a local edit'''
+    root = closed_loop()
+    plant = root.subsystems_dict['plant']
+    transfer_func.clear_reduction_cache()
+    Y_expr, Y, U = transfer_func.transfer_syst(root)
+    Y_expr2, Y, U = transfer_func.transfer_syst(root)
+    assert_equal(Y_expr2, Y_expr)
+    assert_equal(transfer_func.reduction_cache_info().misses, 1)
+
+    # edit the controller into a proportional gain 2:
+    ctrl = root.subsystems_dict['controller']
+    ctrl.params['num'] = [2]
+    ctrl.params['den'] = [1]
+    assert_is(root._analysis_cache, None)
+    assert_true(plant._structural_hash is not None) # untouched branch
+    Y_expr, Y, U = transfer_func.transfer_syst(root)
+    s = symbols('s')
+    assert_equal(sympy.simplify(Y_expr[0] - U[0]*2/(s + 2)), 0)
+    # the plant reduction was reused:
+    info = transfer_func.reduction_cache_info()
+    assert_equal((info.hits, info.misses), (1, 1))
+
+
+def test_rename_transfer():
+    '''the cached transfer function follows the renaming of the System
+    and of its ports'''
+    s = blocks.SISOSystem('s1')
+    out_expr, out_var, in_var = transfer_func.transfer_syst(s)
+    assert_equal(out_expr[0], symbols('TF_s1')*symbols('U_s1_in'))
+    s.name = 's2'
+    out_expr, out_var, in_var = transfer_func.transfer_syst(s)
+    assert_equal(out_expr[0], symbols('TF_s2')*symbols('U_s2_in'))
+    assert_equal([str(v) for v in out_var], ['Y_s2_out'])
+    # and the renaming of its ports:
+    s.ports_dict['in'].name = 'u'
+    s.ports_dict['out'].name = 'y'
+    out_expr, out_var, in_var = transfer_func.transfer_syst(s)
+    assert_equal(out_expr[0], symbols('TF_s2')*symbols('U_s2_u'))
+    assert_equal([str(v) for v in out_var], ['Y_s2_y'])
+
+
+class Lag(blocks.SISOSystem):
+    '''user-defined block class, for the parallel reduction'''
+    pass
+
+
+def lag_chain(parent, dens, cls=blocks.SISOSystem):
+    '''chain of SISOSystems containing the lags 1/den(s), inside `parent`.
+    Returns the first and last systems of the chain'''
+    chain = []
+    for i, den in enumerate(dens):
+        plant = cls('plant{}'.format(i), parent)
+        blocks.TransferFunction('lag', [1], den, plant)
+        wp1 = blocks.SignalWire('wp1', parent=plant)
+        wp2 = blocks.SignalWire('wp2', parent=plant)
+        wp1.connect_by_name(plant.name, 'in', 'parent')
+        wp1.connect_by_name('lag', 'in')
+        wp2.connect_by_name(plant.name, 'out', 'parent')
+        wp2.connect_by_name('lag', 'out')
+        if chain:
+            blocks.connect_systems(chain[-1], plant)
+        chain.append(plant)
+    return chain[0], chain[-1]
+
+
+def test_parallel_reduction():
+    '''reduction of the subsystems in worker processes'''
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', parent=root)
+    first, last = lag_chain(root, [[1, 1], [2, 1], [1, 1]])
+    blocks.connect_systems(src, first)
+    blocks.connect_systems(last, out)
+
+    transfer_func.clear_reduction_cache()
+    Y_expr, Y, U = transfer_func.transfer_syst(root, processes=2)
+    # two distinct plants reduced by the pool:
+    assert_equal(transfer_func.reduction_cache_info().misses, 2)
+    s = symbols('s')
+    assert_equal(sympy.simplify(Y_expr[0] - U[0]/((1 + s)**2*(2 + s))), 0)
+    # no pool for the trivial reductions of depth 0:
+    assert_equal(transfer_func._reduce_in_pool(root.subsystems, 0, 2), {})
+    Y_expr, Y, U = transfer_func.transfer_syst(root, depth=1, processes=2)
+    TF = symbols('TF_plant0 TF_plant1 TF_plant2')
+    assert_equal(Y_expr[0], TF[0]*TF[1]*TF[2]*U[0])
+
+    # nested plants, of a class of this module:
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', parent=root)
+    outer = blocks.SISOSystem('outer', root)
+    first, last = lag_chain(outer, [[1, 1], [2, 1], [1, 1]], Lag)
+    w_in = blocks.SignalWire('w_in', parent=outer)
+    w_in.connect_port(outer.ports_dict['in'], 'parent')
+    w_in.connect_port(first.ports_dict['in'])
+    w_out = blocks.SignalWire('w_out', parent=outer)
+    w_out.connect_port(outer.ports_dict['out'], 'parent')
+    w_out.connect_port(last.ports_dict['out'])
+    blocks.connect_systems(src, outer)
+    blocks.connect_systems(outer, out)
+    transfer_func.clear_reduction_cache()
+    Y_expr, Y, U = transfer_func.transfer_syst(root, processes=2)
+    # the two distinct plants, then the outer system, reduced by the pool
+    # (the third plant reuses the result of the pool, without cache lookup):
+    info = transfer_func.reduction_cache_info()
+    assert_equal((info.hits, info.misses), (0, 3))
+    assert_equal(sympy.simplify(Y_expr[0] - U[0]/((1 + s)**2*(2 + s))), 0)
+    # the outer system is found in the cache:
+    transfer_func.transfer_syst(root, input_var=[], processes=2)
+    info = transfer_func.reduction_cache_info()
+    assert_equal((info.hits, info.misses), (1, 3))
+
+    # the params are sent exactly to the workers (tuples, int keys),
+    # and the subsystems keep their connections:
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    out = blocks.Sink('out', parent=root)
+    first, last = lag_chain(root, [(1, 1), (2, 1)], Lag)
+    first.params[1] = 'int key'
+    blocks.connect_systems(src, first)
+    blocks.connect_systems(last, out)
+    import pickle
+    sent = pickle.loads(transfer_func._pickle_detached(first))
+    assert_is(sent.parent, None)
+    assert_equal(list(sent.params), [1])
+    assert_is(type(sent.subsystems_dict['lag'].params['den']), tuple)
+    assert_true(sent.full_compare(first))
+    assert_is(first.parent, root)
+    assert_is(first.ports_dict['in'].wire, src.ports_dict['out'].wire)
+    # same reductions as in this process:
+    reductions = transfer_func._reduce_in_pool(root.subsystems, 'unlimited', 2)
+    assert_equal(len(reductions), 2)
+    for plant in (first, last):
+        key = transfer_func._reduction_key(plant, 'unlimited')
+        expr, var, in_var = reductions[key]
+        expr_seq, var, in_var_seq = transfer_func._reduce_task(plant, 'unlimited', {})
+        assert_equal(expr[0].subs(in_var[0], U[0]),
+                     expr_seq[0].subs(in_var_seq[0], U[0]))
+
+
+def test_signal_flow_graph():
+    '''signal flow graph reduction versus the linear engine'''
+    root = closed_loop()
+    Y_sfg, Y, U = transfer_func.transfer_syst(root, method='sfg')
+    assert_equal([str(v) for v in Y], ['Y_out'])
+    Y_lin, Y, U = transfer_func.transfer_syst(root, method='linear')
+    s = symbols('s')
+    for s_val in [1j, 0.5+2j, 10]:
+        H_lin = complex(Y_lin[0].subs({s: s_val, U[0]: 1}))
+        H_sfg = complex(Y_sfg[0].subs({s: s_val, U[0]: 1}))
+        assert_true(abs(H_lin - H_sfg) < 1e-12)
+    # subclasses of the LTI blocks have the same model in all the engines:
+    class Gain(blocks.TransferFunction):
+        pass
+    root = closed_loop(nested=False)
+    plant = root.subsystems_dict['plant']
+    gain = Gain('gain', [2], [1], root)
+    plant.ports_dict['out'].wire.connect_port(gain.ports_dict['in'])
+    blocks.connect_systems(gain, blocks.Sink('out2', parent=root))
+    Y_solve, Y, U = transfer_func.transfer_syst(root)
+    for method in ['sfg', 'linear']:
+        Y_m, Y, U = transfer_func.transfer_syst(root, method=method)
+        for y_solve, y_m in zip(Y_solve, Y_m):
+            assert_equal(sympy.simplify(y_solve - y_m), 0)
+    assert_equal(sympy.simplify(Y_solve[1] - 2*Y_solve[0]), 0)
+
+    # generic blocks, in a feedback loop:
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    g = blocks.SISOSystem('G', root)
+    h = blocks.SISOSystem('H', root)
+    comp = blocks.Summation('compare', ops = ['+','-'], parent = root)
+    out = blocks.Sink('out', parent=root)
+    blocks.connect_systems(src, comp, d_pname='in0')
+    blocks.connect_systems(comp, g)
+    blocks.connect_systems(g, h)
+    blocks.connect_systems(h, comp, d_pname='in1')
+    blocks.connect_systems(g, out)
+    Y_sfg, Y, U = transfer_func.transfer_syst(root, method='sfg')
+    G, H = symbols('TF_G TF_H')
+    assert_equal(sympy.simplify(Y_sfg[0] - G*U[0]/(1 + G*H)), 0)
+
+    # only the gains of the paths through a loop are simplified:
+    src2 = blocks.Source('src2', root)
+    lag1 = blocks.TransferFunction('lag1', [1], [1, 1], root)
+    lag2 = blocks.TransferFunction('lag2', [1], [2, 1], root)
+    out2 = blocks.Sink('out2', parent=root)
+    blocks.connect_systems(src2, lag1)
+    blocks.connect_systems(lag1, lag2)
+    blocks.connect_systems(lag2, out2)
+    Y_sfg, Y, U = transfer_func.transfer_syst(root, method='sfg')
+    assert_equal([str(v) for v in Y], ['Y_out', 'Y_out2'])
+    assert_equal(sympy.simplify(Y_sfg[0] - G*U[0]/(1 + G*H)), 0)
+    assert_equal(Y_sfg[1], U[1]/((s + 1)*(s + 2)))
+
+    # singular algebraic loop: y = u + y
+    root = blocks.System('root')
+    src = blocks.Source('src', root)
+    comp = blocks.Summation('sum', ops = ['+','+'], parent = root)
+    gain = blocks.TransferFunction('gain', [1], [1], root)
+    blocks.connect_systems(src, comp, d_pname='in0')
+    blocks.connect_systems(comp, gain)
+    blocks.connect_systems(gain, comp, d_pname='in1')
+    with assert_raises(ValueError):
+        transfer_func.transfer_syst(root, method='sfg')
+
+
+def test_debug_logging():
+    '''equations of the reductions logged at the debug level'''
+    import logging
+    records = []
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+    logger = logging.getLogger('transfer_func')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    try:
+        transfer_func.transfer_syst(closed_loop())
+        # debug messages are not created by default:
+        assert_equal([r for r in records if r.levelno == logging.DEBUG], [])
+        logger.setLevel(logging.DEBUG)
+        transfer_func.clear_reduction_cache()
+        transfer_func.transfer_syst(closed_loop())
+        messages = [r.getMessage() for r in records]
+        assert_true(any(m.startswith('equations of root: ') for m in messages))
+        assert_true(any(m.startswith('solution of plant: ') for m in messages))
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Test the instrumentation of the core operations
+"""
+
+from nose.tools import assert_equal, assert_true, assert_false
+
+# Import sysdiag:
+import sys
+try:
+    import blocks
+    import transfer_func
+    import profiling
+except ImportError:
+    sys.path.append('..')
+    import blocks
+    import transfer_func
+    import profiling
+
+from diagrams import closed_loop
+
+
+def test_profile():
+    '''counters, timers and per subsystem report'''
+    transfer_syst = transfer_func.transfer_syst
+    transfer_func.clear_reduction_cache()
+    with profiling.profile() as report:
+        assert_true(profiling.enabled())
+        root = closed_loop()
+        transfer_func.transfer_syst(root)
+        root.json_dump()
+    assert_false(profiling.enabled())
+    # the original functions are restored:
+    assert_true(transfer_func.transfer_syst is transfer_syst)
+    assert_true(blocks.System.add_subsystem is profiling._original('sysdiag', 'System', 'add_subsystem'))
+    
+    assert_equal(report.counts['sysdiag.System.add_subsystem'], 6)
+    assert_equal(report.counts['sysdiag.connect_systems'], 5)
+    assert_equal(report.counts['sysdiag.System.json_dump'], 1)
+    # nested calls of transfer_syst are counted, but timed once:
+    assert_true(report.counts['transfer_func.transfer_syst'] > 1)
+    assert_true(0 < report.times['transfer_func.transfer_syst'] <= report.duration)
+    assert_equal(set(report.categories), set(['add', 'connect', 'serialize', 'solve']))
+    assert_equal(report.subsystems['root/plant'][0], 1)
+    assert_true('root/controller' in report.subsystems)
+    d = report.as_dict()
+    assert_equal(d['operations']['sysdiag.System.json_dump']['category'], 'serialize')
+    assert_true('root/plant' in str(report))
+    
+    # nested profiles:
+    with profiling.profile() as outer:
+        with profiling.profile() as inner:
+            blocks.System('s1')
+        blocks.System('s2', blocks.System('root'))
+    assert_false(profiling.enabled())
+    assert_equal(inner.counts, {})
+    assert_equal(outer.counts['sysdiag.System.add_subsystem'], 1)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Test the time-domain simulation of block diagrams
+"""
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+import numpy as np
+
+# Import sysdiag:
+import sys
+try:
+    import blocks
+    import simulation
+except ImportError:
+    sys.path.append('..')
+    import blocks
+    import simulation
+
+from diagrams import closed_loop
+
+
+def first_order():
+    '''Source -> 1/(1+s) -> Sink'''
+    r = blocks.System('root')
+    src = blocks.Source('src', r)
+    tf = blocks.TransferFunction('tf', [1], [1, 1], r)
+    out = blocks.Sink('out', r)
+    blocks.connect_systems(src, tf)
+    blocks.connect_systems(tf, out)
+    return r
+
+
+def test_tf_realization():
+    '''state-space realization of a transfer function'''
+    # (1 + 2s)/(3 + 4s + 5s^2)
+    A, B, C, D = simulation.tf_realization([1, 2], [3, 4, 5])
+    s = 0.3 + 2j
+    H = C.dot(np.linalg.solve(s*np.eye(2) - A, B)) + D
+    assert_true(abs(H[0,0] - (1 + 2*s)/(3 + 4*s + 5*s**2)) < 1e-12)
+    # Improper transfer function:
+    with assert_raises(ValueError):
+        simulation.tf_realization([1, 2], [1])
+
+
+def test_step_response():
+    '''step and free responses of a first order system'''
+    t = np.linspace(0, 5, 501)
+    y, out_names, in_names = simulation.simulate(first_order(), t, np.ones(501))
+    assert_equal(in_names, ['U_src'])
+    assert_equal(out_names, ['Y_out'])
+    assert_true(np.allclose(y[0], 1 - np.exp(-t), atol=1e-12))
+
+    model = simulation.StateSpaceModel(first_order())
+    y, x = model.simulate(t, x0=[1.])
+    assert_true(np.allclose(y[0], np.exp(-t), atol=1e-12))
+    # adaptive step solver:
+    y, x = model.simulate(t, np.ones(501), method='RK45', rtol=1e-9, atol=1e-12)
+    assert_true(np.allclose(y[0], 1 - np.exp(-t), atol=1e-7))
+
+
+def test_high_order():
+    '''zoh simulation of a chain of second order blocks (8 states)'''
+    r = blocks.System('root')
+    prev = blocks.Source('src', r)
+    for i in range(4):
+        tf = blocks.TransferFunction('tf{}'.format(i), [1], [1, 1, 1], r)
+        blocks.connect_systems(prev, tf)
+        prev = tf
+    blocks.connect_systems(prev, blocks.Sink('out', r))
+    model = simulation.StateSpaceModel(r)
+    assert_equal(model.n_states, 8)
+    t = np.linspace(0, 30, 10001)
+    u = np.ones(10001)
+    y_zoh, x = model.simulate(t, u)
+    y_ivp, x = model.simulate(t, u, method='LSODA', rtol=1e-10, atol=1e-12)
+    assert_true(np.allclose(y_zoh, y_ivp, atol=1e-6))
+    # free response, versus the plain recursion:
+    import scipy.linalg
+    x0 = np.arange(8.)
+    y, x = model.simulate(t[:500], x0=x0)
+    Ad = scipy.linalg.expm(model.A*(t[1] - t[0]))
+    x_k = x0
+    for k in range(500):
+        assert_true(np.allclose(x[:, k], x_k, atol=1e-12))
+        x_k = Ad.dot(x_k)
+
+
+def pi_loop(K=1., Ti=10.):
+    '''PI control K(1 + 1/(Ti s)) of an integrator'''
+    return closed_loop([K, K*Ti], [0, Ti], nested=False)
+
+
+def test_closed_loop():
+    '''PI control of an integrator, with an algebraic loop'''
+    model = simulation.StateSpaceModel(pi_loop(1., 0.1))
+    assert_equal(model.n_states, 2)
+    t = np.linspace(0, 10, 1001)
+    y_zoh, x = model.simulate(t, np.ones(1001))
+    y_ivp, x = model.simulate(t, np.ones(1001), method='LSODA',
+                              rtol=1e-10, atol=1e-12)
+    assert_true(np.allclose(y_zoh, y_ivp, atol=1e-7))
+    # zero steady state error:
+    assert_true(abs(y_zoh[0,-1] - 1) < 1e-2)
+
+    # Singular algebraic loop: y = u + y
+    r = blocks.System('root')
+    src = blocks.Source('src', r)
+    comp = blocks.Summation('sum', ops = ['+','+'], parent = r)
+    gain = blocks.TransferFunction('gain', [1], [1], r)
+    blocks.connect_systems(src, comp, d_pname='in0')
+    blocks.connect_systems(comp, gain)
+    blocks.connect_systems(gain, comp, d_pname='in1')
+    with assert_raises(ValueError):
+        simulation.StateSpaceModel(r)
+
+
+def test_simulate_batch():
+    '''batch simulation of a sweep of PI gains'''
+    gains = [(0.5, 2.), (1., 5.), (2., 10.), (4., 1.)]
+    params = {'controller': {'num': [[K, K*Ti] for K, Ti in gains],
+                             'den': [[0, Ti] for K, Ti in gains]}}
+    t = np.linspace(0, 10, 201)
+    u = np.ones(201)
+    y, out_names, in_names = simulation.simulate_batch(pi_loop(), t, params, u)
+    assert_equal(y.shape, (4, 1, 201))
+    assert_equal(out_names, ['Y_out'])
+    for k, (K, Ti) in enumerate(gains):
+        y_k, out_names, in_names = simulation.simulate(pi_loop(K, Ti), t, u)
+        assert_true(np.allclose(y[k], y_k, atol=1e-10))
+    # initial states of each variant:
+    model = simulation.StateSpaceModel(pi_loop(), params)
+    x0 = np.arange(8.).reshape(4, 2)
+    y_x0, x = model.simulate(t, u, x0)
+    for k, (K, Ti) in enumerate(gains):
+        y_k, x_k = simulation.StateSpaceModel(pi_loop(K, Ti)).simulate(t, u, x0[k])
+        assert_true(np.allclose(x[k], x_k, atol=1e-10))
+    # adaptive step solver:
+    y_ivp, out_names, in_names = simulation.simulate_batch(pi_loop(), t, params, u,
+                                 method='LSODA', rtol=1e-10, atol=1e-12)
+    assert_true(np.allclose(y, y_ivp, atol=1e-7))
+    # worker processes:
+    y_pool, out_names, in_names = simulation.simulate_batch(pi_loop(), t, params, u,
+                                  processes=2)
+    assert_true(np.allclose(y, y_pool, atol=1e-12))
+    # Inconsistent batch sizes:
+    params['controller']['den'] = [[0, 1]]*3
+    with assert_raises(ValueError):
+        simulation.simulate_batch(pi_loop(), t, params, u)
@@ -29,6 +29,29 @@ def test_create_name():
     # 3) when the basename is already taken
     assert_equal(create(['a'],'a'), 'a0')
     assert_equal(create(['a', 'a0'],'a'), 'a1')
+    # 4) with a counter memory:
+    counters = {}
+    assert_equal(create({'a', 'a0'}, 'a', counters), 'a1')
+    assert_equal(create({'a', 'a0', 'a1', 'a2'}, 'a', counters), 'a3')
+    assert_equal(counters, {'a': 3})
+
+def test_system_create_name():
+    '''automatic naming of wires within a System'''
+    r = sysdiag.System('root')
+    names = []
+    for i in range(5):
+        w = sysdiag.Wire(r.create_name('wire', 'W'), 'type1', parent=r)
+        names.append(w.name)
+    assert_equal(names, ['W', 'W0', 'W1', 'W2', 'W3'])
+    # a name not yet used is returned again:
+    assert_equal(r.create_name('wire', 'W'), 'W4')
+    assert_equal(r.create_name('wire', 'W'), 'W4')
+    # manually added names are honoured:
+    sysdiag.Wire('W4', 'type1', parent=r)
+    sysdiag.Wire('W5', 'type1', parent=r)
+    assert_equal(r.create_name('wire', 'W'), 'W6')
+    # categories are independent:
+    assert_equal(r.create_name('subsystem', 'W'), 'W')
 
 def test_is_similar():
     '''check the similarity test of Ports and Wires'''
@@ -75,6 +98,97 @@ def test_system_eq():
     assert_true(not s1 == s2)
     assert_true(s1 != s2)
 
+    # Hierarchical systems:
+    def hierarchy(value):
+        root = sysdiag.System('root')
+        s = sysdiag.System('s', root)
+        s.add_port(sysdiag.Port('p', 'type1'))
+        ss = sysdiag.System('ss', s)
+        ss.add_port(sysdiag.Port('p', 'type1'))
+        ss.params['k'] = value
+        w = sysdiag.Wire('w', 'type1', s)
+        w.connect_by_name('s', 'p', 'parent')
+        w.connect_by_name('ss', 'p')
+        return root
+    r1, r2 = hierarchy(1), hierarchy(1)
+    assert_equal(r1, r2)
+    assert_true(r1.full_compare(r2))
+    # hashes are cached, and invalidated up to the root on modifications:
+    h1 = r1.structural_hash()
+    assert_is(r1._structural_hash, h1)
+    assert_equal(r2.structural_hash(), h1)
+    assert_equal(r1, r2)
+    ss = r1.subsystems[0].subsystems[0]
+    ss.params['k'] = 2
+    assert_is(r1._structural_hash, None)
+    assert_true(r1 != r2)
+    assert_true(not r1.full_compare(r2))
+    ss.params = {'k': 1}
+    assert_equal(r1, r2)
+    ss.name = 'ss1'
+    assert_true(r1 != r2)
+    ss.name = 'ss'
+    sysdiag.Wire('w2', 'type1', r1.subsystems[0])
+    assert_true(r1 != r2)
+    assert_true(not r1.full_compare(r2))
+
+    # params are compared exactly, as in full_compare:
+    assert_equal(hierarchy(1), hierarchy(1.0))
+    assert_true(hierarchy([1, 2]) != hierarchy((1, 2)))
+    import numpy as np
+    a = np.arange(5000)
+    b = a.copy()
+    b[2500] = -1
+    assert_equal(hierarchy(a), hierarchy(a.copy()))
+    assert_true(hierarchy(a) != hierarchy(b))
+    assert_true(hierarchy(a) != hierarchy(a.astype(float)))
+    assert_true(hierarchy({1: 2}) != hierarchy({'1': 2}))
+    assert_equal(hierarchy({1: 2, 'a': 3}), hierarchy({1.0: 2, 'a': 3}))
+    # the hash is exact for sympy objects and numbers, which are
+    # compared by their exact value, and not equal to sympy numbers:
+    import sympy
+    from fractions import Fraction
+    x, x_pos = sympy.Symbol('x'), sympy.Symbol('x', positive=True)
+    assert_equal(hierarchy(x), hierarchy(sympy.Symbol('x')))
+    assert_true(hierarchy(x) != hierarchy(x_pos))
+    assert_true(hierarchy(sympy.Rational(1, 3)) != hierarchy(1/3))
+    assert_true(hierarchy(1/3) != hierarchy(sympy.Rational(1, 3)))
+    assert_true(hierarchy(sympy.Integer(1)) != hierarchy(1))
+    assert_equal(hierarchy(Fraction(1, 2)), hierarchy(0.5))
+    assert_true(hierarchy(Fraction(1, 3)) != hierarchy(1/3))
+    assert_true(hierarchy(np.float32(0.1)) != hierarchy(0.1))
+    assert_equal(hierarchy(np.float32(0.5)), hierarchy(0.5))
+    assert_equal(hierarchy(1+0j), hierarchy(1))
+    def hashed(value):
+        root = hierarchy(value)
+        root.structural_hash()
+        return root
+    assert_equal(hashed(x), hashed(x))
+    assert_true(hashed(x)._hash_exact)
+    assert_true(hashed(x) != hashed(x_pos))
+    assert_true(hashed(sympy.Rational(1, 3)) != hashed(1/3))
+    assert_equal(hashed(Fraction(1, 2)), hashed(0.5))
+    # NaN makes the hash inexact: equal hashes are confirmed by full_compare
+    r1, r2 = hashed(float('nan')), hashed(float('nan'))
+    assert_equal(r1.structural_hash(), r2.structural_hash())
+    assert_true(not r1._hash_exact)
+    assert_true(r1 != r2)
+    # in-place modifications are not tracked by the hash:
+    r1, r2 = hierarchy([1, 2]), hierarchy([1, 2])
+    assert_equal(r1, r2)
+    r1.subsystems[0].subsystems[0].params['k'][0] = 5
+    assert_true(not r1.full_compare(r2))
+
+    # the order of the connections of a wire matters for the equality
+    # and for the structural hash, but not for diff:
+    r1, r2 = hierarchy(1), hierarchy(1)
+    w = r2.subsystems[0].wires[0]
+    w.ports.reverse()
+    assert_true(r1.structural_hash() != r2.structural_hash())
+    assert_true(r1 != r2)
+    assert_true(not r1.full_compare(r2))
+    assert_equal(sysdiag.diff(r1, r2), [])
+
 
 def test_is_empty():
     '''test definition of the *emptyness* of a System'''
@@ -129,6 +243,96 @@ def test_add_ports():
     with assert_raises(ValueError):
         r.add_port(p11)
 
+def test_name_indexes():
+    '''check that the name indexes follow additions and deletions'''
+    r = sysdiag.System('root')
+    s1 = sysdiag.System('s1', parent=r)
+    w1 = sysdiag.Wire('w1', 'type1', parent=r)
+    p1 = sysdiag.Port('p1', 'type1')
+    r.add_port(p1)
+    assert_is(r.subsystems_dict['s1'], s1)
+    assert_is(r.wires_dict['w1'], w1)
+    assert_is(r.ports_dict['p1'], p1)
+    # deletion of a port frees its name:
+    r.del_port(p1)
+    assert 'p1' not in r.ports_dict
+    p1a = sysdiag.Port('p1', 'type2')
+    r.add_port(p1a)
+    assert_is(r.ports_dict['p1'], p1a)
+    # duplicate names are still rejected:
+    with assert_raises(ValueError):
+        sysdiag.System('s1', parent=r)
+    with assert_raises(ValueError):
+        sysdiag.Wire('w1', 'type1', parent=r)
+
+def test_rename():
+    '''renaming a subsystem updates the name index of its parent'''
+    r = sysdiag.System('root')
+    s = sysdiag.System('a', parent=r)
+    sysdiag.System('c', parent=r)
+    s.name = 'b'
+    assert_equal(sorted(r.subsystems_dict), ['b', 'c'])
+    assert_is(r.subsystems_dict['b'], s)
+    # the new name is taken, the old one is free:
+    with assert_raises(ValueError):
+        sysdiag.System('b', parent=r)
+    sysdiag.System('a', parent=r)
+    # renaming to an existing name is rejected:
+    with assert_raises(ValueError):
+        s.name = 'c'
+    assert_equal(s.name, 'b')
+    assert_equal(r.subsystems_dict['c'].name, 'c')
+
+def test_rename_port_wire():
+    '''renaming a port or a wire updates the name index of its system'''
+    r = sysdiag.System('root')
+    p = sysdiag.Port('a', 'type1')
+    r.add_port(p)
+    r.add_port(sysdiag.Port('c', 'type1'))
+    p.name = 'b'
+    assert_equal(sorted(r.ports_dict), ['b', 'c'])
+    assert_is(r.ports_dict['b'], p)
+    with assert_raises(ValueError):
+        p.name = 'c'
+    assert_equal(p.name, 'b')
+    r.del_port(p)
+    assert_equal(sorted(r.ports_dict), ['c'])
+
+    w = sysdiag.Wire('w', 'type1', parent=r)
+    sysdiag.Wire('y', 'type1', parent=r)
+    w.name = 'x'
+    assert_equal(sorted(r.wires_dict), ['x', 'y'])
+    assert_is(r.wires_dict['x'], w)
+    # the old name is free:
+    sysdiag.Wire('w', 'type1', parent=r)
+    with assert_raises(ValueError):
+        w.name = 'y'
+    assert_equal(w.name, 'x')
+
+def test_rename_hash():
+    '''renaming or retyping a port or a wire invalidates the hashes'''
+    def syst(w_name):
+        r = sysdiag.System('root')
+        s = sysdiag.System('s', parent=r)
+        s.add_port(sysdiag.Port('p', 'type1'))
+        w = sysdiag.Wire(w_name, 'type1', parent=r)
+        w.connect_by_name('s', 'p')
+        return r
+    a, b = syst('w'), syst('v')
+    assert_true(a != b)
+    b.wires[0].name = 'w'
+    assert_equal(a, b)
+    assert_equal(sysdiag.diff(a, b), [])
+    b.wires[0].type = 'type2'
+    assert_true(a != b)
+    b.wires[0].type = 'type1'
+    port = b.subsystems[0].ports[0]
+    port.name = 'q'
+    assert_true(a != b)
+    port.name = 'p'
+    port.type = 'type2'
+    assert_true(a != b)
+
 def test_connect_port():
     '''check the connect_port method of Wire'''
     r = sysdiag.System('root')
@@ -147,7 +351,17 @@ def test_connect_port():
     # wire connection that works:
     w1.connect_port(p1)
     assert_is(p1.wire, w1)
-    
+    # connecting it again does nothing:
+    w1.connect_port(p1)
+    assert_equal(w1.ports, [p1])
+    # a port of the parent, connected inside:
+    p_r = sysdiag.Port('p_r', 'type1')
+    r.add_port(p_r)
+    w1.connect_port(p_r, 'parent')
+    w1.connect_port(p_r, 'parent')
+    assert_equal(w1.ports, [p1, p_r])
+    assert_is(p_r.internal_wire, w1)
+
     # failure if a port is already taken:
     with assert_raises(ValueError):
         w2.connect_port(p1)
@@ -259,3 +473,113 @@ def test_from_json():
       "type": ""
     }'''
     # TODO: implement from_json classmethods
+
+def test_connect_ports():
+    '''check the bulk connection of Ports with connect_ports'''
+    r = sysdiag.System('root')
+    s1 = sysdiag.System('s1', parent=r)
+    s2 = sysdiag.System('s2', parent=r)
+    p1 = sysdiag.OutputPort('p1', 'type1')
+    p2 = sysdiag.InputPort('p2', 'type1')
+    p3 = sysdiag.OutputPort('p3', 'type1')
+    s1.add_port(p1)
+    s2.add_port(p2)
+    s2.add_port(p3)
+    p_r = sysdiag.InputPort('p_r', 'type1')
+    r.add_port(p_r)
+
+    w1 = sysdiag.SignalWire('w1', parent=r)
+    w1.connect_ports([(p1, 'sibling'), (p2, 'sibling'), (p2, 'sibling')])
+    assert_equal(w1.ports, [p1, p2])
+    assert_is(p2.wire, w1)
+
+    # Only one output port can be connected to a SignalWire,
+    # and nothing is connected on failure:
+    w2 = sysdiag.SignalWire('w2', parent=r)
+    with assert_raises(ValueError):
+        w2.connect_ports([(p3, 'sibling'), (p_r, 'parent')])
+    assert_equal(w2.ports, [])
+    assert_is(p3.wire, None)
+    with assert_raises(ValueError):
+        w1.connect_ports([(p3, 'sibling')])
+    with assert_raises(ValueError):
+        w2.connect_ports([(p3, 'nowhere')])
+
+    # the validation of Wire subclasses is used:
+    class ReadOnlyWire(sysdiag.SignalWire):
+        def is_connect_allowed(self, port, port_level, raise_error=False):
+            if raise_error:
+                raise ValueError('read-only wire')
+            return False
+    w3 = ReadOnlyWire('w3', parent=r)
+    with assert_raises(ValueError):
+        w3.connect_ports([(p3, 'sibling')])
+    assert_equal(w3.ports, [])
+    # subclasses which do not override is_connect_allowed are checked
+    # like SignalWire:
+    class NamedWire(sysdiag.SignalWire):
+        pass
+    w4 = NamedWire('w4', parent=r)
+    with assert_raises(ValueError):
+        w4.connect_ports([(p3, 'sibling'), (p_r, 'parent')])
+    assert_equal(w4.ports, [])
+    w4.connect_ports([(p3, 'sibling')])
+    assert_equal(w4.ports, [p3])
+
+
+def test_diff():
+    '''structural differences between two diagrams'''
+    def diagram():
+        r = sysdiag.System('root')
+        for name in ['s1', 's2']:
+            s = sysdiag.System(name, parent=r)
+            s.add_port(sysdiag.Port('p', 'type1'))
+            ss = sysdiag.System('ss', parent=s)
+            ss.add_port(sysdiag.Port('p', 'type1'))
+            ss.params['k'] = 1
+            w = sysdiag.Wire('w', 'type1', parent=s)
+            w.connect_by_name(name, 'p', 'parent')
+            w.connect_by_name('ss', 'p')
+        return r
+    r1, r2 = diagram(), diagram()
+    assert_equal(sysdiag.diff(r1, r2), [])
+
+    s2 = r2.subsystems_dict['s2']
+    s2.subsystems_dict['ss'].params['k'] = 2
+    s2.subsystems_dict['ss'].params['new'] = 'a'
+    s2.add_port(sysdiag.Port('q', 'type2'))
+    sysdiag.System('s3', parent=r2)
+    del r1.subsystems_dict['s2'].subsystems_dict['ss'].params['k']
+    changes = [(d.change, d.category, d.path) for d in sysdiag.diff(r1, r2)]
+    assert_equal(changes, [('added', 'system', 's3'),
+                           ('added', 'port', 's2/q'),
+                           ('added', 'param', 's2/ss/k'),
+                           ('added', 'param', 's2/ss/new')])
+    d = sysdiag.diff(r2, r1)
+    assert_equal(d[0], sysdiag.Difference('removed', 'system', 's3',
+                                          r2.subsystems_dict['s3'], None))
+
+    r1.subsystems_dict['s2'].subsystems_dict['ss'].params['k'] = 3
+    d = sysdiag.diff(r1, r2)
+    assert_equal(d[2], ('modified', 'param', 's2/ss/k', 3, 2))
+    # wires:
+    w = sysdiag.Wire('w', 'type1', parent=r2)
+    w.connect_by_name('s1', 'p')
+    w1 = sysdiag.Wire('w', 'type1', parent=r1)
+    w1.connect_by_name('s2', 'p')
+    d = sysdiag.diff(r1, r2)
+    assert_equal(d[0], sysdiag.Difference('modified', 'wire', 'w',
+                                          [('s2', 'p')], [('s1', 'p')]))
+    # params with equal but not exact hashes are compared:
+    import sympy
+    for k1, k2 in [(sympy.Rational(1, 3), 1/3),
+                   (sympy.Symbol('k'), sympy.Symbol('k', positive=True)),
+                   (set([1, 2]), set([1, 3]))]:
+        r1, r2 = diagram(), diagram()
+        r1.subsystems_dict['s1'].subsystems_dict['ss'].params['k'] = k1
+        r2.subsystems_dict['s1'].subsystems_dict['ss'].params['k'] = k2
+        d = sysdiag.diff(r1, r2)
+        assert_equal(d, [('modified', 'param', 's1/ss/k', k1, k2)])
+    r2.subsystems_dict['s1'].subsystems_dict['ss'].params['k'] = set([1, 2])
+    assert_true(not r1._hash_exact)
+    assert_equal(sysdiag.diff(r1, r2), [])
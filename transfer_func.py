@@ -8,74 +8,208 @@ Pierre Haessig — September 2013
 """
 
 from __future__ import division, print_function
+from collections import OrderedDict, namedtuple
+import logging
+import numpy as np
 import sympy
 from sympy import symbols, Eq
 
 import blocks
+import graph
 
-def laplace_output(syst, input_var):
-    '''Laplace tranform of the output of the block `syst`.
+logger = logging.getLogger(__name__)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class _LRUCache(object):
+    '''Least Recently Used cache, with hit and miss statistics'''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
     
-    The list of input variables should match the list of input ports.
+    def get(self, key):
+        '''cached value for `key` (None if not cached)'''
+        value = self._data.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data[key] = value # most recently used
+        return value
+    
+    def __contains__(self, key):
+        '''True if `key` is cached (not counted in the statistics)'''
+        return key in self._data
+    
+    def put(self, key, value):
+        self._data[key] = value
+        self.trim()
+    
+    def trim(self):
+        '''remove the least recently used values above `maxsize`'''
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+    
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+    
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Reductions of subsystems by `transfer_syst`, keyed on their structure:
+_reduction_cache = _LRUCache()
+
+def reduction_cache_info():
+    '''statistics of the cache of subsystem reductions (see `transfer_syst`):
+    CacheInfo(hits, misses, maxsize, currsize)'''
+    return _reduction_cache.info()
+
+def clear_reduction_cache():
+    '''empty the cache of subsystem reductions and reset its statistics'''
+    _reduction_cache.clear()
+
+def set_reduction_cache_size(maxsize):
+    '''set the maximum number of cached subsystem reductions
+    (0 disables the cache)'''
+    _reduction_cache.maxsize = maxsize
+    _reduction_cache.trim()
+
+def block_gains(syst):
+    '''Laplace transfer functions of the block `syst`, from each input port
+    to each output port, as a list (one item per output) of lists
+    (one gain per input).
+    
+    * Summation: gains ±1 given by the operators
+    * TransferFunction: num(s)/den(s)
+    * generic IO block: symbols 'TF_<name>' (with the port names
+      appended for blocks with several inputs or outputs)
     '''
     in_ports  = [p for p in syst.ports if p.direction=='in']
     out_ports = [p for p in syst.ports if p.direction=='out']
     n_in = len(in_ports)
     n_out = len(out_ports)
-    assert len(input_var) == n_in
-
-    ### Model the system of the block
-    output_expr = []
     
-    # 1) Model a Summation block:
-    if type(syst) is blocks.Summation:
-        sum_terms = []
-        for op, var in zip(syst._operators, input_var):
+    # 1) Model a Summation block:
+    if isinstance(syst, blocks.Summation):
+        gains = []
+        for op in syst._operators:
             if op == '+':
-                sum_terms.append(+var)
+                gains.append(sympy.S.One)
             elif op == '-':
-                sum_terms.append(-var)
+                gains.append(-sympy.S.One)
             else:
                 raise ValueError('unknow operator')
-        # end for
-        output_expr.append(sympy.Add(*sum_terms))
-
-    # 2) Model a TransferFunction block:
-    elif type(syst) is blocks.TransferFunction:
+        # end for
+        return [gains]
+    
+    # 2) Model a TransferFunction block:
+    elif isinstance(syst, blocks.TransferFunction):
         assert n_in == 1
         num = syst.params['num']
         den = syst.params['den']
-        # Convert to Laplace:
+        # Convert to Laplace:
         s = symbols('s')
         num_s = [n*s**i for i,n in enumerate(num)]
         den_s = [d*s**i for i,d in enumerate(den)]
         TF = sympy.Add(*num_s)/sympy.Add(*den_s)
-        output_expr.append(TF*input_var[0])
-
+        return [[TF]]
+    
     # Model a generic IO block:
-    else:
-        for p_out in out_ports:
-            out = 0
-            for p_in, var in zip(in_ports, input_var):
-                # Generate a symbol with an *hopefully* unique name:
-                TF_name = 'TF_{}'.format(syst.name)
-                if n_in > 1 or n_out>1:
-                    TF_name += '{}_{}'.format(p_in.name, p_out.name)
-                TF = symbols(TF_name)
-                out += TF*var
-            output_expr.append(out)
-            # end for each input
-        # end for each ouput
+    gains = []
+    for p_out in out_ports:
+        row = []
+        for p_in in in_ports:
+            # Generate a symbol with an *hopefully* unique name:
+            TF_name = 'TF_{}'.format(syst.name)
+            if n_in > 1 or n_out>1:
+                TF_name += '{}_{}'.format(p_in.name, p_out.name)
+            row.append(symbols(TF_name))
+        gains.append(row)
+    return gains
+# end block_gains
 
+def laplace_output(syst, input_var):
+    '''Laplace tranform of the output of the block `syst`.
+    
+    The list of input variables should match the list of input ports.
+    '''
+    in_ports  = [p for p in syst.ports if p.direction=='in']
+    assert len(input_var) == len(in_ports)
+    
+    output_expr = [sympy.Add(*[gain*var for gain, var in zip(gains, input_var)])
+                   for gains in block_gains(syst)]
     return output_expr
 # end laplace_output
 
-def transfer_syst(syst, input_var=None, depth='unlimited'):
+def transfer_syst(syst, input_var=None, depth='unlimited', method='solve',
+                  check_loops=False, processes=None):
     '''Compute the transfer function of `syst`
     
-    Returns `output_expr`, `output_var`
+    Returns `output_expr`, `output_var`, `input_var`
     `output_var` is of length n_out + number of internal sink blocks
+    
+    `method` is either:
+    * 'solve' (default): the equations of each level of the hierarchy
+      are solved with `sympy.solve`
+    * 'linear': the flattened diagram is assembled as a sparse linear system
+      in the Laplace variable (see `LinearModel`) which is solved by
+      sparse Gaussian elimination. Only for LTI diagrams (Summation and
+      TransferFunction blocks) with `depth` 'unlimited'.
+    * 'sfg': the flattened diagram is reduced as a signal flow graph
+      (see `SignalFlowGraph`), by eliminating the signals one by one
+      on the transfer functions of the blocks. With `depth` 'unlimited'.
+    
+    With the 'solve' method, the reductions of the subsystems are memoized
+    on their structure, so that replicated subsystems are solved only once
+    (see `reduction_cache_info`).
+    
+    When `input_var` is None, the result is cached on `syst` until the diagram
+    is modified (see `System._cached_analysis`): after a local edit, only
+    the subsystems on the path from the edited block to `syst` are reduced again.
+    
+    if `check_loops` is True, an AlgebraicLoopError is raised before
+    solving if the flattened diagram has algebraic loops (see `graph`).
+    
+    if `processes` is not None, the distinct subsystems which are not yet
+    in the reduction cache are reduced concurrently by a pool of `processes`
+    worker processes ('solve' method only), level by level from the leaves
+    of the hierarchy (see `_reduce_in_pool`). The subsystems are pickled
+    to the workers, so their classes should be importable by their module name.
     '''
+    if check_loops:
+        graph.check_algebraic_loops(syst)
+    if input_var is None:
+        output_expr, output_var, input_var = syst._cached_analysis(
+            ('transfer_syst', depth, method),
+            lambda: _transfer_syst(syst, None, depth, method, processes))
+        return list(output_expr), list(output_var), list(input_var)
+    return _transfer_syst(syst, input_var, depth, method, processes)
+
+def _transfer_syst(syst, input_var, depth, method, processes=None,
+                   reductions=None):
+    '''transfer function of `syst` (see `transfer_syst`)
+    
+    `reductions` is an optional dict of the reductions of the subsystems
+    of `syst`, already computed (see `_reduce_in_pool`)'''
+    if method in ('linear', 'sfg'):
+        if depth != 'unlimited':
+            raise ValueError("method '{}' requires an unlimited depth".format(method))
+        model = LinearModel(syst) if method == 'linear' else SignalFlowGraph(syst)
+        if input_var is not None:
+            n_in = len([p for p in syst.ports if p.direction=='in'])
+            assert len(input_var) == n_in
+            input_var = list(input_var) + model.input_var[n_in:]
+        else:
+            input_var = model.input_var
+        output_expr = model.transfer_expr(input_var)
+        return output_expr, model.output_var, input_var
+    elif method != 'solve':
+        raise ValueError("Unknown method '{}'!".format(method))
+    
     # Analyze the IO Ports: of `syst`
     in_ports  = [p for p in syst.ports if p.direction=='in']
     out_ports = [p for p in syst.ports if p.direction=='out']
@@ -103,6 +237,10 @@ def transfer_syst(syst, input_var=None, depth='unlimited'):
     wires_var = {w:symbols('W_' + w.name) for w in syst.wires}
     
     # 2) Parse the subsystems
+    reductions = dict(reductions) if reductions else {}
+    if processes is not None and depth != 0:
+        sub_depth = 'unlimited' if depth=='unlimited' else (depth - 1)
+        reductions.update(_reduce_in_pool(syst.subsystems, sub_depth, processes))
     subsys_eqs = []
     for subsys in syst.subsystems:
         sub_depth = 'unlimited' if depth=='unlimited' \
@@ -134,10 +272,11 @@ def transfer_syst(syst, input_var=None, depth='unlimited'):
         
         else:
             # Recursive call:
-            sub_output_expr, sub_output_var, sub_input_var = transfer_syst(subsys,
-                                                    sub_var_in, depth=sub_depth)
+            sub_output_expr, sub_output_var, sub_input_var = _reduce_subsystem(subsys,
+                                        sub_var_in, sub_depth, reductions, processes)
             # TODO: manage extraneous output var/expressions
-            print(sub_output_var[n_out:])
+            logger.debug('extraneous outputs of %s: %s',
+                         subsys.name, sub_output_var[n_out:])
             # and extraneous input variables
             subsys_eqs.extend([Eq(var, tf) for var,tf in
                                zip(sub_var_out, sub_output_expr)])
@@ -147,26 +286,705 @@ def transfer_syst(syst, input_var=None, depth='unlimited'):
     for p, p_var in zip(in_ports, input_var):
         w = p.internal_wire
         if w is None:
-            print('Warning, input port {.name} is not internally connected'.format(p))
+            logger.warning('input port %s of %s is not internally connected',
+                           p.name, syst.name)
         subsys_eqs.append(Eq(wires_var[w], p_var))
     for p, p_var in zip(out_ports, output_var):
         w = p.internal_wire
         if w is None:
-            print('Warning, output port {.name} is not internally connected'.format(p))
+            logger.warning('output port %s of %s is not internally connected',
+                           p.name, syst.name)
         subsys_eqs.append(Eq(p_var, wires_var[w]))
     # TODO...
     #subsys_eqs.append(Eq())
     
     # Solve the equations:
-    print(subsys_eqs)
-    eqs_sol = sympy.solve(subsys_eqs, wires_var.values() + output_var)
-    print(eqs_sol)
+    # (the equations are only formatted if the debug level is enabled)
+    logger.debug('equations of %s: %s', syst.name, subsys_eqs)
+    eqs_sol = sympy.solve(subsys_eqs, list(wires_var.values()) + output_var)
+    logger.debug('solution of %s: %s', syst.name, eqs_sol)
     # filter out the wire variables
-    output_expr = [eqs_sol[var] for var in eqs_sol if var in output_var]
+    output_expr = [eqs_sol[var] for var in output_var if var in eqs_sol]
     
     return output_expr, output_var, input_var
 # end transfer_syst
 
+def _reduce_subsystem(subsys, input_var, depth, reductions=None, processes=None):
+    '''transfer function of the subsystem `subsys` (see `transfer_syst`)
+    
+    The reduction is memoized on the structure of `subsys`
+    (see `System.structural_hash`): it is computed once with placeholder
+    input variables, which are then substituted by `input_var`.
+    At `depth` 0, the name of `subsys` is also part of the key, since
+    its transfer function is then the symbol 'TF_<name>' (see `block_gains`).
+    The reduction is not memoized if the hash of `subsys` is not exact.
+    
+    `reductions` is an optional dict of reductions already computed
+    (see `_reduce_in_pool`) and `processes` the number of worker processes
+    for the reduction of the inner subsystems (see `transfer_syst`)
+    '''
+    if subsys.is_empty():
+        # blocks are modeled directly
+        return transfer_syst(subsys, input_var, depth=depth)
+    
+    n_in = len(input_var)
+    key = _reduction_key(subsys, depth)
+    cached = reductions.get(key) if reductions and key is not None else None
+    if cached is None:
+        if key is None or _reduction_cache.maxsize <= 0:
+            return transfer_syst(subsys, input_var, depth=depth,
+                                 processes=processes)
+        cached = _reduction_cache.get(key)
+    if cached is None:
+        cached = transfer_syst(subsys, _placeholders(n_in), depth=depth,
+                               processes=processes)
+        _reduction_cache.put(key, cached)
+    output_expr, output_var, cached_input = cached
+    
+    inputs = dict(zip(cached_input[:n_in], input_var))
+    output_expr = [expr.subs(inputs, simultaneous=True) for expr in output_expr]
+    # port output variables named after `subsys`:
+    out_ports = [p for p in subsys.ports if p.direction=='out']
+    output_var = [symbols('Y_{}_{}'.format(subsys.name, p.name)) for p in out_ports] +\
+                 output_var[len(out_ports):]
+    input_var.extend(cached_input[n_in:])
+    return output_expr, output_var, input_var
+
+def _reduction_key(subsys, depth):
+    '''key of the reduction of `subsys` in the reduction cache
+    (see `_reduce_subsystem`), None if the structural hash of `subsys`
+    is not exact (equal hashes then do not imply equal subsystems)'''
+    syst_hash = subsys.structural_hash()
+    if not subsys._hash_exact:
+        return None
+    if depth == 0:
+        return (syst_hash, depth, subsys.name)
+    return (syst_hash, depth)
+
+def _placeholders(n_in):
+    '''placeholder input variables for the reduction of a subsystem'''
+    return [sympy.Dummy('in{}'.format(i)) for i in range(n_in)]
+
+def _pickle_detached(subsys):
+    '''pickle of the System `subsys` without its parent system
+    nor the external wires of its ports (see `_reduce_in_pool`)'''
+    import pickle
+    parent = subsys.parent
+    port_wires = [p.wire for p in subsys.ports]
+    subsys.parent = None
+    for p in subsys.ports:
+        p.wire = None
+    try:
+        return pickle.dumps(subsys, pickle.HIGHEST_PROTOCOL)
+    finally:
+        subsys.parent = parent
+        for p, w in zip(subsys.ports, port_wires):
+            p.wire = w
+
+def _reduce_task(subsys, depth, sub_reductions):
+    '''reduction of `subsys` with placeholder inputs, given the reductions
+    of its inner subsystems `sub_reductions` (see `_reduce_in_pool`)'''
+    n_in = len([p for p in subsys.ports if p.direction=='in'])
+    return _transfer_syst(subsys, _placeholders(n_in), depth, 'solve',
+                          reductions=sub_reductions)
+
+def _reduce_pickled(args):
+    '''reduction of a pickled subsystem
+    (in a worker process, see `_reduce_in_pool`)'''
+    import pickle
+    data, depth, sub_reductions = args
+    return _reduce_task(pickle.loads(data), depth, sub_reductions)
+
+def _reduce_in_pool(subsystems, depth, processes):
+    '''reduces concurrently the distinct `subsystems`, and their own
+    subsystems down the hierarchy, which are not in the reduction cache,
+    with a pool of `processes` worker processes.
+    
+    The reductions are scheduled bottom-up, by levels: the subsystems of
+    one level are reduced concurrently, each worker receiving the reductions
+    of the inner subsystems from the previous levels.
+    
+    The subsystems are pickled (without their parent), so that their params
+    are sent exactly. The classes are pickled by reference, so that their
+    modules must be importable by the workers (e.g. with the 'spawn' start
+    method, they are imported again). The reductions (with placeholder
+    inputs) are pickled back, and stored in the reduction cache.
+    
+    Each distinct subsystem is looked up once in the reduction cache
+    (a hit, or a miss when it is reduced by the pool). The subsystems
+    which hash is not exact are not reduced by the pool (see `_reduction_key`),
+    but their own subsystems are.
+    No pool is started at `depth` 0, since the reductions are then
+    only the symbols 'TF_<name>' (see `block_gains`), nor for less than
+    two subsystems to reduce (which are then reduced in this process).
+    
+    Returns a dict {key: reduction} (see `_reduction_key`)
+    '''
+    if depth == 0:
+        return {} # trivial reductions
+    use_cache = _reduction_cache.maxsize > 0
+    reductions = {}
+    # subsystems to reduce, in post-order (inner subsystems first):
+    tasks = OrderedDict()
+    def visit(subsys, depth):
+        '''registers the reduction of `subsys` and of its subsystems,
+        returns its key (None if it is not to be reduced)'''
+        if depth == 0 or isinstance(subsys, (blocks.Source, blocks.Sink)) or \
+           subsys.is_empty():
+            return None
+        key = _reduction_key(subsys, depth)
+        if key is not None:
+            if key in tasks or key in reductions:
+                return key
+            cached = _reduction_cache.get(key) if use_cache else None
+            if cached is not None:
+                reductions[key] = cached
+                return key
+        sub_depth = 'unlimited' if depth=='unlimited' else (depth - 1)
+        sub_keys = set(visit(s, sub_depth) for s in subsys.subsystems)
+        sub_keys.discard(None)
+        if key is not None:
+            tasks[key] = (subsys, depth, sub_keys)
+        return key
+    for subsys in subsystems:
+        visit(subsys, depth)
+    
+    # levels: 0 for the tasks without inner tasks, and so on
+    levels = {}
+    for key, (subsys, sub_depth, sub_keys) in tasks.items():
+        levels[key] = 1 + max([levels[k] for k in sub_keys if k in levels] + [-1])
+    schedule = [[] for i in range(max(levels.values()) + 1)] if levels else []
+    for key, level in levels.items():
+        schedule[level].append(key)
+    
+    pool = None
+    if len(tasks) >= 2:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+    try:
+        for keys in schedule:
+            args = []
+            for key in keys:
+                subsys, sub_depth, sub_keys = tasks[key]
+                sub_reductions = {k: reductions[k] for k in sub_keys}
+                if pool is None:
+                    args.append((subsys, sub_depth, sub_reductions))
+                else:
+                    args.append((_pickle_detached(subsys), sub_depth,
+                                 sub_reductions))
+            if pool is None:
+                results = [_reduce_task(*a) for a in args]
+            else:
+                results = pool.map(_reduce_pickled, args)
+            for key, reduction in zip(keys, results):
+                reductions[key] = reduction
+                if use_cache:
+                    _reduction_cache.put(key, reduction)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return reductions
+
+
+class LinearModel(object):
+    '''Linear equations of the interconnection of an LTI block diagram
+    in the Laplace domain.
+    
+    The diagram `syst` is flattened (see `blocks.flatten`) and described by
+    
+        A(s)·x = B·u
+        y = x[output_index]
+    
+    with x the vector of signals, u the inputs and y the outputs.
+    
+    A(s) is a sparse matrix with polynomial entries, stored in COO format:
+    `A_row`, `A_col` and `A_poly`, which rows are the coefficients
+    of the polynomials in increasing powers of s (as `num` and `den` of
+    TransferFunction blocks). Each signal has one equation (row of A),
+    written by the block driving it:
+    
+    * Summation: x_out - sum(±x_in) = 0
+    * TransferFunction: den(s)·x_out - num(s)·x_in = 0
+    * inputs: x_in = u
+    
+    B has a single 1 in each column (stored as `B_row`).
+    '''
+    def __init__(self, syst):
+        leaves, signals, inputs, outputs = blocks.flatten(syst)
+        self.signals = signals
+        n = len(signals)
+        self.input_var = [symbols(name) for name, sig in inputs]
+        self.output_var = [symbols(name) for name, sig in outputs]
+        # output signals (-1 for unconnected outputs):
+        self.output_index = np.array([-1 if sig is None else sig
+                                      for name, sig in outputs], dtype=np.intp)
+        
+        entries = []
+        drivers = np.zeros(n, dtype=int)
+        B_row = []
+        for k, (name, sig) in enumerate(inputs):
+            B_row.append(-1 if sig is None else sig)
+            if sig is not None:
+                entries.append((sig, sig, [1]))
+                drivers[sig] += 1
+        
+        for block, in_sig, out_sig in leaves:
+            if isinstance(block, blocks.Summation):
+                in_coef = [[-1] if op == '+' else [1]
+                           for op in block._operators]
+                out_coef = [1]
+            elif isinstance(block, blocks.TransferFunction):
+                in_coef = [[-c for c in block.params['num']]]
+                out_coef = list(block.params['den'])
+            else:
+                raise ValueError('Block {} has no LTI model!'.format(repr(block)))
+            
+            out = out_sig[0]
+            if out is None:
+                continue # output is not used
+            drivers[out] += 1
+            entries.append((out, out, out_coef))
+            for sig, coef in zip(in_sig, in_coef):
+                if sig is not None:
+                    entries.append((out, sig, coef))
+        # end for each block
+        
+        not_driven = np.flatnonzero(drivers != 1)
+        if len(not_driven):
+            sig = not_driven[0]
+            raise ValueError('Signal of {} has {} sources (one expected)'.format(
+                             repr(signals[sig]), drivers[sig]))
+        
+        # Merge the entries at the same position (e.g. self loops):
+        merged = {}
+        for i, j, coef in entries:
+            if (i, j) in merged:
+                prev = merged[i, j]
+                n_max = max(len(prev), len(coef))
+                prev = list(prev) + [0]*(n_max - len(prev))
+                coef = list(coef) + [0]*(n_max - len(coef))
+                coef = [c1 + c2 for c1, c2 in zip(prev, coef)]
+            merged[i, j] = coef
+        entries = [(i, j, coef) for (i, j), coef in merged.items()]
+        
+        self.A_row = np.array([e[0] for e in entries], dtype=np.intp)
+        self.A_col = np.array([e[1] for e in entries], dtype=np.intp)
+        order = max(len(e[2]) for e in entries) if entries else 1
+        self.A_poly = np.zeros((len(entries), order))
+        for i, e in enumerate(entries):
+            self.A_poly[i, :len(e[2])] = e[2]
+        # coefficients with their original type, for the symbolic solution:
+        self._A_coef = [e[2] for e in entries]
+        self.B_row = np.array(B_row, dtype=np.intp)
+    # end __init__
+    
+    @property
+    def shape(self):
+        '''(number of signals, number of inputs, number of outputs)'''
+        return len(self.signals), len(self.input_var), len(self.output_var)
+    
+    def A_values(self, s):
+        '''values of the non-zero entries of A(s), for the complex
+        frequency `s` (scalar or array). The entries are along the first axis
+        
+        (Horner evaluation of all the polynomials at once)
+        '''
+        s = np.asarray(s)
+        values = np.zeros(self.A_poly.shape[:1] + s.shape,
+                          dtype=np.result_type(s, float))
+        poly = self.A_poly.reshape(self.A_poly.shape + (1,)*s.ndim)
+        for k in range(self.A_poly.shape[1]-1, -1, -1):
+            values = values*s + poly[:, k]
+        return values
+    
+    def matrices(self, s):
+        '''A(s) (scipy.sparse CSC matrix) and B (dense array)
+        evaluated at the complex frequency `s`
+        '''
+        import scipy.sparse
+        n, n_in, n_out = self.shape
+        A = scipy.sparse.csc_matrix((self.A_values(s), (self.A_row, self.A_col)),
+                                    shape=(n, n))
+        return A, self.B_dense()
+    
+    def B_dense(self):
+        '''input matrix B as a dense array'''
+        n, n_in, n_out = self.shape
+        B = np.zeros((n, n_in))
+        connected = self.B_row >= 0
+        B[self.B_row[connected], np.flatnonzero(connected)] = 1
+        return B
+    
+    def solve(self, s):
+        '''transfer matrix H(s), evaluated at the complex frequency `s`,
+        of shape (number of outputs, number of inputs)
+        '''
+        import scipy.sparse.linalg
+        n, n_in, n_out = self.shape
+        A, B = self.matrices(s)
+        X = scipy.sparse.linalg.splu(A).solve(B.astype(A.dtype))
+        H = np.zeros((n_out, n_in), dtype=X.dtype)
+        connected = self.output_index >= 0
+        H[connected] = X[self.output_index[connected]]
+        return H
+    
+    def frequency_response(self, omegas, max_memory=2**26):
+        '''transfer matrix H(jω) evaluated at all the angular frequencies
+        `omegas`, of shape (number of outputs, number of inputs, len(omegas))
+        
+        All the polynomials are evaluated at once over the frequency array
+        and the linear systems are solved as a batch of dense systems,
+        by chunks of frequencies which take at most about `max_memory` bytes.
+        When the dense system of a single frequency does not fit in
+        `max_memory`, the sparse system A(jω) is factored for each frequency
+        (see `solve`).
+        '''
+        omegas = np.asarray(omegas, dtype=float).ravel()
+        n, n_in, n_out = self.shape
+        n_freq = len(omegas)
+        H = np.zeros((n_out, n_in, n_freq), dtype=complex)
+        if n == 0 or n_freq == 0:
+            return H
+        values = self.A_values(1j*omegas) # shape (nnz, n_freq)
+        B = self.B_dense()
+        connected = self.output_index >= 0
+        out_index = self.output_index[connected]
+        
+        chunk = max_memory // (16*n*(n + n_in))
+        if chunk == 0:
+            import scipy.sparse
+            import scipy.sparse.linalg
+            B = B.astype(complex)
+            for k in range(n_freq):
+                A = scipy.sparse.csc_matrix((values[:, k], (self.A_row, self.A_col)),
+                                            shape=(n, n))
+                X = scipy.sparse.linalg.splu(A).solve(B)
+                H[connected, :, k] = X[out_index]
+            return H
+        for start in range(0, n_freq, chunk):
+            stop = min(start + chunk, n_freq)
+            A = np.zeros((stop-start, n, n), dtype=complex)
+            A[:, self.A_row, self.A_col] = values[:, start:stop].T
+            X = np.linalg.solve(A, np.broadcast_to(B, (stop-start, n, n_in)))
+            H[connected, :, start:stop] = X[:, out_index, :].transpose(1, 2, 0)
+        return H
+    
+    def transfer_expr(self, input_var=None):
+        '''symbolic expressions of the outputs, as functions of the
+        Laplace variable `s` and of the inputs `input_var`
+        (defaults to `self.input_var`)
+        
+        The linear system is solved by sparse Gaussian elimination, with
+        polynomial coefficients: the signals which are not outputs are
+        eliminated with their own equation (greedy order: the signal which
+        elimination updates the fewest entries first, as in
+        `SignalFlowGraph.reduce`), then the small system of the output
+        signals is solved by LU decomposition.
+        
+        As in `SignalFlowGraph.transfer_expr`, the products are kept factored:
+        the entries are simplified (`sympy.cancel`) only if they went through
+        a sum (e.g. of a loop), which cost grows with the degree of the
+        rational functions. For large diagrams with many loops, the method
+        'sfg' of `transfer_syst` is faster, and the numerical methods `solve`
+        and `frequency_response` much faster.
+        '''
+        import heapq
+        if input_var is None:
+            input_var = self.input_var
+        n, n_in, n_out = self.shape
+        s = symbols('s')
+        # sparse rows and columns of A, and rows of B (the right-hand side
+        # is kept as a matrix, so that the entries are functions of s only):
+        rows = [{} for i in range(n)]
+        cols = [set() for i in range(n)]
+        for i, j, coef in zip(self.A_row, self.A_col, self._A_coef):
+            rows[i][j] = sympy.Add(*[c*s**k for k, c in enumerate(coef)])
+            cols[j].add(i)
+        B_rows = [{} for i in range(n)]
+        for k, i in enumerate(self.B_row):
+            if i >= 0:
+                B_rows[i][k] = sympy.S.One
+        # entries (i, j) of A and (i, k) of B which went through a sum:
+        summed = set()
+        B_summed = set()
+        
+        def eliminate(v):
+            '''eliminates the signal `v` from the other equations
+            with its own equation (the row `v`, then removed)'''
+            row = rows[v]
+            pivot = row.pop(v, 0)
+            if pivot == 0:
+                raise ValueError('the diagram has a singular algebraic loop ' +\
+                                 'through {}!'.format(repr(self.signals[v])))
+            for j in row:
+                cols[j].discard(v)
+            cols[v].discard(v)
+            for i in cols[v]:
+                factor = rows[i].pop(v)/pivot
+                factor_summed = (v, v) in summed or (i, v) in summed
+                summed.discard((i, v))
+                for j, a in row.items():
+                    value = rows[i].get(j)
+                    # (products are kept factored: only sums are simplified)
+                    if value is None:
+                        value = -factor*a
+                        is_summed = factor_summed or (v, j) in summed
+                    else:
+                        value = sympy.cancel(value - factor*a)
+                        is_summed = True
+                    if value == 0:
+                        rows[i].pop(j, None)
+                        cols[j].discard(i)
+                        summed.discard((i, j))
+                    else:
+                        rows[i][j] = value
+                        cols[j].add(i)
+                        if is_summed:
+                            summed.add((i, j))
+                for k, c in B_rows[v].items():
+                    value = B_rows[i].get(k)
+                    if value is None:
+                        value = -factor*c
+                        is_summed = factor_summed or (v, k) in B_summed
+                    else:
+                        value = sympy.cancel(value - factor*c)
+                        is_summed = True
+                    if value == 0:
+                        B_rows[i].pop(k, None)
+                        B_summed.discard((i, k))
+                    else:
+                        B_rows[i][k] = value
+                        if is_summed:
+                            B_summed.add((i, k))
+            for j in row:
+                summed.discard((v, j))
+            summed.discard((v, v))
+            for k in B_rows[v]:
+                B_summed.discard((v, k))
+            B_rows[v] = {}
+            rows[v] = {}
+            cols[v] = set()
+        
+        def score(v):
+            '''number of entries updated by the elimination of `v`'''
+            return (len(cols[v]) - 1)*(len(rows[v]) - 1)
+        
+        outputs = sorted(set(int(i) for i in self.output_index if i >= 0))
+        output_set = set(outputs)
+        heap = [(score(v), v) for v in range(n) if v not in output_set]
+        heapq.heapify(heap)
+        eliminated = set()
+        while heap:
+            v_score, v = heapq.heappop(heap)
+            if v in eliminated:
+                continue
+            current = score(v)
+            if current > v_score:
+                # outdated score (the neighbors of v were eliminated)
+                heapq.heappush(heap, (current, v))
+                continue
+            eliminate(v)
+            eliminated.add(v)
+        
+        # system of the output signals: the transfer functions are simplified
+        # if the signals are coupled or if their entries went through a sum
+        index = {v: k for k, v in enumerate(outputs)}
+        A_out = sympy.zeros(len(outputs), len(outputs))
+        B_out = sympy.zeros(len(outputs), n_in)
+        for v in outputs:
+            for j, a in rows[v].items():
+                A_out[index[v], index[j]] = a
+            for k, c in B_rows[v].items():
+                B_out[index[v], k] = c
+        H = A_out.LUsolve(B_out) if outputs else None
+        coupled = summed or any(len(rows[v]) > 1 for v in outputs)
+        output_expr = []
+        for i in self.output_index:
+            if i < 0:
+                output_expr.append(sympy.S.Zero)
+                continue
+            terms = []
+            for k in range(n_in):
+                tf = H[index[i], k]
+                if coupled or (i, k) in B_summed:
+                    tf = sympy.cancel(tf)
+                terms.append(tf*input_var[k])
+            output_expr.append(sympy.Add(*terms))
+        return output_expr
+# end LinearModel
+
+def frequency_response(syst, omegas):
+    '''Frequency response of the LTI block diagram `syst` (or of its
+    LinearModel) at the angular frequencies `omegas` (array)
+    
+    Returns `H`, `output_var`, `input_var`
+    with H of shape (n_out, n_in, len(omegas)): H[i,j] is the complex
+    frequency response from input j to output i.
+    '''
+    if isinstance(syst, LinearModel):
+        model = syst
+    else:
+        model = LinearModel(syst)
+    H = model.frequency_response(omegas)
+    return H, model.output_var, model.input_var
+
+
+class SignalFlowGraph(object):
+    '''Signal flow graph of a block diagram, reduced by node elimination
+    
+    The diagram `syst` is flattened (see `blocks.flatten`). The nodes of the
+    graph are its signals, inputs and outputs. Each leaf block adds edges
+    from its input signals to its output signals, weighted by its transfer
+    functions (see `block_gains`). Inputs feed their signal and outputs
+    read their signal with a gain 1.
+    
+    `reduce` eliminates the signals one by one (fewest paths through
+    the node first): each path p -> v -> q through the eliminated signal v
+    becomes an edge p -> q with the gain a·b/(1 - l), where l is the gain
+    of the self loop of v. The remaining edges go from the inputs to the
+    outputs: they are the transfer functions of the diagram.
+    
+    Eliminating v costs one edge update per path through it, i.e.
+    in-degree × out-degree: the cost is linear in the number of edges
+    for the series nodes (one predecessor or one successor), which are
+    eliminated first, but quadratic in the degree of the nodes which have
+    many of both (and the eliminations may add edges).
+    '''
+    def __init__(self, syst):
+        leaves, signals, inputs, outputs = blocks.flatten(syst)
+        self.signals = signals
+        self.input_var = [symbols(name) for name, sig in inputs]
+        self.output_var = [symbols(name) for name, sig in outputs]
+        # Nodes: signals, then inputs, then outputs
+        n = len(signals)
+        self._input_node = n
+        self._output_node = n + len(inputs)
+        n_nodes = n + len(inputs) + len(outputs)
+        self._succ = [{} for i in range(n_nodes)]
+        self._pred = [{} for i in range(n_nodes)]
+        self._reduced = False
+        # edges (p, q) which gains went through the elimination of a loop:
+        self._looped = set()
+        
+        drivers = np.zeros(n, dtype=int)
+        for k, (name, sig) in enumerate(inputs):
+            if sig is not None:
+                self._add_edge(self._input_node + k, sig, sympy.S.One)
+                drivers[sig] += 1
+        for k, (name, sig) in enumerate(outputs):
+            if sig is not None:
+                self._add_edge(sig, self._output_node + k, sympy.S.One)
+        for block, in_sig, out_sig in leaves:
+            for out, gains in zip(out_sig, block_gains(block)):
+                if out is None:
+                    continue # output is not used
+                drivers[out] += 1
+                for sig, gain in zip(in_sig, gains):
+                    if sig is not None:
+                        self._add_edge(sig, out, gain)
+        # end for each block
+        
+        not_driven = np.flatnonzero(drivers != 1)
+        if len(not_driven):
+            sig = not_driven[0]
+            raise ValueError('Signal of {} has {} sources (one expected)'.format(
+                             repr(signals[sig]), drivers[sig]))
+    # end __init__
+    
+    def _add_edge(self, p, q, gain, looped=False):
+        '''adds the gain of an edge p -> q (to the existing edge, if any).
+        `looped` tells if the gain went through the elimination of a loop.
+        '''
+        if looped:
+            self._looped.add((p, q))
+        if q in self._succ[p]:
+            gain = sympy.cancel(self._succ[p][q] + gain)
+        if gain == 0:
+            self._succ[p].pop(q, None)
+            self._pred[q].pop(p, None)
+            self._looped.discard((p, q))
+        else:
+            self._succ[p][q] = gain
+            self._pred[q][p] = gain
+    
+    def _eliminate(self, v):
+        '''eliminates the node `v`, with the paths going through it'''
+        succ, pred = self._succ[v], self._pred[v]
+        loop = succ.pop(v, None)
+        pred.pop(v, None)
+        factor = sympy.S.One
+        if loop is not None:
+            factor = sympy.cancel(1 - loop)
+            if factor == 0:
+                raise ValueError('the diagram has a singular algebraic loop ' +\
+                                 'through {}!'.format(repr(self.signals[v])))
+            factor = 1/factor
+        looped = self._looped
+        for p in pred:
+            del self._succ[p][v]
+        for q in succ:
+            del self._pred[q][v]
+        for p, a in pred.items():
+            for q, b in succ.items():
+                # (products are kept factored: only sums are simplified)
+                self._add_edge(p, q, a*b*factor, loop is not None or
+                               (p, v) in looped or (v, q) in looped)
+        for p in pred:
+            looped.discard((p, v))
+        for q in succ:
+            looped.discard((v, q))
+        looped.discard((v, v))
+        self._succ[v] = {}
+        self._pred[v] = {}
+    
+    def _score(self, v):
+        '''number of paths through the node `v`'''
+        return len(self._pred[v])*len(self._succ[v])
+    
+    def reduce(self):
+        '''eliminates all the signals (greedy order: the signal with
+        the fewest paths through it first)'''
+        if self._reduced:
+            return
+        import heapq
+        heap = [(self._score(v), v) for v in range(self._input_node)]
+        heapq.heapify(heap)
+        eliminated = set()
+        while heap:
+            score, v = heapq.heappop(heap)
+            if v in eliminated:
+                continue
+            current = self._score(v)
+            if current > score:
+                # outdated score (the neighbors of v were eliminated)
+                heapq.heappush(heap, (current, v))
+                continue
+            self._eliminate(v)
+            eliminated.add(v)
+        self._reduced = True
+    
+    def transfer_expr(self, input_var=None):
+        '''Laplace expressions of the outputs, as functions of the
+        input variables `input_var` (defaults to `self.input_var`)
+        
+        The gains are simplified only if their paths went through a loop:
+        the gains of loop-free paths are kept as products of the block gains.
+        '''
+        if input_var is None:
+            input_var = self.input_var
+        self.reduce()
+        output_expr = []
+        for k in range(len(self.output_var)):
+            q = self._output_node + k
+            pred = self._pred[q]
+            output_expr.append(sympy.Add(*[
+                (sympy.cancel(gain) if (p, q) in self._looped else gain)*
+                input_var[p - self._input_node]
+                for p, gain in sorted(pred.items())]))
+        return output_expr
+# end SignalFlowGraph
+
 
 if __name__ == '__main__':
     # Example tranfer function modeling of a closed loop system